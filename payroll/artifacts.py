@@ -0,0 +1,213 @@
+from django.conf import settings
+from .pdf_generator import generate_payroll_pdf
+from .statutory import generate_statutory_files, statutory_filename, statutory_zip_files, STATUTORY_FILES
+from datetime import datetime
+from io import BytesIO, StringIO
+import csv
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from .entities import current_entity
+
+MANIFEST_NAME = 'manifest.json'
+
+# Columns of the payroll register export: (header, line field)
+REGISTER_COLUMNS = [
+    ('Employee ID', 'employee_id'),
+    ('Name', 'name'),
+    ('Role', 'role'),
+    ('Salary', 'salary'),
+    ('EPF', 'epf_deduction'),
+    ('SOCSO', 'socso_deduction'),
+    ('EIS', 'eis_deduction'),
+    ('Zakat', 'zakat_deduction'),
+    ('PCB', 'pcb_deduction'),
+    ('HRDF', 'hrdf_deduction'),
+    ('Statutory Total', 'statutory_deductions_total'),
+    ('Ad-hoc Deductions', 'adhoc_deductions_total'),
+    ('Total Deductions', 'total_deductions'),
+    ('Net Pay', 'net_pay'),
+    ('Employer EPF', 'employer_epf'),
+    ('Employer SOCSO', 'employer_socso'),
+    ('Employer EIS', 'employer_eis'),
+]
+
+# Finalized runs never change, so manifests and verified checksums are cached for the process
+_manifests = {}
+_verified = set()
+_lock = threading.Lock()
+
+def payslip_filename(run, line):
+    """Download filename for one employee's payslip"""
+    employee_name = (line.get('name') or 'employee').replace(' ', '_')
+    return f"{employee_name}_payslip_{run['month']}.pdf"
+
+def combined_filename(run):
+    return f"payroll_{run['month']}_combined.pdf"
+
+def payslips_zip_filename(run):
+    return f"leogics_payslips_{run['month'].replace('-', '_')}.zip"
+
+def statutory_zip_filename(run):
+    return f"statutory_{run['month'].replace('-', '_')}.zip"
+
+def register_filename(run):
+    return f"payroll_register_{run['month'].replace('-', '_')}.csv"
+
+def generate_payroll_register(run, lines):
+    """CSV register of every line in a run, with a totals row"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([header for header, _ in REGISTER_COLUMNS])
+
+    totals = {}
+    for line in lines:
+        row = []
+        for _, field in REGISTER_COLUMNS:
+            value = line.get(field)
+            if isinstance(value, (int, float)):
+                totals[field] = totals.get(field, 0) + value
+                value = f"{value:.2f}"
+            row.append(value or '')
+        writer.writerow(row)
+
+    writer.writerow([
+        'TOTAL' if index == 0 else (f"{totals[field]:.2f}" if field in totals else '')
+        for index, (_, field) in enumerate(REGISTER_COLUMNS)
+    ])
+    return buffer.getvalue().encode('utf-8')
+
+def build_zip(files):
+    """ZIP archive of (filename, content) pairs"""
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for filename, content in files:
+            zip_file.writestr(filename, content)
+    return zip_buffer.getvalue()
+
+def entity_dir():
+    """Artifacts directory of the current entity; the default entity keeps the top level"""
+    entity_id = current_entity()
+    if entity_id == settings.PAYROLL_DEFAULT_ENTITY:
+        return settings.PAYROLL_ARTIFACTS_DIR
+    return os.path.join(settings.PAYROLL_ARTIFACTS_DIR, 'entities', entity_id)
+
+def run_dir(run_id):
+    return os.path.join(entity_dir(), run_id)
+
+def render_run_artifacts(run, lines):
+    """Render every download of a run into a scratch directory; returns (scratch, manifest)"""
+    # (name, download filename, content type, content)
+    artifacts = [('combined.pdf', combined_filename(run), 'application/pdf', generate_payroll_pdf(run, lines).getvalue())]
+
+    payslips = []
+    for line in lines:
+        filename = payslip_filename(run, line)
+        content = generate_payroll_pdf(run, [line]).getvalue()
+        payslips.append((filename, content))
+        artifacts.append((f"payslips/{line['id']}.pdf", filename, 'application/pdf', content))
+    artifacts.append(('payslips.zip', payslips_zip_filename(run), 'application/zip', build_zip(payslips)))
+
+    artifacts.append(('register.csv', register_filename(run), 'text/csv', generate_payroll_register(run, lines)))
+
+    # Statutory files that can't be produced yet aren't frozen, so they are rendered live once fixed
+    statutory = generate_statutory_files(run, lines)
+    for kind in STATUTORY_FILES:
+        if statutory[kind] is not None:
+            content_type = 'text/csv' if kind == 'epf' else 'text/plain'
+            artifacts.append((f"statutory/{kind}", statutory_filename(run, kind), content_type, statutory[kind]))
+    if not statutory['problems']:
+        artifacts.append(('statutory/all', statutory_zip_filename(run), 'application/zip', build_zip(statutory_zip_files(run, statutory))))
+
+    # Written to a scratch directory and swapped in whole by publish_run_artifacts,
+    # so readers never see a partial set
+    os.makedirs(entity_dir(), exist_ok=True)
+    scratch = os.path.join(entity_dir(), f".{run['id']}-{uuid.uuid4().hex}")
+    manifest = {'run_id': run['id'], 'month': run['month'], 'frozen_at': datetime.now().isoformat(), 'files': {}}
+    try:
+        for name, filename, content_type, content in artifacts:
+            path = os.path.join(scratch, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+            manifest['files'][name] = {
+                'filename': filename,
+                'content_type': content_type,
+                'size': len(content),
+                'sha256': hashlib.sha256(content).hexdigest(),
+            }
+        with open(os.path.join(scratch, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    except Exception:
+        discard_run_artifacts(scratch)
+        raise
+    return scratch, manifest
+
+def publish_run_artifacts(run, scratch, manifest):
+    """Swap a rendered scratch directory in as the run's frozen artifacts"""
+    target = run_dir(run['id'])
+    with _lock:
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        os.replace(scratch, target)
+        _manifests[target] = manifest
+        _verified.difference_update({key for key in _verified if key[0] == target})
+
+def discard_run_artifacts(scratch):
+    """Remove a rendered scratch directory that won't be published"""
+    shutil.rmtree(scratch, ignore_errors=True)
+
+def freeze_run_artifacts(run, lines):
+    """Render and publish every download of a finalized run; returns the manifest"""
+    scratch, manifest = render_run_artifacts(run, lines)
+    try:
+        publish_run_artifacts(run, scratch, manifest)
+    finally:
+        discard_run_artifacts(scratch)
+    return manifest
+
+def get_frozen_manifest(run_id):
+    """Manifest of a run's frozen artifacts, or None if the run isn't frozen here"""
+    directory = run_dir(run_id)
+    with _lock:
+        manifest = _manifests.get(directory)
+    if manifest is None:
+        try:
+            with open(os.path.join(directory, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with _lock:
+            _manifests[directory] = manifest
+    return manifest
+
+def get_frozen_artifact(run_id, name):
+    """Path and manifest entry of a frozen artifact, or None if the run isn't frozen here"""
+    manifest = get_frozen_manifest(run_id)
+    if manifest is None:
+        return None
+    directory = run_dir(run_id)
+
+    entry = manifest['files'].get(name)
+    if entry is None:
+        return None
+
+    path = os.path.join(directory, name)
+    if (directory, name) not in _verified:
+        # Checked once per process; a corrupt or missing file falls back to a live render
+        try:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+        except OSError:
+            return None
+        if digest.hexdigest() != entry['sha256']:
+            return None
+        with _lock:
+            _verified.add((directory, name))
+    return path, entry
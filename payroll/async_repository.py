@@ -0,0 +1,89 @@
+from payroll_mvp.firebase import get_async_db
+from .records import PayrollRun, PayrollLines, unpack_lines
+from .entities import scoped_collection
+from .repository import ytd_rollup_id, ytd_as_at
+import asyncio
+import hashlib
+
+# Async counterparts of the repository reads used by the async views
+
+def collection(name):
+    """A collection of the current entity on the event loop's async client"""
+    return scoped_collection(get_async_db(), name)
+
+async def get_payroll_run(run_id):
+    """Get payroll run by ID"""
+    doc = await collection('payroll_runs').document(run_id).get()
+    if doc.exists:
+        return PayrollRun.from_document(doc)
+    return None
+
+async def get_run_archive(run_id):
+    """Archived lines of a run, or None if the run is still live"""
+    doc = await collection('payroll_archives').document(run_id).get()
+    if not doc.exists:
+        return None
+    
+    archive = doc.to_dict()
+    if hashlib.sha256(archive['snapshot']).hexdigest() != archive['sha256']:
+        raise ValueError(f'Archive for run {run_id} failed its checksum')
+    return unpack_lines(archive['snapshot'])
+
+async def get_payroll_lines(run_id):
+    """Get all payroll lines for a run as a compact columnar table"""
+    archived = await get_run_archive(run_id)
+    if archived is not None:
+        return archived
+    
+    lines = PayrollLines()
+    docs = collection('payroll_runs').document(run_id).collection('lines').stream()
+    async for doc in docs:
+        lines.append(doc.id, doc.to_dict())
+    return lines
+
+async def get_changed_payroll_lines(run_id, since_version):
+    """Get the lines of a run written after a given run version"""
+    lines = []
+    docs = (
+        collection('payroll_runs').document(run_id)
+        .collection('lines').where('version', '>', since_version).stream()
+    )
+    async for doc in docs:
+        line = doc.to_dict()
+        line['id'] = doc.id
+        lines.append(line)
+    return lines
+
+async def get_line_with_deductions(run_id, line_id):
+    """Get a single payroll line and its ad-hoc deductions; (None, []) if there is no such line"""
+    # The archive is read and unpacked once, whichever of the two is wanted
+    archived = await get_run_archive(run_id)
+    if archived is not None:
+        line = archived.find(line_id)
+        if line is None:
+            return None, []
+        return line.to_dict(), line.get('adhoc_deductions') or []
+    
+    line_ref = collection('payroll_runs').document(run_id).collection('lines').document(line_id)
+    doc, deductions = await asyncio.gather(line_ref.get(), read_line_deductions(line_ref))
+    if not doc.exists:
+        return None, []
+    line = doc.to_dict()
+    line['id'] = doc.id
+    return line, deductions
+
+async def read_line_deductions(line_ref):
+    """Stream one live line's ad-hoc deductions"""
+    deductions = []
+    async for doc in line_ref.collection('deductions').order_by('sort_order').stream():
+        deduction = doc.to_dict()
+        deduction['id'] = doc.id
+        deductions.append(deduction)
+    return deductions
+
+async def get_line_ytd(line, month):
+    """YTD totals as at `month` for one line's employee, or None"""
+    if not line.get('employee_ref'):
+        return None
+    doc = await collection('employee_ytd').document(ytd_rollup_id(line['employee_ref'], month[:4])).get()
+    return ytd_as_at(doc.to_dict(), month) if doc.exists else None
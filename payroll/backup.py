@@ -0,0 +1,164 @@
+from payroll_mvp.firebase import db
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+# Collections backed up. Each is read as a partitioned collection group, which covers the
+# default entity's top-level collections, those partitioned under entities/<id>/, and
+# splits large runs' lines and deductions across workers
+BACKUP_COLLECTIONS = [
+    'entities', 'employees', 'payroll_runs', 'chunks', 'lines', 'deductions', 'deduction_schedules', 'attendance',
+    'employee_ytd', 'payroll_aggregates', 'payroll_archives', 'pay_history_archive',
+]
+
+# Documents per chunk file
+CHUNK_RECORDS = 5000
+
+# Documents per batched write when restoring
+WRITE_BATCH_SIZE = 400
+
+MANIFEST_NAME = 'manifest.json'
+
+def encode_value(value):
+    """JSON fallback for Firestore timestamps and bytes"""
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, bytes):
+        return {'$bytes': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'Cannot back up {type(value).__name__}')
+
+def decode_object(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    if len(obj) == 1 and '$bytes' in obj:
+        return base64.b64decode(obj['$bytes'])
+    return obj
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class ChunkWriter:
+    """Writes documents to numbered gzip JSON-lines files, starting a new one every CHUNK_RECORDS"""
+
+    def __init__(self, directory, prefix):
+        self.directory = directory
+        self.prefix = prefix
+        self.chunks = []
+        self.file = None
+        self.records = 0
+
+    def write(self, path, data):
+        if self.file is None:
+            self.name = f'{self.prefix}-{len(self.chunks):04d}.jsonl.gz'
+            self.file = gzip.open(os.path.join(self.directory, self.name), 'wt', encoding='utf-8')
+        self.file.write(json.dumps({'path': path, 'data': data}, default=encode_value, separators=(',', ':')))
+        self.file.write('\n')
+        self.records += 1
+        if self.records == CHUNK_RECORDS:
+            self.finish_chunk()
+
+    def finish_chunk(self):
+        self.file.close()
+        self.chunks.append({
+            'file': self.name,
+            'records': self.records,
+            'sha256': file_sha256(os.path.join(self.directory, self.name)),
+        })
+        self.file = None
+        self.records = 0
+
+    def close(self):
+        """Finish the open chunk; returns manifest entries for every chunk written"""
+        if self.file is not None:
+            self.finish_chunk()
+        return self.chunks
+
+def export_dataset(directory, workers=8):
+    """Stream every collection into checksummed chunk files in parallel; returns the manifest"""
+    os.makedirs(directory, exist_ok=True)
+
+    # Each source is a callable streaming one partition of a collection group
+    sources = [
+        partition.query().stream
+        for name in BACKUP_COLLECTIONS
+        for partition in db.collection_group(name).get_partitions(workers * 4)
+    ]
+
+    # Each worker thread appends to its own chunk files, so nothing is held in memory
+    writers = []
+    writers_lock = threading.Lock()
+    local = threading.local()
+
+    def export_source(stream):
+        writer = getattr(local, 'writer', None)
+        if writer is None:
+            with writers_lock:
+                writer = local.writer = ChunkWriter(directory, f'chunk-{len(writers):03d}')
+                writers.append(writer)
+        count = 0
+        for doc in stream():
+            writer.write(doc.reference.path, doc.to_dict())
+            count += 1
+        return count
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backup') as pool:
+        records = sum(pool.map(export_source, sources))
+
+    manifest = {
+        'created_at': datetime.now().isoformat(),
+        'records': records,
+        'chunks': [chunk for writer in writers for chunk in writer.close()],
+    }
+    with open(os.path.join(directory, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+def read_manifest(directory):
+    with open(os.path.join(directory, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+def verify_backup(directory):
+    """Check every chunk against the manifest without touching Firestore; returns a list of problems"""
+    manifest = read_manifest(directory)
+    problems = []
+    for chunk in manifest['chunks']:
+        path = os.path.join(directory, chunk['file'])
+        if not os.path.exists(path):
+            problems.append(f"{chunk['file']}: missing")
+        elif file_sha256(path) != chunk['sha256']:
+            problems.append(f"{chunk['file']}: checksum mismatch")
+    return problems
+
+def restore_chunk(path):
+    """Replay one chunk file with batched writes; returns documents written"""
+    count = 0
+    batch = db.batch()
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for row in f:
+            record = json.loads(row, object_hook=decode_object)
+            batch.set(db.document(record['path']), record['data'])
+            count += 1
+            if count % WRITE_BATCH_SIZE == 0:
+                batch.commit()
+                batch = db.batch()
+    batch.commit()
+    return count
+
+def restore_dataset(directory, workers=8):
+    """Verify a backup, then write its chunks back to Firestore in parallel; returns documents written"""
+    problems = verify_backup(directory)
+    if problems:
+        raise ValueError('Backup failed verification: ' + '; '.join(problems))
+
+    paths = [os.path.join(directory, chunk['file']) for chunk in read_manifest(directory)['chunks']]
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='restore') as pool:
+        return sum(pool.map(restore_chunk, paths))
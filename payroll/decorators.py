@@ -0,0 +1,12 @@
+from functools import wraps
+from django.contrib.auth.views import redirect_to_login
+
+def async_login_required(view_func):
+    """login_required for async views"""
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view_func(request, *args, **kwargs)
+    return wrapper
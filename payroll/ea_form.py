@@ -0,0 +1,112 @@
+from reportlab.lib.pagesizes import A4
+from reportlab.lib import colors
+from reportlab.lib.units import cm
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
+from reportlab.lib.styles import getSampleStyleSheet
+from io import BytesIO
+from .entities import get_branding
+
+def generate_ea_forms_pdf(year, rollups):
+    """Generate one EA form page per employee from their YTD rollups"""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=A4,
+        topMargin=1.5*cm,
+        bottomMargin=1.5*cm,
+        leftMargin=1.5*cm,
+        rightMargin=1.5*cm
+    )
+
+    elements = []
+    styles = getSampleStyleSheet()
+
+    for idx, rollup in enumerate(rollups):
+        if idx > 0:
+            elements.append(PageBreak())
+
+        elements.extend(create_ea_form_page(year, rollup, styles))
+
+    doc.build(elements)
+    buffer.seek(0)
+    return buffer
+
+def create_ea_form_page(year, rollup, styles):
+    """Create a single EA form page"""
+    page_elements = []
+    totals = rollup.get('totals', {})
+
+    page_elements.append(Paragraph(f"<b><font size=14>EA Form - Statement of Remuneration for {year}</font></b>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.3*cm))
+    company = get_branding()
+    page_elements.append(Paragraph(f"<b>{company['name']}</b><br/>{'<br/>'.join(company['address_lines'])}<br/><font size=8>{company['registration']}</font>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.5*cm))
+
+    # A. Particulars of employee
+    page_elements.append(Paragraph("<b>A. Particulars of Employee</b>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.2*cm))
+
+    particulars = [
+        ['Name', rollup.get('name') or 'N/A'],
+        ['Employee ID', rollup.get('employee_id') or 'N/A'],
+        ['Position', rollup.get('role') or 'N/A'],
+        ['NRIC/Passport', rollup.get('passport') or 'N/A'],
+        ['EPF No.', rollup.get('epf_no') or 'N/A'],
+        ['SOCSO No.', rollup.get('socso_no') or 'N/A'],
+    ]
+    page_elements.append(ea_table(particulars, [5*cm, 13*cm]))
+    page_elements.append(Spacer(1, 0.5*cm))
+
+    # B. Employment income
+    page_elements.append(Paragraph("<b>B. Employment Income</b>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.2*cm))
+
+    income = [
+        ['Gross salary, wages or leave pay', f"{totals.get('salary', 0):.2f}"],
+        ['Total', f"{totals.get('salary', 0):.2f}"],
+    ]
+    page_elements.append(ea_table(income, [14*cm, 4*cm], total_row=True))
+    page_elements.append(Spacer(1, 0.5*cm))
+
+    # C. Tax deductions
+    page_elements.append(Paragraph("<b>C. Total Deductions</b>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.2*cm))
+
+    deductions = [
+        ['Monthly tax deductions (PCB) remitted to LHDNM', f"{totals.get('pcb_deduction', 0):.2f}"],
+        ['Zakat paid via salary deduction', f"{totals.get('zakat_deduction', 0):.2f}"],
+    ]
+    page_elements.append(ea_table(deductions, [14*cm, 4*cm]))
+    page_elements.append(Spacer(1, 0.5*cm))
+
+    # D. Statutory contributions
+    page_elements.append(Paragraph("<b>D. Contributions Paid by Employee</b>", styles['Normal']))
+    page_elements.append(Spacer(1, 0.2*cm))
+
+    contributions = [
+        ['Employees Provident Fund (EPF)', f"{totals.get('epf_deduction', 0):.2f}"],
+        ['SOCSO', f"{totals.get('socso_deduction', 0):.2f}"],
+        ['Employment Insurance System (EIS)', f"{totals.get('eis_deduction', 0):.2f}"],
+    ]
+    page_elements.append(ea_table(contributions, [14*cm, 4*cm]))
+
+    page_elements.append(Spacer(1, 1*cm))
+    page_elements.append(Paragraph("<font size=7 color='#666666'><b>Generated from Leogics Payroll System</b></font>", styles['Normal']))
+
+    return page_elements
+
+def ea_table(rows, col_widths, total_row=False):
+    """Two-column label/amount table used throughout the EA form"""
+    table = Table(rows, colWidths=col_widths)
+    style = [
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+        ('TOPPADDING', (0, 0), (-1, -1), 3),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+        ('LINEBELOW', (0, 0), (-1, -1), 0.5, colors.HexColor('#eeeeee')),
+    ]
+    if total_row:
+        style.append(('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold'))
+        style.append(('BACKGROUND', (0, -1), (-1, -1), colors.HexColor('#f5f5f5')))
+    table.setStyle(TableStyle(style))
+    return table
@@ -0,0 +1,139 @@
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from itertools import groupby
+import csv
+import io
+
+# Hours in a normal working day; time beyond this on any day is overtime
+STANDARD_DAY_HOURS = 8
+
+# Working days used to derive the hourly rate from a monthly salary
+WORKING_DAYS_PER_MONTH = 26
+
+OVERTIME_MULTIPLIER = 1.5
+
+# Longest gap between an in-punch and the next punch that still counts as one shift;
+# a punch with no partner within it is reported as unmatched
+MAX_SHIFT_HOURS = 16
+
+class PunchFileError(ValueError):
+    """A punches upload that can't be read as a CSV file"""
+
+def month_bounds(month):
+    """First and last day of a 'YYYY-MM' month"""
+    year, month_no = (int(part) for part in month.split('-'))
+    return date(year, month_no, 1), date(year, month_no, monthrange(year, month_no)[1])
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def read_punches(csv_file, month):
+    """Read (employee_id, punch time) pairs for a month, plus a day either side for overnight shifts"""
+    first, last = month_bounds(month)
+    first, last = first - timedelta(days=1), last + timedelta(days=1)
+    reader = csv.DictReader(io.TextIOWrapper(csv_file, encoding='utf-8-sig'))
+
+    punches = []
+    skipped = 0
+    try:
+        for row in reader:
+            try:
+                punched_at = datetime.fromisoformat((row.get('timestamp') or '').strip())
+            except ValueError:
+                skipped += 1
+                continue
+            # Clocks record local wall time; an offset, where given, is dropped so that
+            # every punch compares on the same footing
+            punched_at = punched_at.replace(tzinfo=None)
+            employee_id = (row.get('employee_id') or '').strip()
+            if employee_id and first <= punched_at.date() <= last:
+                punches.append((employee_id, punched_at))
+            else:
+                skipped += 1
+    except UnicodeDecodeError:
+        raise PunchFileError("The punches file is not UTF-8 text; export it as CSV UTF-8 and upload it again")
+    except csv.Error as error:
+        raise PunchFileError(f"The punches file is not a valid CSV file: {error}")
+    return punches, skipped
+
+def pair_punches(times):
+    """Pair sorted punches into (in, out) shifts, across midnight; returns (shifts, unmatched punches)"""
+    shifts, unmatched = [], []
+    index = 0
+    while index < len(times):
+        clock_in = times[index]
+        if index + 1 < len(times) and times[index + 1] - clock_in <= timedelta(hours=MAX_SHIFT_HOURS):
+            shifts.append((clock_in, times[index + 1]))
+            index += 2
+        else:
+            unmatched.append(clock_in)
+            index += 1
+    return shifts, unmatched
+
+def aggregate_punches(punches, month):
+    """Days worked, hours and overtime hours per employee from raw punches; returns (summaries, unmatched punches)"""
+    first, last = month_bounds(month)
+
+    # One sort puts every employee's punches together, in order; they then pair up as in/out,
+    # and each shift counts towards the day it started on
+    punches.sort()
+    summaries, unmatched = {}, {}
+    for employee_id, employee_punches in groupby(punches, key=lambda punch: punch[0]):
+        shifts, lone = pair_punches([punched_at for _, punched_at in employee_punches])
+
+        # Punches from the days either side only complete shifts that cross the month boundary
+        lone = [punched_at for punched_at in lone if first <= punched_at.date() <= last]
+        if lone:
+            unmatched[employee_id] = lone
+
+        daily_hours = {}
+        for clock_in, clock_out in shifts:
+            if first <= clock_in.date() <= last:
+                day = clock_in.date()
+                daily_hours[day] = daily_hours.get(day, 0) + (clock_out - clock_in).total_seconds() / 3600
+        daily_hours = {day: hours for day, hours in daily_hours.items() if hours > 0}
+        if not daily_hours and not lone:
+            continue
+
+        summaries[employee_id] = {
+            'days_worked': len(daily_hours),
+            'hours': round(sum(daily_hours.values()), 2),
+            'overtime_hours': round(sum(max(hours - STANDARD_DAY_HOURS, 0) for hours in daily_hours.values()), 2),
+            'unmatched_punches': len(lone),
+        }
+    return summaries, unmatched
+
+def earning(label, amount, units=None, rate=None):
+    return {'label': label, 'units': units, 'rate': rate, 'amount': round(amount, 2)}
+
+def compute_earnings(employee, month, attendance=None):
+    """Earnings rows for one employee's month: (prorated) salary, overtime and allowance"""
+    base_salary = employee.get('base_salary') or 0
+    earnings = []
+
+    # Joiners and leavers are paid for the calendar days they were employed
+    first, last = month_bounds(month)
+    start = max(first, parse_date(employee.get('join_date')) or first)
+    end = min(last, parse_date(employee.get('leave_date')) or last)
+    days_employed = max((end - start).days + 1, 0)
+    days_in_month = (last - first).days + 1
+
+    if days_employed < days_in_month:
+        daily_rate = base_salary / days_in_month
+        earnings.append(earning('Salary (prorated)', daily_rate * days_employed, units=days_employed, rate=round(daily_rate, 2)))
+    else:
+        earnings.append(earning('Salary', base_salary))
+
+    overtime_hours = (attendance or {}).get('overtime_hours') or 0
+    if overtime_hours and days_employed:
+        rate = round(base_salary / WORKING_DAYS_PER_MONTH / STANDARD_DAY_HOURS * OVERTIME_MULTIPLIER, 2)
+        earnings.append(earning('Overtime', overtime_hours * rate, units=overtime_hours, rate=rate))
+
+    allowance = employee.get('allowance') or 0
+    if allowance and days_employed:
+        earnings.append(earning('Allowance', allowance))
+
+    return earnings
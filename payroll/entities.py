@@ -0,0 +1,153 @@
+from payroll_mvp.firebase import db
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+import threading
+import time
+
+# Cookie holding the entity picked in the selector
+ENTITY_COOKIE = 'payroll_entity'
+
+# How long the cached entity list is trusted before it is reloaded
+ENTITIES_TTL_SECONDS = 300
+
+_current_entity = ContextVar('payroll_entity', default=None)
+
+# Entity list looked up once by the middleware for the rest of the request
+_request_entities = ContextVar('payroll_entities', default=None)
+
+def current_entity():
+    """ID of the legal entity the current request or job is scoped to"""
+    return _current_entity.get() or settings.PAYROLL_DEFAULT_ENTITY
+
+@contextmanager
+def use_entity(entity_id):
+    """Scope repository calls inside the block to one entity"""
+    token = _current_entity.set(entity_id)
+    try:
+        yield
+    finally:
+        _current_entity.reset(token)
+
+def bind_entity(func):
+    """Wrap a callable so it runs scoped to the caller's entity on another thread"""
+    entity_id = current_entity()
+
+    def run(*args, **kwargs):
+        with use_entity(entity_id):
+            return func(*args, **kwargs)
+    return run
+
+def scoped_collection(client, name, entity_id=None):
+    """A collection partitioned under an entity; the default entity keeps the original top-level collections"""
+    entity_id = entity_id or current_entity()
+    if entity_id == settings.PAYROLL_DEFAULT_ENTITY:
+        return client.collection(name)
+    return client.collection('entities').document(entity_id).collection(name)
+
+def default_branding():
+    """Branding of the default entity, from settings"""
+    return {
+        'id': settings.PAYROLL_DEFAULT_ENTITY,
+        'name': settings.COMPANY_NAME,
+        'address_lines': settings.COMPANY_ADDRESS_LINES,
+        'registration': settings.COMPANY_REGISTRATION,
+        'logo': None,
+    }
+
+def load_entities():
+    """Read every entity's branding; the default entity is always first"""
+    entities = {settings.PAYROLL_DEFAULT_ENTITY: default_branding()}
+    for doc in db.collection('entities').stream():
+        data = doc.to_dict()
+        branding = entities.get(doc.id) or {'id': doc.id, 'name': doc.id, 'address_lines': [], 'registration': '', 'logo': None}
+        branding.update({
+            'name': data.get('name') or branding['name'],
+            'address_lines': (data['address'].splitlines() if data.get('address') else branding['address_lines']),
+            'registration': data.get('registration') or branding['registration'],
+            'logo': data.get('logo') or branding['logo'],
+        })
+        entities[doc.id] = branding
+    return entities
+
+_entities = None
+_entities_loaded_at = 0
+_entities_lock = threading.Lock()
+
+def get_entities():
+    """Cached branding of every entity, keyed by entity ID"""
+    global _entities, _entities_loaded_at
+    entities = _request_entities.get()
+    if entities is not None:
+        return entities
+    with _entities_lock:
+        if _entities is None or time.monotonic() - _entities_loaded_at > ENTITIES_TTL_SECONDS:
+            _entities = load_entities()
+            _entities_loaded_at = time.monotonic()
+        return _entities
+
+async def aget_entities():
+    """get_entities for the event loop; a stale cache is reloaded on a worker thread"""
+    from asgiref.sync import sync_to_async
+
+    entities = _request_entities.get()
+    if entities is not None:
+        return entities
+    if _entities is not None and time.monotonic() - _entities_loaded_at <= ENTITIES_TTL_SECONDS:
+        return _entities
+    return await sync_to_async(get_entities)()
+
+def get_branding(entity_id=None):
+    """Name, address lines, registration and logo bytes (or None) of an entity"""
+    entities = get_entities()
+    return entities.get(entity_id or current_entity()) or entities[settings.PAYROLL_DEFAULT_ENTITY]
+
+def invalidate_entities():
+    """Drop the cached entity list after an entity is added or changed"""
+    global _entities
+    with _entities_lock:
+        _entities = None
+
+def save_entity(entity_id, name, address='', registration='', logo=None):
+    """Create or update an entity's branding"""
+    data = {'name': name, 'address': address, 'registration': registration}
+    if logo is not None:
+        data['logo'] = logo
+    db.collection('entities').document(entity_id).set(data, merge=True)
+    invalidate_entities()
+
+@contextmanager
+def use_request_entities(request, entities):
+    """Scope a request to the entity chosen in the selector, reusing one entity list throughout"""
+    entity_id = request.COOKIES.get(ENTITY_COOKIE)
+    token = _request_entities.set(entities)
+    try:
+        with use_entity(entity_id if entity_id in entities else settings.PAYROLL_DEFAULT_ENTITY):
+            yield
+    finally:
+        _request_entities.reset(token)
+
+def entity_middleware(get_response):
+    """Scope each request to the entity chosen in the selector"""
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with use_request_entities(request, await aget_entities()):
+                return await get_response(request)
+        markcoroutinefunction(middleware)
+    else:
+        def middleware(request):
+            with use_request_entities(request, get_entities()):
+                return get_response(request)
+    return middleware
+
+entity_middleware.sync_capable = True
+entity_middleware.async_capable = True
+
+def entity_context(request):
+    """Template context for the entity selector"""
+    return {
+        'entities': list(get_entities().values()),
+        'current_entity': current_entity(),
+    }
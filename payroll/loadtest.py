@@ -0,0 +1,223 @@
+from django.urls import reverse
+from collections import defaultdict
+from contextlib import contextmanager
+import http.cookiejar
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# gunicorn arguments for each worker model
+WORKER_MODELS = {
+    'sync': ['payroll_mvp.wsgi:application', '-k', 'sync'],
+    'gthread': ['payroll_mvp.wsgi:application', '-k', 'gthread', '--threads', '4'],
+    'asgi': ['payroll_mvp.asgi:application', '-k', 'uvicorn.workers.UvicornWorker'],
+}
+
+# Month-end officer actions (URL names from payroll/urls.py) and how often each is picked
+SCENARIO = [
+    ('payroll_detail', 4),
+    ('payroll_lines_api', 3),
+    ('get_deductions', 4),
+    ('save_deductions', 2),
+    ('payslip_preview', 2),
+    ('download_all_payslips_zip', 1),
+]
+
+# Seconds to wait for a started server to accept connections
+SERVER_START_TIMEOUT = 30
+
+class Session:
+    """One logged-in browser: cookies, CSRF token and timed requests"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def cookie(self, name):
+        return next((cookie.value for cookie in self.cookies if cookie.name == name), None)
+
+    def request(self, path, form=None, body=None, timeout=120):
+        """Send a request; returns (status, response body)"""
+        headers = {'X-CSRFToken': self.cookie('csrftoken') or '', 'Referer': self.base_url + path}
+        data = None
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        try:
+            with self.opener.open(request, timeout=timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def login(self, username, password):
+        """Log in through the login form; returns whether a session was started"""
+        self.request(reverse('login'))
+        self.request(reverse('login'), form={
+            'username': username,
+            'password': password,
+            'csrfmiddlewaretoken': self.cookie('csrftoken') or '',
+        })
+        return self.cookie('sessionid') is not None
+
+class Stats:
+    """Latencies and errors per endpoint, shared by every session"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def timed(self, endpoint, call):
+        """Run one request, recording its latency and whether it failed; returns its result"""
+        start = time.perf_counter()
+        try:
+            status, content = call()
+        except (OSError, urllib.error.URLError):
+            self.record(endpoint, time.perf_counter() - start, False)
+            return None, b''
+        self.record(endpoint, time.perf_counter() - start, status < 400)
+        return status, content
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values"""
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+def summarize(stats, elapsed):
+    """Per-endpoint throughput, latency percentiles (ms) and error rate"""
+    summary = {}
+    for endpoint, latencies in sorted(stats.latencies.items()):
+        latencies = sorted(latencies)
+        summary[endpoint] = {
+            'requests': len(latencies),
+            'errors': stats.errors[endpoint],
+            'error_rate': stats.errors[endpoint] / len(latencies),
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+    return summary
+
+def run_step(session, stats, step, run_id, line_id):
+    """Perform one scenario action the way the detail screen does"""
+    if step == 'payroll_detail':
+        stats.timed(step, lambda: session.request(reverse('payroll_detail', args=[run_id])))
+    elif step == 'payroll_lines_api':
+        stats.timed(step, lambda: session.request(reverse('payroll_lines_api', args=[run_id])))
+    elif step == 'payslip_preview':
+        stats.timed(step, lambda: session.request(reverse('payslip_preview', args=[run_id, line_id])))
+    elif step == 'download_all_payslips_zip':
+        stats.timed(step, lambda: session.request(reverse('download_all_payslips_zip', args=[run_id])))
+    elif step in ('get_deductions', 'save_deductions'):
+        # Saving opens the deductions modal first, then writes the same deductions back
+        status, content = stats.timed('get_deductions', lambda: session.request(reverse('get_deductions', args=[run_id, line_id])))
+        if step == 'save_deductions' and status == 200:
+            deductions = [
+                {
+                    'name': deduction.get('name'),
+                    'amount': deduction.get('amount', 0),
+                    'recurring': deduction.get('recurring', False),
+                    'schedule_id': deduction.get('schedule_id'),
+                }
+                for deduction in json.loads(content).get('adhoc_deductions', [])
+            ]
+            stats.timed(step, lambda: session.request(
+                reverse('save_deductions', args=[run_id, line_id]), body={'adhoc_deductions': deductions}
+            ))
+
+def run_load(base_url, username, password, run_id, users=10, duration=30, seed=None, entity=None):
+    """Drive concurrent officer sessions against a server for a while; returns the per-endpoint summary"""
+    sessions = [Session(base_url) for _ in range(users)]
+    for session in sessions:
+        if not session.login(username, password):
+            raise ValueError(f'Could not log in to {base_url} as {username}')
+        if entity:
+            session.request(reverse('select_entity'), form={
+                'entity': entity,
+                'csrfmiddlewaretoken': session.cookie('csrftoken') or '',
+            })
+
+    status, content = sessions[0].request(reverse('payroll_lines_api', args=[run_id]))
+    if status != 200:
+        raise ValueError(f'Payroll run {run_id} is not available ({status})')
+    line_ids = [line['id'] for line in json.loads(content)['lines']]
+    if not line_ids:
+        raise ValueError(f'Payroll run {run_id} has no lines')
+
+    steps, weights = zip(*SCENARIO)
+    stats = Stats()
+    deadline = time.monotonic() + duration
+
+    def officer(number):
+        rng = random.Random(None if seed is None else seed + number)
+        while time.monotonic() < deadline:
+            step = rng.choices(steps, weights)[0]
+            run_step(sessions[number], stats, step, run_id, rng.choice(line_ids))
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=officer, args=(number,), daemon=True) for number in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(stats, time.monotonic() - started)
+
+def wait_for_port(port, process):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'Server exited with code {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server did not start listening on port {port}')
+
+@contextmanager
+def serve(model, port, workers):
+    """Run the app under gunicorn with a worker model; yields its base URL"""
+    command = [
+        sys.executable, '-m', 'gunicorn', *WORKER_MODELS[model],
+        '--bind', f'127.0.0.1:{port}', '--workers', str(workers), '--log-level', 'warning',
+    ]
+    # The server inherits the environment, so FIRESTORE_EMULATOR_HOST points it at the emulator
+    process = subprocess.Popen(command, env=os.environ.copy())
+    try:
+        wait_for_port(port, process)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+def format_report(label, summary):
+    """Plain-text table of a summary"""
+    rows = [f'{label}', f"{'endpoint':<28}{'reqs':>7}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'errors':>8}"]
+    for endpoint, row in summary.items():
+        rows.append(
+            f"{endpoint:<28}{row['requests']:>7}{row['throughput']:>8.1f}"
+            f"{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}{row['p99_ms']:>9.0f}{row['max_ms']:>9.0f}"
+            f"{row['error_rate']:>8.1%}"
+        )
+    return '\n'.join(rows)
@@ -0,0 +1,205 @@
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import render_to_string
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import smtplib
+import threading
+import time
+from .pdf_generator import generate_payroll_pdf, format_month_year
+from .entities import bind_entity
+from .repository import (
+    get_payroll_run, get_lines_with_deductions, get_ytd_for_lines,
+    update_lines_email_status, mark_lines_email_queued,
+)
+
+logger = logging.getLogger(__name__)
+
+PASSWORD_LABELS = {
+    'passport': 'NRIC/Passport number',
+    'employee_id': 'Employee ID',
+}
+
+class RateLimiter:
+    """Spaces out calls so no more than `rate` happen per second across threads"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+class StatusRecorder:
+    """Collects email outcomes from the sender threads and writes them a chunk at a time"""
+
+    def __init__(self, run_id, chunk_size):
+        self.run_id = run_id
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def record(self, line_id, status, error, attempts):
+        with self.lock:
+            self.pending[line_id] = (status, error, attempts)
+            if len(self.pending) < self.chunk_size:
+                return
+            outcomes, self.pending = self.pending, {}
+        self.write(outcomes)
+
+    def flush(self):
+        with self.lock:
+            outcomes, self.pending = self.pending, {}
+        if outcomes:
+            self.write(outcomes)
+
+    def write(self, outcomes):
+        # The emails have already gone out, so a failed write must not stop the dispatch
+        try:
+            update_lines_email_status(self.run_id, outcomes)
+        except Exception:
+            logger.exception('Could not record payslip email status for %d lines of run %s', len(outcomes), self.run_id)
+
+class ConnectionPool:
+    """One reusable SMTP connection per worker thread"""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def reset(self):
+        """Drop this thread's connection after an error so the next attempt reconnects"""
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+            self.local.connection = None
+
+    def close_all(self):
+        for connection in self.connections:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+def build_payslip_email(run, line, password_protected):
+    """Build the email message for one payslip, with the PDF attached"""
+    month_name = format_month_year(run['month'])
+    password = line.get(settings.PAYSLIP_PASSWORD_FIELD) if password_protected else None
+    if password_protected and not password:
+        raise ValueError(f'No {settings.PAYSLIP_PASSWORD_FIELD} to protect the payslip with')
+
+    body = render_to_string('payroll/email/payslip.txt', {
+        'line': line,
+        'month_name': month_name,
+        'password_protected': password_protected,
+        'password_label': PASSWORD_LABELS.get(settings.PAYSLIP_PASSWORD_FIELD, settings.PAYSLIP_PASSWORD_FIELD),
+    })
+
+    message = EmailMessage(
+        subject=f'Payslip for {month_name} - Confidential',
+        body=body,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[line['email']],
+    )
+
+    pdf_buffer = generate_payroll_pdf(run, [line], password=password, profile=settings.PAYSLIP_EMAIL_PDF_PROFILE)
+    employee_name = (line.get('name') or 'employee').replace(' ', '_')
+    message.attach(f"{employee_name}_payslip_{run['month']}.pdf", pdf_buffer.getvalue(), 'application/pdf')
+    return message
+
+def send_payslip(run, line, password_protected, pool, limiter):
+    """Send one payslip with retries; returns the outcome as (status, error, attempts)"""
+    if not line.get('email'):
+        return 'failed', 'No email address', 0
+
+    try:
+        message = build_payslip_email(run, line, password_protected)
+    except Exception as exc:
+        return 'failed', str(exc), 0
+
+    attempts = 0
+    while True:
+        attempts += 1
+        limiter.wait()
+        try:
+            message.connection = pool.get()
+            message.send()
+            return 'sent', None, attempts
+        except (smtplib.SMTPException, OSError) as exc:
+            pool.reset()
+            if attempts >= settings.PAYSLIP_EMAIL_RETRIES:
+                logger.warning('Payslip email to %s failed: %s', line['email'], exc)
+                return 'failed', str(exc), attempts
+            # Back off before retrying: 1s, 2s, 4s...
+            time.sleep(2 ** (attempts - 1))
+
+def deliver_payslip(run, line, password_protected, pool, limiter, recorder):
+    """Send one payslip and queue its outcome for recording; never raises, so one line can't stop a dispatch"""
+    try:
+        status, error, attempts = send_payslip(run, line, password_protected, pool, limiter)
+    except Exception:
+        logger.exception('Payslip email for line %s of run %s failed', line['id'], run['id'])
+        status, error, attempts = 'failed', 'Unexpected error while sending', 0
+
+    recorder.record(line['id'], status, error, attempts)
+    return status == 'sent'
+
+def dispatch_payslips(run_id, line_ids=None, password_protected=False, resend=False):
+    """Email payslips for a run through a pool of SMTP connections"""
+    run = get_payroll_run(run_id)
+    lines = get_lines_with_deductions(run_id, line_ids)
+
+    # Already delivered payslips are skipped unless explicitly resent
+    if not resend:
+        lines = [line for line in lines if line.get('email_status') != 'sent']
+    if not lines:
+        return {'sent': 0, 'failed': 0}
+
+    ytd = get_ytd_for_lines(lines, run['month'])
+    for line in lines:
+        line['ytd'] = ytd.get(line.get('employee_ref'))
+
+    mark_lines_email_queued(run_id, [line['id'] for line in lines])
+
+    pool = ConnectionPool()
+    limiter = RateLimiter(settings.PAYSLIP_EMAIL_RATE)
+    # Outcomes share one run version per chunk rather than a transaction on the run per email
+    recorder = StatusRecorder(run_id, settings.PAYSLIP_EMAIL_STATUS_CHUNK)
+    try:
+        with ThreadPoolExecutor(max_workers=settings.PAYSLIP_EMAIL_CONNECTIONS) as executor:
+            results = list(executor.map(
+                bind_entity(lambda line: deliver_payslip(run, line, password_protected, pool, limiter, recorder)), lines
+            ))
+    finally:
+        pool.close_all()
+        recorder.flush()
+
+    sent = sum(results)
+    return {'sent': sent, 'failed': len(results) - sent}
+
+def dispatch_payslips_in_background(run_id, line_ids=None, password_protected=False, resend=False):
+    """Start a payslip dispatch without blocking the request"""
+    threading.Thread(
+        target=bind_entity(dispatch_payslips),
+        args=(run_id, line_ids, password_protected, resend),
+        daemon=True
+    ).start()
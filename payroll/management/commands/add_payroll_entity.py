@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from payroll.entities import save_entity
+
+class Command(BaseCommand):
+    help = 'Add a legal entity, or update its payslip branding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('entity_id')
+        parser.add_argument('--name', required=True)
+        parser.add_argument('--address', default='', help='Address; separate lines with "\\n"')
+        parser.add_argument('--registration', default='')
+        parser.add_argument('--logo', help='Path to a PNG logo')
+
+    def handle(self, *args, **options):
+        logo = None
+        if options['logo']:
+            try:
+                with open(options['logo'], 'rb') as f:
+                    logo = f.read()
+            except OSError as e:
+                raise CommandError(f'Cannot read logo: {e}')
+
+        save_entity(
+            options['entity_id'],
+            options['name'],
+            address=options['address'].replace('\\n', '\n'),
+            registration=options['registration'],
+            logo=logo
+        )
+        self.stdout.write(self.style.SUCCESS(f"Saved entity {options['entity_id']}"))
@@ -0,0 +1,37 @@
+from datetime import date
+from django.core.management.base import BaseCommand
+from payroll.repository import get_archivable_payroll_runs, archive_payroll_run
+from payroll.entities import use_entity
+
+class Command(BaseCommand):
+    help = 'Pack finalized payroll runs older than the kept months into compressed archive snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep-months', type=int, default=24,
+                            help='Months of finalized runs to keep live (default 24)')
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--entity', help='Entity to work on (default: the default entity)')
+
+    def handle(self, *args, **options):
+        with use_entity(options['entity']):
+            self.archive(options)
+
+    def archive(self, options):
+        today = date.today()
+        months_back = today.year * 12 + today.month - 1 - options['keep_months']
+        before_month = f'{months_back // 12:04d}-{months_back % 12 + 1:02d}'
+
+        run_ids = get_archivable_payroll_runs(before_month)
+        if options['dry_run']:
+            self.stdout.write(f'{len(run_ids)} finalized runs before {before_month}')
+            return
+
+        for run_id in run_ids:
+            try:
+                deleted = archive_payroll_run(run_id)
+            except ValueError as e:
+                self.stdout.write(self.style.WARNING(f'Skipped {run_id}: {e}'))
+                continue
+            self.stdout.write(f'Archived {run_id} ({deleted} documents removed)')
+
+        self.stdout.write(self.style.SUCCESS(f'Archived runs before {before_month}'))
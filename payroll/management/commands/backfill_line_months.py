@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from payroll.repository import backfill_line_months
+from payroll.entities import use_entity
+
+class Command(BaseCommand):
+    help = 'Copy run months and the entity onto older payroll lines so they appear in pay history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entity', help='Entity to work on (default: the default entity)')
+
+    def handle(self, *args, **options):
+        with use_entity(options['entity']):
+            count = backfill_line_months()
+        self.stdout.write(self.style.SUCCESS(f'Updated {count} payroll lines'))
@@ -0,0 +1,19 @@
+from datetime import datetime
+from django.core.management.base import BaseCommand
+from payroll.backup import export_dataset
+
+class Command(BaseCommand):
+    help = 'Export employees, payroll runs and related collections to compressed, checksummed chunk files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', nargs='?',
+                            help='Backup directory (default backups/<timestamp>)')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Collections or partitions streamed at once (default 8)')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or f"backups/{datetime.now():%Y%m%d-%H%M%S}"
+        manifest = export_dataset(directory, workers=options['workers'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Backed up {manifest['records']} documents in {len(manifest['chunks'])} chunks to {directory}"
+        ))
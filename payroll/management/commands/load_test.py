@@ -0,0 +1,51 @@
+import json
+import os
+from django.core.management.base import BaseCommand, CommandError
+from payroll.loadtest import WORKER_MODELS, run_load, serve, format_report
+
+class Command(BaseCommand):
+    help = ('Drive concurrent payroll officer sessions against the app and report throughput, '
+            'tail latency and error rates per endpoint and worker model. Point the servers at the '
+            'Firestore emulator with FIRESTORE_EMULATOR_HOST; save_deductions writes to the run.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('run_id', help='Payroll run the sessions work on')
+        parser.add_argument('--url', help='Test an already running server instead of starting one per worker model')
+        parser.add_argument('--models', default='sync,gthread,asgi',
+                            help=f"Worker models to start under gunicorn ({', '.join(WORKER_MODELS)})")
+        parser.add_argument('--workers', type=int, default=1, help='gunicorn workers per server (default 1)')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--users', type=int, default=10, help='Concurrent sessions (default 10)')
+        parser.add_argument('--duration', type=int, default=30, help='Seconds per worker model (default 30)')
+        parser.add_argument('--seed', type=int, help='Random seed for repeatable scenarios')
+        parser.add_argument('--entity', help='Entity the sessions select')
+        parser.add_argument('--username', default=os.environ.get('LOADTEST_USERNAME'))
+        parser.add_argument('--password', default=os.environ.get('LOADTEST_PASSWORD'))
+        parser.add_argument('--json', help='Also write the results to this file, for comparing runs')
+
+    def handle(self, *args, **options):
+        if not options['username'] or not options['password']:
+            raise CommandError('Pass --username/--password or set LOADTEST_USERNAME/LOADTEST_PASSWORD')
+
+        load = {
+            key: options[key] for key in ('username', 'password', 'run_id', 'users', 'duration', 'seed', 'entity')
+        }
+        results = {}
+        try:
+            if options['url']:
+                results['external'] = run_load(options['url'], **load)
+                self.stdout.write(format_report(options['url'], results['external']))
+            else:
+                for model in options['models'].split(','):
+                    if model not in WORKER_MODELS:
+                        raise CommandError(f'Unknown worker model: {model}')
+                    with serve(model, options['port'], options['workers']) as url:
+                        results[model] = run_load(url, **load)
+                    self.stdout.write(format_report(f"{model} ({options['workers']} workers, {options['users']} users)", results[model]))
+                    self.stdout.write('')
+        except (ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
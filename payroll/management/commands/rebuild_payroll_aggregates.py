@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from payroll.repository import rebuild_payroll_aggregates
+from payroll.entities import use_entity
+
+class Command(BaseCommand):
+    help = 'Recompute the dashboard aggregates for every payroll run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entity', help='Entity to work on (default: the default entity)')
+
+    def handle(self, *args, **options):
+        with use_entity(options['entity']):
+            count = rebuild_payroll_aggregates()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt aggregates for {count} payroll runs'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from payroll.repository import rebuild_ytd_rollups
+from payroll.entities import use_entity
+
+class Command(BaseCommand):
+    help = 'Recompute per-employee year-to-date rollups from payroll runs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('year', type=int)
+        parser.add_argument('--entity', help='Entity to work on (default: the default entity)')
+
+    def handle(self, *args, **options):
+        with use_entity(options['entity']):
+            count = rebuild_ytd_rollups(options['year'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} YTD rollups for {options["year"]}'))
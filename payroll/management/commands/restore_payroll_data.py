@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from payroll.backup import verify_backup, restore_dataset
+
+class Command(BaseCommand):
+    help = ('Verify a backup made by backup_payroll_data and write it back to Firestore '
+            '(set FIRESTORE_EMULATOR_HOST to restore into the emulator)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Chunk files written at once (default 8)')
+        parser.add_argument('--verify-only', action='store_true',
+                            help='Only check chunk checksums, without writing anything')
+
+    def handle(self, *args, **options):
+        if options['verify_only']:
+            problems = verify_backup(options['directory'])
+            for problem in problems:
+                self.stdout.write(self.style.ERROR(problem))
+            if problems:
+                raise CommandError(f'{len(problems)} chunks failed verification')
+            self.stdout.write(self.style.SUCCESS('Backup verified'))
+            return
+
+        try:
+            count = restore_dataset(options['directory'], workers=options['workers'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Restored {count} documents'))
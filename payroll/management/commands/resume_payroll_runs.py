@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from payroll.repository import get_unfinished_payroll_runs, build_payroll_run, run_is_being_built
+from payroll.entities import get_entities, use_entity
+
+class Command(BaseCommand):
+    help = 'Finish building payroll runs that were interrupted part-way'
+
+    def handle(self, *args, **kwargs):
+        resumed = 0
+        for entity_id in get_entities():
+            with use_entity(entity_id):
+                runs = get_unfinished_payroll_runs()
+                
+                for run_id, run in runs.items():
+                    # A fresh heartbeat means a worker is still building it
+                    if run_is_being_built(run):
+                        self.stdout.write(f'Skipped payroll run still being built: {entity_id}/{run_id}')
+                        continue
+                    build_payroll_run(run_id)
+                    self.stdout.write(self.style.SUCCESS(f'Resumed payroll run: {entity_id}/{run_id}'))
+                    resumed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'\nResumed {resumed} payroll runs'))
@@ -1,10 +1,14 @@
 from django.core.management.base import BaseCommand
-from payroll_mvp.firebase import db
+from payroll.repository import collection
+from payroll.entities import use_entity
 
 class Command(BaseCommand):
     help = 'Seed test employees into Firestore'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--entity', help='Entity to work on (default: the default entity)')
+
+    def handle(self, *args, **options):
         employees = [
             {
                 'name': 'John Tan',
@@ -14,6 +18,7 @@ class Command(BaseCommand):
                 'passport': 'A12345678',
                 'epf_no': 'EPF123456',
                 'socso_no': 'SOCSO123456',
+                'tax_no': 'SG10234560',
                 'gender': 'Male',
                 'base_salary': 5500,
                 # Statutory deductions
@@ -32,6 +37,7 @@ class Command(BaseCommand):
                 'passport': 'B98765432',
                 'epf_no': 'EPF789012',
                 'socso_no': 'SOCSO789012',
+                'tax_no': 'SG10789010',
                 'gender': 'Female',
                 'base_salary': 7200,
                 'epf_deduction': 792.00,
@@ -49,6 +55,7 @@ class Command(BaseCommand):
                 'passport': 'C11223344',
                 'epf_no': 'EPF345678',
                 'socso_no': 'SOCSO345678',
+                'tax_no': 'SG10345670',
                 'gender': 'Male',
                 'base_salary': 4800,
                 'epf_deduction': 528.00,
@@ -66,6 +73,7 @@ class Command(BaseCommand):
                 'passport': 'D55667788',
                 'epf_no': 'EPF901234',
                 'socso_no': 'SOCSO901234',
+                'tax_no': 'SG10901230',
                 'gender': 'Female',
                 'base_salary': 6000,
                 'epf_deduction': 660.00,
@@ -77,14 +85,15 @@ class Command(BaseCommand):
             }
         ]
 
-        # Delete existing employees first
-        existing = db.collection('employees').stream()
-        for doc in existing:
-            doc.reference.delete()
-        
-        # Add new employees
-        for emp in employees:
-            db.collection('employees').add(emp)
-            self.stdout.write(self.style.SUCCESS(f'Added employee: {emp["name"]}'))
+        with use_entity(options['entity']):
+            # Delete existing employees first
+            existing = collection('employees').stream()
+            for doc in existing:
+                doc.reference.delete()
+            
+            # Add new employees
+            for emp in employees:
+                collection('employees').add(emp)
+                self.stdout.write(self.style.SUCCESS(f'Added employee: {emp["name"]}'))
 
         self.stdout.write(self.style.SUCCESS('\nSuccessfully seeded 4 employees with statutory deductions!'))
\ No newline at end of file
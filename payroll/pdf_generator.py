@@ -7,12 +7,68 @@ from reportlab.lib.enums import TA_LEFT, TA_RIGHT
 from io import BytesIO
 from datetime import datetime
 from reportlab.platypus import Image
+from reportlab.lib.pdfencrypt import StandardEncryption
+from PIL import Image as PILImage
 import os
+import threading
 from django.conf import settings
+from .entities import get_branding
 
-COMPANY_NAME = "Leogics Solutions (M) Sdn. Bhd."
-COMPANY_ADDRESS = "06-01 & 06M-01, Level 6 & 6M, Menara EcoWorld, Bukit Bintang City Centre, 2, Jln Hang Tuah, Pudu<br/>55100, Wilayah Persekutuan Kuala Lumpur"
-COMPANY_REGISTRATION = "Business registration number: 202501000353 (1601768-D)"
+# Logo of the default entity; other entities carry theirs on the entity document
+LOGO_PATH = os.path.join(settings.BASE_DIR, 'payroll', 'static', 'payroll', 'leogics-logo.png')
+LOGO_SIZE = 2*cm
+
+# Output profiles: logo resolution at its printed size (None keeps the original file).
+# Page content streams are always compressed
+PDF_PROFILES = {
+    'print': {'logo_dpi': None},
+    'standard': {'logo_dpi': 300},
+    'compact': {'logo_dpi': 150},
+}
+
+_headers = {}
+_headers_lock = threading.Lock()
+
+def get_payslip_header(profile):
+    """Company header markup and logo PNG (or None) of the current entity, prepared once per entity and profile"""
+    branding = get_branding()
+    key = (branding['id'], profile)
+    with _headers_lock:
+        cached = _headers.get(key)
+        # Rebuilt only when the entity's branding has been reloaded
+        if cached is None or cached[0] is not branding:
+            header = {
+                'company_markup': (
+                    f"<b>{branding['name']}</b><br/>{'<br/>'.join(branding['address_lines'])}"
+                    f"<br/><font size=8>{branding['registration']}</font>"
+                ),
+                'logo_data': prepare_logo(read_logo(branding), PDF_PROFILES[profile]['logo_dpi']),
+            }
+            cached = _headers[key] = (branding, header)
+        return cached[1]
+
+def read_logo(branding):
+    """Original logo bytes of an entity, or None"""
+    if branding['logo'] is not None:
+        return branding['logo']
+    if branding['id'] != settings.PAYROLL_DEFAULT_ENTITY or not os.path.exists(LOGO_PATH):
+        return None
+    with open(LOGO_PATH, 'rb') as f:
+        return f.read()
+
+def prepare_logo(data, dpi):
+    """Resize a logo so it carries no more pixels than it can show at LOGO_SIZE"""
+    if data is None or dpi is None:
+        return data
+    
+    pixels = round(LOGO_SIZE / 72 * dpi)
+    with PILImage.open(BytesIO(data)) as image:
+        if max(image.size) <= pixels:
+            return data
+        image.thumbnail((pixels, pixels), PILImage.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, 'PNG', optimize=True)
+    return buffer.getvalue()
 
 def format_month_year(month_str):
     """Convert '2025-12' to 'December 2025'"""
@@ -22,8 +78,10 @@ def format_month_year(month_str):
     except:
         return month_str
 
-def generate_payroll_pdf(run, lines):
+def generate_payroll_pdf(run, lines, password=None, profile=None):
     """Generate a PDF matching the PayrollPanda layout"""
+    header = get_payslip_header(profile or settings.PAYSLIP_PDF_PROFILE)
+    
     buffer = BytesIO()
     doc = SimpleDocTemplate(
         buffer, 
@@ -31,7 +89,10 @@ def generate_payroll_pdf(run, lines):
         topMargin=1.5*cm, 
         bottomMargin=1.5*cm,
         leftMargin=1.5*cm,
-        rightMargin=1.5*cm
+        rightMargin=1.5*cm,
+        pageCompression=1,
+        # Password-protected payslips need the password to open
+        encrypt=StandardEncryption(password, canModify=0) if password else None
     )
     
     elements = []
@@ -42,42 +103,109 @@ def generate_payroll_pdf(run, lines):
         if idx > 0:
             elements.append(PageBreak())
         
-        elements.extend(create_payslip_page(run, line, styles))
+        elements.extend(create_payslip_page(run, line, styles, header))
     
     doc.build(elements)
     buffer.seek(0)
     return buffer
 
-def create_payslip_page(run, line, styles):
+# Footnotes printed under every payslip
+PAYSLIP_FOOTNOTES = [
+    "EPF contributions are calculated based on 11.00% employee rate and 13.00% employer rate",
+    "PCB Calculations are based on the following employee info:",
+    "Resident, Normal Worker, Single, No Dependent Children",
+]
+
+def build_payslip_layout(run, line):
+    """Payslip content as plain data, shared by the PDF and the HTML preview"""
+    adhoc_deductions = line.get('adhoc_deductions', [])
+    ytd = line.get('ytd')
+    
+    branding = get_branding()
+    
+    return {
+        'company': {
+            'name': branding['name'],
+            'address_lines': branding['address_lines'],
+            'registration': branding['registration'],
+        },
+        'title': f"Payslip for {format_month_year(run['month'])}",
+        'issued_date': run['issued_date'],
+        'employee_name': line['name'],
+        'employee_role': line.get('role', 'N/A'),
+        # Two rows of four label/value cells
+        'details': [
+            [
+                ('Department', line.get('department', 'N/A')),
+                ('Nationality', line.get('nationality', 'N/A')),
+                ('NRIC/Passport', line.get('passport', 'N/A')),
+                ('EPF No.', line.get('epf_no', 'N/A')),
+            ],
+            [
+                ('Employee ID', line.get('employee_id', 'N/A')),
+                ('Gender', line.get('gender', 'N/A')),
+                None,
+                ('SOCSO No.', line.get('socso_no', 'N/A')),
+            ],
+        ],
+        # (label, units, rate, amount); lines snapshotted before earnings were itemised show one salary row
+        'earnings': [
+            (row['label'], row.get('units'), row.get('rate'), row['amount'])
+            for row in line.get('earnings') or [{'label': 'Salary', 'amount': line.get('salary', 0)}]
+        ],
+        'gross_pay': line.get('salary', 0),
+        'contribution_headers': ['EPF', 'SOCSO', 'EIS', 'Zakat', 'PCB', 'HRDF'],
+        'employee_contributions': [
+            line.get('epf_deduction', 0),
+            line.get('socso_deduction', 0),
+            line.get('eis_deduction', 0),
+            line.get('zakat_deduction', 0),
+            line.get('pcb_deduction', 0),
+            line.get('hrdf_deduction', 0),
+        ],
+        'employee_contributions_total': line.get('statutory_deductions_total', 0),
+        'employer_contributions': [
+            line.get('employer_epf', 0),
+            line.get('employer_socso', 0),
+            line.get('employer_eis', 0),
+            0,
+            0,
+            0,
+        ],
+        'adhoc_deductions': [(ded['name'], ded['amount']) for ded in adhoc_deductions],
+        'net_pay': line.get('net_pay', 0),
+        'taxable_pay': line.get('salary', 0),
+        'ytd': [
+            ('Gross pay', ytd.get('salary', 0)),
+            ('EPF', ytd.get('epf_deduction', 0)),
+            ('SOCSO', ytd.get('socso_deduction', 0)),
+            ('EIS', ytd.get('eis_deduction', 0)),
+            ('PCB', ytd.get('pcb_deduction', 0)),
+            ('Deductions', ytd.get('total_deductions', 0)),
+            ('Net pay', ytd.get('net_pay', 0)),
+        ] if ytd else None,
+        'footnotes': PAYSLIP_FOOTNOTES,
+    }
+
+def create_payslip_page(run, line, styles, header):
     """Create a single payslip page"""
     page_elements = []
+    layout = build_payslip_layout(run, line)
+    logo_data = header['logo_data']
     
-    # Format month
-    formatted_month = format_month_year(run['month'])
+    company_header = Paragraph(
+        header['company_markup'], 
+        ParagraphStyle('CompanyHeader', parent=styles['Normal'], fontSize=9, leading=12))
+    payslip_header = Paragraph(
+        f"<b>{layout['title']}</b><br/><font size=8>Issued on: {layout['issued_date']}</font>", 
+        ParagraphStyle('PayslipHeader', parent=styles['Normal'], fontSize=10, alignment=TA_RIGHT, leading=14))
     
     # Header section with logo
-    # Try multiple possible paths
-    logo_path = os.path.join(settings.BASE_DIR, 'payroll', 'static', 'payroll', 'leogics-logo.png')
-
-    # Debug: print the path (temporary - remove after testing)
-    print(f"Looking for logo at: {logo_path}")
-    print(f"Logo exists: {os.path.exists(logo_path)}")
-
-    # Check if logo exists
-    if os.path.exists(logo_path):
-        logo = Image(logo_path, width=2*cm, height=2*cm)  # Adjust size as needed
-
-        header_data = [
-            [
-                logo,
-                Paragraph(f"<b>{COMPANY_NAME}</b><br/>{COMPANY_ADDRESS}<br/><font size=8>{COMPANY_REGISTRATION}</font>", 
-                        ParagraphStyle('CompanyHeader', parent=styles['Normal'], fontSize=9, leading=12)),
-                Paragraph(f"<b>Payslip for {formatted_month}</b><br/><font size=8>Issued on: {run['issued_date']}</font>", 
-                        ParagraphStyle('PayslipHeader', parent=styles['Normal'], fontSize=10, alignment=TA_RIGHT, leading=14))
-            ]
-        ]
+    if logo_data:
+        # Every page draws the same image data, so the PDF holds a single shared image XObject
+        logo = Image(BytesIO(logo_data), width=LOGO_SIZE, height=LOGO_SIZE)
 
-        header_table = Table(header_data, colWidths=[2.5*cm, 9*cm, 6.5*cm])
+        header_table = Table([[logo, company_header, payslip_header]], colWidths=[2.5*cm, 9*cm, 6.5*cm])
         header_table.setStyle(TableStyle([
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
             ('TOPPADDING', (0, 0), (-1, -1), 0),
@@ -86,18 +214,8 @@ def create_payslip_page(run, line, styles):
             ('RIGHTPADDING', (0, 0), (0, 0), 8),
         ]))
     else:
-        print("Logo not found, using fallback")
         # Fallback if logo not found
-        header_data = [
-            [
-                Paragraph(f"<b>{COMPANY_NAME}</b><br/>{COMPANY_ADDRESS}<br/><font size=8>{COMPANY_REGISTRATION}</font>", 
-                        ParagraphStyle('CompanyHeader', parent=styles['Normal'], fontSize=9, leading=12)),
-                Paragraph(f"<b>Payslip for {formatted_month}</b><br/><font size=8>Issued on: {run['issued_date']}</font>", 
-                        ParagraphStyle('PayslipHeader', parent=styles['Normal'], fontSize=10, alignment=TA_RIGHT, leading=14))
-            ]
-        ]
-        
-        header_table = Table(header_data, colWidths=[11*cm, 7*cm])
+        header_table = Table([[company_header, payslip_header]], colWidths=[11*cm, 7*cm])
         header_table.setStyle(TableStyle([
             ('VALIGN', (0, 0), (-1, -1), 'TOP'),
             ('TOPPADDING', (0, 0), (-1, -1), 0),
@@ -117,38 +235,22 @@ def create_payslip_page(run, line, styles):
     page_elements.append(Spacer(1, 0.3*cm))
     
     # Employee name and title with more spacing
-    page_elements.append(Paragraph(f"<b><font size=14>{line['name']}</font></b>", styles['Normal']))
+    page_elements.append(Paragraph(f"<b><font size=14>{layout['employee_name']}</font></b>", styles['Normal']))
     page_elements.append(Spacer(1, 0.15*cm))  # Added spacing
-    page_elements.append(Paragraph(f"<font size=10>{line.get('role', 'N/A')}</font>", styles['Normal']))
+    page_elements.append(Paragraph(f"<font size=10>{layout['employee_role']}</font>", styles['Normal']))
     page_elements.append(Spacer(1, 0.3*cm))
     
-    # Employee details
-    employee_details = [
-        [
-            Paragraph("<font size=8 color='#666666'>Department</font>", styles['Normal']),
-            Paragraph("<font size=8 color='#666666'>Nationality</font>", styles['Normal']),
-            Paragraph("<font size=8 color='#666666'>NRIC/Passport</font>", styles['Normal']),
-            Paragraph("<font size=8 color='#666666'>EPF No.</font>", styles['Normal'])
-        ],
-        [
-            Paragraph(f"<font size=9>{line.get('department', 'N/A')}</font>", styles['Normal']),
-            Paragraph(f"<font size=9>{line.get('nationality', 'N/A')}</font>", styles['Normal']),
-            Paragraph(f"<font size=9>{line.get('passport', 'N/A')}</font>", styles['Normal']),
-            Paragraph(f"<font size=9>{line.get('epf_no', 'N/A')}</font>", styles['Normal'])
-        ],
-        [
-            Paragraph("<font size=8 color='#666666'>Employee ID</font>", styles['Normal']),
-            Paragraph("<font size=8 color='#666666'>Gender</font>", styles['Normal']),
-            '',
-            Paragraph("<font size=8 color='#666666'>SOCSO No.</font>", styles['Normal'])
-        ],
-        [
-            Paragraph(f"<font size=9>{line.get('employee_id', 'N/A')}</font>", styles['Normal']),
-            Paragraph(f"<font size=9>{line.get('gender', 'N/A')}</font>", styles['Normal']),
-            '',
-            Paragraph(f"<font size=9>{line.get('socso_no', 'N/A')}</font>", styles['Normal'])
-        ]
-    ]
+    # Employee details: a label row above each value row
+    employee_details = []
+    for detail_row in layout['details']:
+        employee_details.append([
+            Paragraph(f"<font size=8 color='#666666'>{cell[0]}</font>", styles['Normal']) if cell else ''
+            for cell in detail_row
+        ])
+        employee_details.append([
+            Paragraph(f"<font size=9>{cell[1]}</font>", styles['Normal']) if cell else ''
+            for cell in detail_row
+        ])
     
     employee_table = Table(employee_details, colWidths=[4.5*cm, 4.5*cm, 4.5*cm, 4.5*cm])
     employee_table.setStyle(TableStyle([
@@ -169,27 +271,31 @@ def create_payslip_page(run, line, styles):
     
     gross_data = [
         [
+            '',
             Paragraph("<font size=8 color='#666666'>Units</font>", ParagraphStyle('HeaderCenter', alignment=TA_RIGHT, fontSize=8)),
             Paragraph("<font size=8 color='#666666'>Rate</font>", ParagraphStyle('HeaderCenter', alignment=TA_RIGHT, fontSize=8)),
             Paragraph("<font size=8 color='#666666'>Amount</font>", ParagraphStyle('HeaderRight', alignment=TA_RIGHT, fontSize=8))
         ],
-        ['', '', ''],
-        ['Salary', '', f"{line.get('salary', 0):.2f}"],
-        ['', '', ''],
-        ['', Paragraph("<b>Gross pay</b>", ParagraphStyle('GrossPay', alignment=TA_RIGHT, fontSize=9)), 
-         Paragraph(f"<b>{line.get('salary', 0):.2f}</b>", ParagraphStyle('GrossPayAmount', alignment=TA_RIGHT, fontSize=9))]
+        ['', '', '', ''],
+        *[
+            [label, '' if units is None else f"{units:g}", '' if rate is None else f"{rate:.2f}", f"{amount:.2f}"]
+            for label, units, rate, amount in layout['earnings']
+        ],
+        ['', '', '', ''],
+        ['', '', Paragraph("<b>Gross pay</b>", ParagraphStyle('GrossPay', alignment=TA_RIGHT, fontSize=9)), 
+         Paragraph(f"<b>{layout['gross_pay']:.2f}</b>", ParagraphStyle('GrossPayAmount', alignment=TA_RIGHT, fontSize=9))]
     ]
     
-    gross_table = Table(gross_data, colWidths=[11*cm, 3.5*cm, 3.5*cm])
+    gross_table = Table(gross_data, colWidths=[7.5*cm, 3.5*cm, 3.5*cm, 3.5*cm])
     gross_table.setStyle(TableStyle([
         ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
         ('ALIGN', (0, 0), (0, -1), 'LEFT'),
         ('FONTSIZE', (0, 0), (-1, -1), 9),
         ('TOPPADDING', (0, 0), (-1, -1), 3),
         ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
-        ('BACKGROUND', (2, -1), (2, -1), colors.HexColor('#f5f5f5')),
-        ('LEFTPADDING', (2, -1), (2, -1), 10),  # Added left padding for margin
-        ('RIGHTPADDING', (2, -1), (2, -1), 10),  # Added right padding for margin
+        ('BACKGROUND', (3, -1), (3, -1), colors.HexColor('#f5f5f5')),
+        ('LEFTPADDING', (3, -1), (3, -1), 10),  # Added left padding for margin
+        ('RIGHTPADDING', (3, -1), (3, -1), 10),  # Added right padding for margin
     ]))
     page_elements.append(gross_table)
     
@@ -199,35 +305,17 @@ def create_payslip_page(run, line, styles):
     page_elements.append(Paragraph("<b>Contributions</b>", styles['Normal']))
     page_elements.append(Spacer(1, 0.2*cm))
     
-    # Get employer contributions from stored values
-    employer_epf = line.get('employer_epf', 0)
-    employer_socso = line.get('employer_socso', 0)
-    employer_eis = line.get('employer_eis', 0)
-    employer_zakat = line.get('employer_zakat', 0)
-    employer_pcb = line.get('employer_pcb', 0)
-    employer_hrdf = line.get('employer_hrdf', 0)
-    
     # Build contributions table as proper aligned table
     contributions_data = [
-        ['', 'EPF', 'SOCSO', 'EIS', 'Zakat', 'PCB', 'HRDF', 'Amount'],
+        ['', *layout['contribution_headers'], 'Amount'],
         [
             'Employee',
-            f"{line.get('epf_deduction', 0):.2f}",
-            f"{line.get('socso_deduction', 0):.2f}",
-            f"{line.get('eis_deduction', 0):.2f}",
-            f"{line.get('zakat_deduction', 0):.2f}",
-            f"{line.get('pcb_deduction', 0):.2f}",
-            f"{line.get('hrdf_deduction', 0):.2f}",
-            f"-{line.get('statutory_deductions_total', 0):.2f}"
+            *[f"{amount:.2f}" for amount in layout['employee_contributions']],
+            f"-{layout['employee_contributions_total']:.2f}"
         ],
         [
             'Employer',
-            f"{employer_epf:.2f}",
-            f"{employer_socso:.2f}",
-            f"{employer_eis:.2f}",
-            '0.00',
-            '0.00',
-            '0.00',
+            *[f"{amount:.2f}" for amount in layout['employer_contributions']],
             ''
         ]
     ]
@@ -257,18 +345,17 @@ def create_payslip_page(run, line, styles):
     page_elements.append(contrib_table)
     
     # Ad-hoc deductions if any
-    adhoc_deductions = line.get('adhoc_deductions', [])
-    if adhoc_deductions:
+    if layout['adhoc_deductions']:
         page_elements.append(Spacer(1, 0.5*cm))
         page_elements.append(Paragraph("<b>Deductions</b>", styles['Normal']))
         page_elements.append(Spacer(1, 0.2*cm))
         
         adhoc_data = [['', '', 'Amount']]  # Header
-        for ded in adhoc_deductions:
+        for name, amount in layout['adhoc_deductions']:
             adhoc_data.append([
-                ded['name'],
+                name,
                 '',
-                f"-{ded['amount']:.2f}"
+                f"-{amount:.2f}"
             ])
         
         adhoc_table = Table(adhoc_data, colWidths=[11*cm, 4*cm, 3*cm])
@@ -303,10 +390,10 @@ def create_payslip_page(run, line, styles):
         ['', '', ''],
         ['', '', ''],
         ['', Paragraph("<b>Net pay</b>", ParagraphStyle('NetPay', alignment=TA_RIGHT, fontSize=9)), 
-         Paragraph(f"<b>{line.get('net_pay', 0):.2f}</b>", ParagraphStyle('NetPayAmount', alignment=TA_RIGHT, fontSize=9))],
+         Paragraph(f"<b>{layout['net_pay']:.2f}</b>", ParagraphStyle('NetPayAmount', alignment=TA_RIGHT, fontSize=9))],
         ['', '', ''],
         ['', Paragraph("<font size=8 color='#666666'>Taxable pay</font>", ParagraphStyle('TaxablePay', alignment=TA_RIGHT, fontSize=8)), 
-         Paragraph(f"<font size=8>{line.get('salary', 0):.2f}</font>", ParagraphStyle('TaxablePayAmount', alignment=TA_RIGHT, fontSize=8))]
+         Paragraph(f"<font size=8>{layout['taxable_pay']:.2f}</font>", ParagraphStyle('TaxablePayAmount', alignment=TA_RIGHT, fontSize=8))]
     ]
     
     net_table = Table(net_data, colWidths=[11*cm, 3.5*cm, 3.5*cm])
@@ -321,17 +408,38 @@ def create_payslip_page(run, line, styles):
         ('RIGHTPADDING', (2, 3), (2, 3), 10),  # Added right padding for margin
     ]))
     page_elements.append(net_table)
-    
+
+    # Year-to-date section (from the employee's YTD rollup)
+    if layout['ytd']:
+        page_elements.append(Spacer(1, 0.5*cm))
+        page_elements.append(Paragraph("<b>Year to Date</b>", styles['Normal']))
+        page_elements.append(Spacer(1, 0.2*cm))
+
+        ytd_data = [
+            [label for label, _ in layout['ytd']],
+            [f"{amount:.2f}" for _, amount in layout['ytd']]
+        ]
+
+        ytd_table = Table(ytd_data, colWidths=[3*cm, 2.4*cm, 2.4*cm, 2.4*cm, 2.4*cm, 2.7*cm, 2.7*cm])
+        ytd_table.setStyle(TableStyle([
+            ('FONTSIZE', (0, 0), (-1, 0), 7),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.HexColor('#666666')),
+            ('LINEBELOW', (0, 0), (-1, 0), 0.5, colors.HexColor('#dddddd')),
+            ('FONTSIZE', (0, 1), (-1, -1), 8),
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+            ('TOPPADDING', (0, 0), (-1, -1), 3),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 3),
+        ]))
+        page_elements.append(ytd_table)
+
     # Footer
     page_elements.append(Spacer(1, 1*cm))
-    footer_text = """
+    footer_text = f"""
     <font size=7 color='#666666'>
-    EPF contributions are calculated based on 11.00% employee rate and 13.00% employer rate<br/>
-    PCB Calculations are based on the following employee info:<br/>
-    Resident, Normal Worker, Single, No Dependent Children<br/>
+    {'<br/>'.join(layout['footnotes'])}<br/>
     <b>Generated from Leogics Payroll System</b>
     </font>
     """
     page_elements.append(Paragraph(footer_text, styles['Normal']))
     
-    return page_elements
\ No newline at end of file
+    return page_elements
@@ -0,0 +1,133 @@
+from payroll_mvp.firebase import db
+from .entities import scoped_collection
+from datetime import datetime
+import asyncio
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Line fields pushed to the detail screen for each change
+PUSHED_LINE_FIELDS = [
+    'name', 'employee_id', 'role', 'salary', 'total_deductions', 'net_pay',
+    'email_status', 'email_error', 'version',
+]
+
+class Subscriber:
+    """One open event stream and the run version it has seen up to"""
+
+    def __init__(self, since_version):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.since_version = since_version
+
+class RunChannel:
+    """One Firestore listener on a run's lines, fanned out to every subscriber in this process"""
+
+    def __init__(self, entity_id, run_id, since_version):
+        self.entity_id = entity_id
+        self.run_id = run_id
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.watch = None
+        self.listen(since_version)
+
+    def listen(self, since_version):
+        """(Re)start the listener on lines written after a version"""
+        # Only lines newer than the oldest subscriber's page are watched,
+        # so starting the listener doesn't re-read the whole run
+        if self.watch is not None:
+            self.watch.unsubscribe()
+        self.since_version = since_version
+        query = (
+            scoped_collection(db, 'payroll_runs', self.entity_id).document(self.run_id)
+            .collection('lines').where('version', '>', since_version)
+        )
+        self.watch = query.on_snapshot(self.on_snapshot)
+
+    def add(self, subscriber):
+        """Join a subscriber, replaying from its own version if that is older than the listener's"""
+        with self.lock:
+            self.subscribers.add(subscriber)
+        # The restarted listener's first snapshot holds everything since the older version;
+        # subscribers that already have those lines filter them out by version
+        if subscriber.since_version < self.since_version:
+            self.listen(subscriber.since_version)
+
+    def on_snapshot(self, snapshot, changes, read_time):
+        """Called on Firestore's listener thread with the changed lines"""
+        lines = []
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                continue
+            data = change.document.to_dict()
+            line = {field: data.get(field) for field in PUSHED_LINE_FIELDS}
+            line['id'] = change.document.id
+            lines.append(line)
+
+        if not lines:
+            return
+
+        # Each subscriber only gets lines newer than what it has already seen
+        with self.lock:
+            for subscriber in self.subscribers:
+                newer = [line for line in lines if (line['version'] or 0) > subscriber.since_version]
+                if not newer:
+                    continue
+                subscriber.since_version = max(line['version'] for line in newer)
+                payload = json.dumps({'lines': newer}, default=serialize_value)
+                subscriber.loop.call_soon_threadsafe(subscriber.queue.put_nowait, payload)
+
+    def close(self):
+        self.watch.unsubscribe()
+
+channels = {}
+channels_lock = threading.Lock()
+
+def serialize_value(value):
+    """JSON fallback for Firestore timestamps"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def subscribe(entity_id, run_id, since_version):
+    """Register a subscriber for a run's line changes"""
+    subscriber = Subscriber(since_version)
+    with channels_lock:
+        channel = channels.get((entity_id, run_id))
+        if channel is None:
+            channel = channels[(entity_id, run_id)] = RunChannel(entity_id, run_id, since_version)
+        channel.add(subscriber)
+    return subscriber
+
+def unsubscribe(entity_id, run_id, subscriber):
+    """Remove a subscriber, stopping the run's listener when nobody is left"""
+    with channels_lock:
+        channel = channels.get((entity_id, run_id))
+        if channel is None:
+            return
+        with channel.lock:
+            channel.subscribers.discard(subscriber)
+            empty = not channel.subscribers
+        if empty:
+            del channels[(entity_id, run_id)]
+            channel.close()
+
+async def line_change_events(entity_id, run_id, since_version, heartbeat=15):
+    """Server-Sent Events stream of a run's line changes"""
+    # The stream is consumed after the request's entity scope has ended, so the entity is passed in
+    subscriber = subscribe(entity_id, run_id, since_version)
+    queue = subscriber.queue
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            try:
+                payload = await asyncio.wait_for(queue.get(), timeout=heartbeat)
+            except asyncio.TimeoutError:
+                # Comment line keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: lines\ndata: {payload}\n\n'
+    finally:
+        unsubscribe(entity_id, run_id, subscriber)
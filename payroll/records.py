@@ -0,0 +1,240 @@
+from array import array
+from datetime import datetime
+import json
+import math
+import sys
+import zlib
+
+# Numeric line fields, stored column-wise for the whole run
+LINE_NUMERIC_FIELDS = (
+    'salary', 'base_salary', 'allowance',
+    'epf_deduction', 'socso_deduction', 'eis_deduction',
+    'zakat_deduction', 'pcb_deduction', 'hrdf_deduction',
+    'statutory_deductions_total',
+    'employer_epf', 'employer_socso', 'employer_eis',
+    'employer_zakat', 'employer_pcb', 'employer_hrdf',
+    'adhoc_deductions_total', 'total_deductions', 'net_pay',
+)
+
+# Text line fields; values shared across many lines (role, month...) are interned
+LINE_TEXT_FIELDS = (
+    'payroll_run_id', 'entity', 'month', 'employee_ref', 'name', 'email', 'role',
+    'nationality', 'employee_id', 'passport', 'epf_no', 'socso_no', 'tax_no', 'gender',
+    'join_date', 'leave_date', 'email_status', 'email_error',
+)
+
+LINE_OTHER_FIELDS = ('version', 'created_at', 'updated_at', 'earnings', 'adhoc_deductions', 'ytd')
+
+RUN_FIELDS = (
+    'month', 'issued_date', 'status', 'version', 'employee_count',
+    'chunks_done', 'chunks_total', 'created_at', 'updated_at',
+)
+
+class Record:
+    """Slotted record that still reads like the Firestore dicts it replaces"""
+    __slots__ = ('id', 'extra')
+    FIELDS = ()
+
+    def __getitem__(self, key):
+        if key == 'id' or key in self.FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'id' or key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def keys(self):
+        keys = ['id'] + [field for field in self.FIELDS if field in self]
+        return keys + list(self.extra or ())
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
+
+class PayrollRun(Record):
+    """A payroll run header"""
+    __slots__ = RUN_FIELDS
+    FIELDS = RUN_FIELDS
+
+    @classmethod
+    def from_document(cls, doc):
+        run = cls()
+        run.id = doc.id
+        run.extra = None
+        data = doc.to_dict()
+        for field in RUN_FIELDS:
+            setattr(run, field, data.pop(field, None))
+        # Large bookkeeping fields aren't needed once a run is loaded
+        data.pop('employee_ids', None)
+        data.pop('source_line_ids', None)
+        if data:
+            run.extra = data
+        return run
+
+def numeric_field(field):
+    """Property reading and writing one column of the owning run's table"""
+    def getter(line):
+        return line.table.columns[field][line.row]
+
+    def setter(line, value):
+        line.table.columns[field][line.row] = float(value or 0)
+
+    return property(getter, setter)
+
+class PayrollLine(Record):
+    """One employee's line; numeric fields live in the run's column arrays"""
+    __slots__ = ('table', 'row') + LINE_TEXT_FIELDS + LINE_OTHER_FIELDS
+    FIELDS = LINE_NUMERIC_FIELDS + LINE_TEXT_FIELDS + LINE_OTHER_FIELDS
+
+for _field in LINE_NUMERIC_FIELDS:
+    setattr(PayrollLine, _field, numeric_field(_field))
+
+class PayrollLines:
+    """All lines of a run, with numeric fields held in typed column arrays"""
+    __slots__ = ('columns', 'lines')
+
+    def __init__(self):
+        self.columns = {field: array('d') for field in LINE_NUMERIC_FIELDS}
+        self.lines = []
+
+    @classmethod
+    def from_documents(cls, docs):
+        table = cls()
+        for doc in docs:
+            if doc.exists:
+                table.append(doc.id, doc.to_dict())
+        return table
+
+    def append(self, line_id, data):
+        """Add a line from its Firestore data"""
+        line = PayrollLine()
+        line.table = self
+        line.row = len(self.lines)
+        line.id = line_id
+        line.extra = None
+
+        for field in LINE_NUMERIC_FIELDS:
+            self.columns[field].append(float(data.pop(field, 0) or 0))
+        for field in LINE_TEXT_FIELDS:
+            value = data.pop(field, None)
+            setattr(line, field, sys.intern(value) if isinstance(value, str) else value)
+        for field in LINE_OTHER_FIELDS:
+            setattr(line, field, data.pop(field, None))
+        if data:
+            line.extra = data
+
+        self.lines.append(line)
+        return line
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Rebuild a table from the column-wise dict made by to_snapshot"""
+        table = cls()
+        count = len(snapshot['ids'])
+        for field in LINE_NUMERIC_FIELDS:
+            values = snapshot['numeric'].get(field)
+            table.columns[field] = array('d', values) if values is not None else array('d', [0.0]) * count
+
+        # Fields added after a snapshot was taken read as empty
+        text = {field: snapshot['text'].get(field) or [None] * count for field in LINE_TEXT_FIELDS}
+        other = {field: snapshot['other'].get(field) or [None] * count for field in LINE_OTHER_FIELDS}
+        for row, line_id in enumerate(snapshot['ids']):
+            line = PayrollLine()
+            line.table = table
+            line.row = row
+            line.id = line_id
+            line.extra = snapshot['extra'][row]
+            for field in LINE_TEXT_FIELDS:
+                value = text[field][row]
+                setattr(line, field, sys.intern(value) if isinstance(value, str) else value)
+            for field in LINE_OTHER_FIELDS:
+                setattr(line, field, other[field][row])
+            table.lines.append(line)
+        return table
+
+    def to_snapshot(self):
+        """The whole table as a column-wise dict"""
+        return {
+            'ids': [line.id for line in self.lines],
+            'numeric': {field: self.columns[field].tolist() for field in LINE_NUMERIC_FIELDS},
+            'text': {field: [getattr(line, field) for line in self.lines] for field in LINE_TEXT_FIELDS},
+            'other': {field: [getattr(line, field) for line in self.lines] for field in LINE_OTHER_FIELDS},
+            'extra': [line.extra for line in self.lines],
+        }
+
+    def subset(self, line_ids):
+        """New table holding only the given lines"""
+        wanted = set(line_ids)
+        table = PayrollLines()
+        for line in self.lines:
+            if line.id in wanted:
+                data = line.to_dict()
+                del data['id']
+                table.append(line.id, data)
+        return table
+
+    def find(self, line_id):
+        """Line with the given ID, or None"""
+        return next((line for line in self.lines if line.id == line_id), None)
+
+    def total(self, field):
+        """Sum of a numeric field over the run"""
+        return math.fsum(self.columns[field])
+
+    def totals(self):
+        return {field: self.total(field) for field in LINE_NUMERIC_FIELDS}
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[index]
+
+    def __bool__(self):
+        return bool(self.lines)
+
+def encode_value(value):
+    """JSON fallback keeping Firestore timestamps distinguishable from strings"""
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    raise TypeError(f'Cannot pack {type(value).__name__}')
+
+def decode_object(obj):
+    if len(obj) == 1 and '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    return obj
+
+def pack_lines(lines):
+    """Compress a run's lines into a columnar snapshot for archiving"""
+    data = json.dumps(lines.to_snapshot(), default=encode_value, separators=(',', ':'))
+    return zlib.compress(data.encode('utf-8'), 9)
+
+def unpack_lines(data):
+    """Rebuild a run's lines from a packed snapshot"""
+    return PayrollLines.from_snapshot(json.loads(zlib.decompress(data), object_hook=decode_object))
@@ -1,12 +1,87 @@
 from payroll_mvp.firebase import db
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists
 from datetime import datetime
+import base64
+import binascii
+import hashlib
+import json
+import math
+import re
+from .records import PayrollRun, PayrollLines, pack_lines, unpack_lines
+from .earnings import compute_earnings
+from .entities import scoped_collection, bind_entity, current_entity
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Line fields accumulated into the per-employee year-to-date rollups
+YTD_FIELDS = [
+    'salary',
+    'epf_deduction', 'socso_deduction', 'eis_deduction',
+    'zakat_deduction', 'pcb_deduction', 'hrdf_deduction',
+    'statutory_deductions_total',
+    'employer_epf', 'employer_socso', 'employer_eis',
+    'employer_zakat', 'employer_pcb', 'employer_hrdf',
+    'adhoc_deductions_total', 'total_deductions', 'net_pay',
+]
+
+# Dashboard metrics and the line fields they are summed from
+AGGREGATE_METRICS = {
+    'gross': ['salary'],
+    'statutory': ['statutory_deductions_total'],
+    'employer': ['employer_epf', 'employer_socso', 'employer_eis', 'employer_zakat', 'employer_pcb', 'employer_hrdf'],
+    'adhoc': ['adhoc_deductions_total'],
+    'net': ['net_pay'],
+}
+
+# Line fields the dashboard breaks totals down by
+AGGREGATE_DIMENSIONS = ['role', 'nationality']
+
+# Employees per batched write when building a run's lines
+RUN_CHUNK_SIZE = 200
+
+# Runs with more employees than this are built in the background
+BACKGROUND_RUN_THRESHOLD = 200
+
+# A building run whose progress was written this recently is still owned by a live worker
+RUN_HEARTBEAT_SECONDS = 120
+
+# Accepted idempotency keys double as run document IDs
+IDEMPOTENCY_KEY_PATTERN = re.compile(r'[A-Za-z0-9_-]{8,64}')
+
+# Shared pool for independent Firestore reads issued in parallel
+READ_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix='firestore-read')
+
+# Largest rounding difference tolerated when a run's totals are validated
+TOTALS_TOLERANCE = 0.005
+
+# Largest packed snapshot stored in an archive document (Firestore's limit is 1 MiB)
+ARCHIVE_MAX_BYTES = 1_000_000
+
+# Line fields kept in an employee's archived pay history
+ARCHIVED_HISTORY_FIELDS = [
+    'month', 'salary', 'statutory_deductions_total', 'adhoc_deductions_total', 'total_deductions', 'net_pay',
+]
+
+def collection(name):
+    """A collection of the entity the current request or job is scoped to"""
+    return scoped_collection(db, name)
+
+class PayrollRunLocked(Exception):
+    """Raised when a finalized run's lines would be changed"""
+
+class PayrollRunArchived(Exception):
+    """Raised when an archived run would be used as a live one"""
+
+class InvalidHistoryCursor(ValueError):
+    """Raised when a pay history cursor was not issued for this employee"""
 
 # === EMPLOYEES ===
 
 def get_all_employees():
     """Get all employees from Firestore"""
     employees = []
-    docs = db.collection('employees').stream()
+    docs = collection('employees').stream()
     for doc in docs:
         employee = doc.to_dict()
         employee['id'] = doc.id
@@ -15,7 +90,7 @@ def get_all_employees():
 
 def get_employee(employee_id):
     """Get single employee by ID"""
-    doc = db.collection('employees').document(employee_id).get()
+    doc = collection('employees').document(employee_id).get()
     if doc.exists:
         employee = doc.to_dict()
         employee['id'] = doc.id
@@ -24,104 +99,1165 @@ def get_employee(employee_id):
 
 # === PAYROLL RUNS ===
 
-def create_payroll_run(month, issued_date, selected_employee_ids):
-    """Create a new payroll run with lines for selected employees"""
-    # Create the payroll run document
-    run_ref = db.collection('payroll_runs').document()
-    run_data = {
+def create_payroll_run(month, issued_date, selected_employee_ids, idempotency_key=None):
+    """Create (or resume) a payroll run; returns (run_id, finished)"""
+    employee_ids = list(dict.fromkeys(selected_employee_ids))
+    return start_payroll_run(idempotency_key, {
+        'month': month,
+        'issued_date': issued_date,
+        'employee_ids': employee_ids,
+    })
+
+def clone_payroll_run(source_run_id, month, issued_date, include_deductions=False, idempotency_key=None):
+    """Create a run for a new month from a previous run's lines; returns (run_id, finished), or None"""
+    source_ref = collection('payroll_runs').document(source_run_id)
+    source_doc = source_ref.get()
+    if not source_doc.exists:
+        return None
+    if source_doc.to_dict().get('archived'):
+        raise PayrollRunArchived(source_run_id)
+    
+    # Only line IDs and employee refs are needed to plan the chunks
+    employee_ids, source_line_ids = [], []
+    for doc in source_ref.collection('lines').select(['employee_ref']).stream():
+        employee_ref = doc.to_dict().get('employee_ref')
+        if employee_ref and employee_ref not in employee_ids:
+            employee_ids.append(employee_ref)
+            source_line_ids.append(doc.id)
+    
+    return start_payroll_run(idempotency_key, {
         'month': month,
         'issued_date': issued_date,
-        'created_at': datetime.now()
+        'employee_ids': employee_ids,
+        'source_line_ids': source_line_ids,
+        'cloned_from': source_run_id,
+        'clone_deductions': include_deductions,
+    })
+
+def start_payroll_run(idempotency_key, run_data):
+    """Create a run document and build its lines; returns (run_id, finished)"""
+    # Retries with the same idempotency key land on the same run document
+    if idempotency_key and IDEMPOTENCY_KEY_PATTERN.fullmatch(idempotency_key):
+        run_ref = collection('payroll_runs').document(idempotency_key)
+        existing = run_ref.get()
+        if existing.exists:
+            return resume_existing_run(run_ref, existing.to_dict())
+    else:
+        run_ref = collection('payroll_runs').document()
+    
+    # Chunk membership lives in the run's chunks subcollection, keeping the run document small
+    run_data = dict(run_data)
+    employee_ids = run_data.pop('employee_ids')
+    source_line_ids = run_data.pop('source_line_ids', None)
+    
+    # Copied and scheduled deductions add writes per line, so those chunks are smaller
+    scheduled = get_active_deduction_schedules()
+    if run_data.get('clone_deductions') or any(emp_id in scheduled for emp_id in employee_ids):
+        chunk_size = RUN_CHUNK_SIZE // 2
+    else:
+        chunk_size = RUN_CHUNK_SIZE
+    chunks_total = math.ceil(len(employee_ids) / chunk_size)
+    
+    # Chunk documents are written before the run exists, so a run never points at missing chunks
+    batch = db.batch()
+    for index in range(chunks_total):
+        chunk = slice(index * chunk_size, (index + 1) * chunk_size)
+        chunk_data = {'employee_ids': employee_ids[chunk]}
+        if source_line_ids is not None:
+            chunk_data['source_line_ids'] = source_line_ids[chunk]
+        batch.set(run_chunk_ref(run_ref, index), chunk_data)
+        if (index + 1) % 400 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    
+    run_data = {
+        **run_data,
+        'status': 'building' if employee_ids else 'ready',
+        'employee_count': 0,
+        'chunk_size': chunk_size,
+        'chunks_total': chunks_total,
+        'chunks_done': 0,
+        'created_at': datetime.now(),
+        'updated_at': datetime.now()
     }
-    run_ref.set(run_data)
-    
-    # Create payroll lines for each selected employee
-    for emp_id in selected_employee_ids:
-        employee = get_employee(emp_id)
-        if employee:
-            # Calculate statutory deductions total
-            statutory_total = (
-                employee.get('epf_deduction', 0) +
-                employee.get('socso_deduction', 0) +
-                employee.get('eis_deduction', 0) +
-                employee.get('zakat_deduction', 0) +
-                employee.get('pcb_deduction', 0) +
-                employee.get('hrdf_deduction', 0)
-            )
-            
-            salary = employee.get('base_salary', 0)
-            
-            line_ref = run_ref.collection('lines').document()
-            line_data = {
-                'payroll_run_id': run_ref.id,
-                'employee_ref': emp_id,
-                'name': employee.get('name'),
-                'email': employee.get('email'),
-                'role': employee.get('role'),
-                'nationality': employee.get('nationality'),
-                'employee_id': employee.get('employee_id'),
-                'passport': employee.get('passport'),
-                'epf_no': employee.get('epf_no'),
-                'socso_no': employee.get('socso_no'),
-                'gender': employee.get('gender'),
-                'salary': salary,
-                # Statutory deductions snapshot
-                'epf_deduction': employee.get('epf_deduction', 0),
-                'socso_deduction': employee.get('socso_deduction', 0),
-                'eis_deduction': employee.get('eis_deduction', 0),
-                'zakat_deduction': employee.get('zakat_deduction', 0),
-                'pcb_deduction': employee.get('pcb_deduction', 0),
-                'hrdf_deduction': employee.get('hrdf_deduction', 0),
-                'statutory_deductions_total': statutory_total,
-                # Employer contributions snapshot
-                'employer_epf': employee.get('employer_epf', 0),
-                'employer_socso': employee.get('employer_socso', 0),
-                'employer_eis': employee.get('employer_eis', 0),
-                'employer_zakat': employee.get('employer_zakat', 0),
-                'employer_pcb': employee.get('employer_pcb', 0),
-                'employer_hrdf': employee.get('employer_hrdf', 0),
-                'adhoc_deductions_total': 0,
-                'total_deductions': statutory_total,  # Initially just statutory
-                'net_pay': salary - statutory_total,
-                'created_at': datetime.now(),
-                'updated_at': datetime.now()
+    
+    try:
+        run_ref.create(run_data)
+    except AlreadyExists:
+        # A concurrent retry created it first
+        return resume_existing_run(run_ref, run_ref.get().to_dict())
+    
+    return build_run_lines(run_ref.id, len(employee_ids))
+
+def resume_existing_run(run_ref, run):
+    """Answer a retried submit; the run is only rebuilt if its worker has died; returns (run_id, finished)"""
+    if run.get('status') != 'building':
+        return run_ref.id, True
+    if run_is_being_built(run):
+        return run_ref.id, False
+    return build_run_lines(run_ref.id, (run['chunks_total'] - run['chunks_done']) * run.get('chunk_size', RUN_CHUNK_SIZE))
+
+def run_is_being_built(run, now=None):
+    """Whether a building run's progress was written recently enough that its worker is alive"""
+    heartbeat = run.get('updated_at') or run.get('created_at')
+    if heartbeat is None:
+        return False
+    # Timestamps come back timezone-aware but were written as naive local time
+    age = (now or datetime.now()) - heartbeat.replace(tzinfo=None)
+    return age.total_seconds() < RUN_HEARTBEAT_SECONDS
+
+def build_run_lines(run_id, employee_count):
+    """Build a run inline, or in the background when it is large; returns (run_id, finished)"""
+    if employee_count > BACKGROUND_RUN_THRESHOLD:
+        threading.Thread(target=bind_entity(build_payroll_run), args=(run_id,), daemon=True).start()
+        return run_id, False
+    
+    return run_id, build_payroll_run(run_id)
+
+def run_chunk_ref(run_ref, index):
+    """Document listing the employees (and source lines) of one chunk of a run"""
+    return run_ref.collection('chunks').document(f"{index:05d}")
+
+def get_run_chunk(run_ref, run, index):
+    """Employee IDs and source line IDs (or None) of one chunk"""
+    # Runs created before chunk documents kept every ID on the run itself
+    if 'employee_ids' in run:
+        chunk = slice(index * run['chunk_size'], (index + 1) * run['chunk_size'])
+        source_line_ids = run.get('source_line_ids')
+        return run['employee_ids'][chunk], source_line_ids[chunk] if source_line_ids is not None else None
+    
+    chunk = run_chunk_ref(run_ref, index).get().to_dict()
+    return chunk['employee_ids'], chunk.get('source_line_ids')
+
+def build_payroll_run(run_id):
+    """Write a run's remaining line chunks; safe to call again after a crash"""
+    run_ref = collection('payroll_runs').document(run_id)
+    run = run_ref.get().to_dict()
+    
+    # One projection query finds every schedule; chunks read their own in the commit
+    scheduled = get_active_deduction_schedules()
+    
+    for index in range(run['chunks_done'], run['chunks_total']):
+        employee_ids, source_line_ids = get_run_chunk(run_ref, run, index)
+        
+        if run.get('cloned_from'):
+            lines, deductions = build_cloned_lines(run_id, run, employee_ids, source_line_ids)
+        else:
+            lines, deductions = build_employee_lines(run_id, run['month'], employee_ids), {}
+        
+        schedule_refs = [ref for line in lines for ref in scheduled.get(line['employee_ref'], [])]
+        if not commit_run_chunk(db.transaction(), run_ref, index, lines, deductions, schedule_refs):
+            # Another worker already committed this chunk
+            continue
+    
+    return run_ref.get().to_dict().get('status') == 'ready'
+
+def build_employee_lines(run_id, month, employee_ids):
+    """Snapshot lines for a chunk of employees, read with their attendance in one batched get"""
+    refs = [collection('employees').document(emp_id) for emp_id in employee_ids]
+    attendance_refs = [attendance_ref(month, emp_id) for emp_id in employee_ids]
+    docs = {doc.reference.path: doc for doc in db.get_all(refs + attendance_refs)}
+    
+    lines = []
+    for ref, attendance_doc_ref in zip(refs, attendance_refs):
+        doc = docs.get(ref.path)
+        if doc and doc.exists:
+            employee = doc.to_dict()
+            employee['id'] = doc.id
+            attendance_doc = docs.get(attendance_doc_ref.path)
+            attendance = attendance_doc.to_dict() if attendance_doc and attendance_doc.exists else None
+            lines.append(build_line_snapshot(run_id, month, employee, attendance))
+    return lines
+
+def build_cloned_lines(run_id, run, employee_ids, source_line_ids):
+    """Carry a chunk of source lines forward; returns (lines, recurring deductions by employee_ref)"""
+    source_lines_ref = collection('payroll_runs').document(run['cloned_from']).collection('lines')
+    source_refs = [source_lines_ref.document(line_id) for line_id in source_line_ids]
+    employee_refs = [collection('employees').document(emp_id) for emp_id in employee_ids]
+    attendance_refs = [attendance_ref(run['month'], emp_id) for emp_id in employee_ids]
+    
+    # Source lines, employees and the new month's attendance come back from one batched get
+    docs = {doc.reference.path: doc for doc in db.get_all(source_refs + employee_refs + attendance_refs)}
+    source_deductions = get_deductions_for_line_refs(source_refs) if run.get('clone_deductions') else {}
+    
+    lines, deductions = [], {}
+    for employee_ref, source_ref, attendance_doc_ref in zip(employee_refs, source_refs, attendance_refs):
+        employee_doc, source_doc = docs.get(employee_ref.path), docs.get(source_ref.path)
+        if not employee_doc or not employee_doc.exists:
+            # The employee has since been deleted
+            continue
+        
+        source = source_doc.to_dict() if source_doc and source_doc.exists else None
+        if source is None or employee_changed_since(employee_doc, source):
+            employee = employee_doc.to_dict()
+        else:
+            # Unchanged employees reuse the source line's snapshot; earnings are redone for the new month
+            employee = {**source, 'base_salary': source.get('base_salary', source.get('salary', 0))}
+        employee['id'] = employee_doc.id
+        attendance_doc = docs.get(attendance_doc_ref.path)
+        attendance = attendance_doc.to_dict() if attendance_doc and attendance_doc.exists else None
+        line = build_line_snapshot(run_id, run['month'], employee, attendance)
+        
+        # Scheduled deductions are applied afresh from their schedule, so copying them would deduct twice
+        recurring = [
+            ded for ded in source_deductions.get(source_ref.id, [])
+            if ded.get('recurring') and not ded.get('schedule_id')
+        ]
+        if recurring:
+            deductions[line['employee_ref']] = recurring
+        lines.append(line)
+    
+    return lines, deductions
+
+def employee_changed_since(employee_doc, line):
+    """Whether an employee record was updated after a line snapshotted it"""
+    snapshot_at = line.get('created_at')
+    return snapshot_at is None or employee_doc.update_time > snapshot_at
+
+@firestore.transactional
+def commit_run_chunk(transaction, run_ref, index, lines, deductions=None, schedule_refs=()):
+    """Commit one chunk of lines, their deductions, schedule balances, rollups and progress marker, exactly once"""
+    run = run_ref.get(transaction=transaction).to_dict()
+    if run['chunks_done'] != index:
+        return False
+    
+    # Schedules are read inside the transaction so a balance is never applied twice
+    schedules = [doc for doc in transaction.get_all(schedule_refs) if doc.exists] if schedule_refs else []
+    
+    version = run.get('version', 0) + 1
+    deductions = {employee_ref: list(items) for employee_ref, items in (deductions or {}).items()}
+    apply_deduction_schedules(transaction, schedules, run['month'], {line['employee_ref'] for line in lines}, deductions)
+    
+    # Line documents are keyed by employee_ref, so a chunk can never be duplicated
+    lines = [with_adhoc_deductions(line, deductions.get(line['employee_ref'], [])) for line in lines]
+    for line in lines:
+        line_ref = run_ref.collection('lines').document(line['employee_ref'])
+        transaction.set(line_ref, {**line, 'version': version})
+        for idx, ded in enumerate(deductions.get(line['employee_ref'], [])):
+            deduction = {
+                'name': ded['name'],
+                'amount': ded['amount'],
+                'recurring': bool(ded.get('recurring')),
+                'sort_order': idx,
+                'created_at': datetime.now()
             }
-            line_ref.set(line_data)
+            if ded.get('schedule_id'):
+                deduction['schedule_id'] = ded['schedule_id']
+            transaction.set(line_ref.collection('deductions').document(), deduction)
+        add_ytd_rollup_write(transaction, run_ref.id, line)
+    if lines:
+        add_aggregate_write(transaction, run_ref.id, run['month'], lines)
     
-    return run_ref.id
+    done = index + 1
+    transaction.update(run_ref, {
+        'version': version,
+        'chunks_done': done,
+        'employee_count': firestore.Increment(len(lines)),
+        'status': 'ready' if done >= run['chunks_total'] else 'building',
+        'updated_at': datetime.now()
+    })
+    return True
+
+def with_adhoc_deductions(line, deductions):
+    """Copy of a new line with its ad-hoc deductions reflected in the totals"""
+    if not deductions:
+        return line
+    adhoc_total = sum(ded['amount'] for ded in deductions)
+    total_deductions = line['statutory_deductions_total'] + adhoc_total
+    return {
+        **line,
+        'adhoc_deductions_total': adhoc_total,
+        'total_deductions': total_deductions,
+        'net_pay': line['salary'] - total_deductions,
+    }
+
+def build_line_snapshot(run_id, month, employee, attendance=None):
+    """Snapshot an employee record (and the month's attendance) into a new payroll line"""
+    # Calculate statutory deductions total
+    statutory_total = (
+        employee.get('epf_deduction', 0) +
+        employee.get('socso_deduction', 0) +
+        employee.get('eis_deduction', 0) +
+        employee.get('zakat_deduction', 0) +
+        employee.get('pcb_deduction', 0) +
+        employee.get('hrdf_deduction', 0)
+    )
+    
+    # Gross pay is the sum of the earnings rows shown on the payslip
+    earnings = compute_earnings(employee, month, attendance)
+    salary = round(sum(row['amount'] for row in earnings), 2)
+    
+    return {
+        'payroll_run_id': run_id,
+        'entity': current_entity(),
+        'month': month,
+        'employee_ref': employee['id'],
+        'name': employee.get('name'),
+        'email': employee.get('email'),
+        'role': employee.get('role'),
+        'nationality': employee.get('nationality'),
+        'employee_id': employee.get('employee_id'),
+        'passport': employee.get('passport'),
+        'epf_no': employee.get('epf_no'),
+        'socso_no': employee.get('socso_no'),
+        'tax_no': employee.get('tax_no'),
+        'gender': employee.get('gender'),
+        'join_date': employee.get('join_date'),
+        'leave_date': employee.get('leave_date'),
+        'base_salary': employee.get('base_salary', 0),
+        'allowance': employee.get('allowance', 0),
+        'earnings': earnings,
+        'salary': salary,
+        # Statutory deductions snapshot
+        'epf_deduction': employee.get('epf_deduction', 0),
+        'socso_deduction': employee.get('socso_deduction', 0),
+        'eis_deduction': employee.get('eis_deduction', 0),
+        'zakat_deduction': employee.get('zakat_deduction', 0),
+        'pcb_deduction': employee.get('pcb_deduction', 0),
+        'hrdf_deduction': employee.get('hrdf_deduction', 0),
+        'statutory_deductions_total': statutory_total,
+        # Employer contributions snapshot
+        'employer_epf': employee.get('employer_epf', 0),
+        'employer_socso': employee.get('employer_socso', 0),
+        'employer_eis': employee.get('employer_eis', 0),
+        'employer_zakat': employee.get('employer_zakat', 0),
+        'employer_pcb': employee.get('employer_pcb', 0),
+        'employer_hrdf': employee.get('employer_hrdf', 0),
+        'adhoc_deductions_total': 0,
+        'total_deductions': statutory_total,  # Initially just statutory
+        'net_pay': salary - statutory_total,
+        'created_at': datetime.now(),
+        'updated_at': datetime.now()
+    }
+
+def get_unfinished_payroll_runs():
+    """Get runs whose line building never completed, keyed by run ID"""
+    docs = collection('payroll_runs').where('status', '==', 'building').stream()
+    return {doc.id: doc.to_dict() for doc in docs}
 
 def get_payroll_run(run_id):
     """Get payroll run by ID"""
-    doc = db.collection('payroll_runs').document(run_id).get()
+    doc = collection('payroll_runs').document(run_id).get()
     if doc.exists:
-        run = doc.to_dict()
-        run['id'] = doc.id
-        return run
+        return PayrollRun.from_document(doc)
     return None
 
 def get_payroll_lines(run_id):
-    """Get all payroll lines for a run"""
-    lines = []
-    docs = db.collection('payroll_runs').document(run_id).collection('lines').stream()
+    """Get all payroll lines for a run as a compact columnar table"""
+    archived = get_run_archive(run_id)
+    if archived is not None:
+        return archived
+    
+    docs = collection('payroll_runs').document(run_id).collection('lines').stream()
+    return PayrollLines.from_documents(docs)
+
+def iter_payroll_lines(run_id):
+    """Stream payroll lines for a run one document at a time"""
+    archived = get_run_archive(run_id)
+    if archived is not None:
+        yield from (line.to_dict() for line in archived)
+        return
+    
+    docs = collection('payroll_runs').document(run_id).collection('lines').stream()
     for doc in docs:
         line = doc.to_dict()
         line['id'] = doc.id
-        lines.append(line)
-    return lines
+        yield line
 
 def get_all_payroll_runs():
     """Get all payroll runs, ordered by creation date (newest first)"""
     runs = []
-    docs = db.collection('payroll_runs').order_by('created_at', direction='DESCENDING').stream()
+    docs = collection('payroll_runs').order_by('created_at', direction='DESCENDING').stream()
     
     for doc in docs:
         run = doc.to_dict()
         run['id'] = doc.id
         
-        # Count how many employees in this run
-        lines_count = len(list(doc.reference.collection('lines').stream()))
-        run['employee_count'] = lines_count
+        # Older runs don't store their employee count
+        if 'employee_count' not in run:
+            run['employee_count'] = len(list(doc.reference.collection('lines').stream()))
         
         runs.append(run)
     
-    return runs
\ No newline at end of file
+    return runs
+
+# === FINALIZATION ===
+
+def validate_run_totals(run, lines):
+    """Check a run's lines add up before it is finalized; returns a list of problems"""
+    errors = []
+    if run.get('status') == 'finalized':
+        errors.append('Payroll run is already finalized')
+    elif run.get('status', 'ready') != 'ready':
+        errors.append('Payroll run is still being built')
+    if run.get('employee_count') is not None and run['employee_count'] != len(lines):
+        errors.append(f"Run has {len(lines)} lines but expects {run['employee_count']}")
+    
+    for line in lines:
+        name = line.get('name') or line['id']
+        adhoc_total = sum(ded.get('amount', 0) for ded in line.get('adhoc_deductions', []))
+        checks = [
+            ('ad-hoc deductions', adhoc_total, line['adhoc_deductions_total']),
+            ('total deductions', line['statutory_deductions_total'] + line['adhoc_deductions_total'], line['total_deductions']),
+            ('net pay', line['salary'] - line['total_deductions'], line['net_pay']),
+        ]
+        for label, expected, actual in checks:
+            if abs(expected - actual) > TOTALS_TOLERANCE:
+                errors.append(f"{name}: {label} is {actual:.2f}, expected {expected:.2f}")
+    return errors
+
+def finalize_payroll_run(run_id, version, manifest=None):
+    """Lock a run against edits if it is unchanged since it was validated; returns True on success"""
+    run_ref = collection('payroll_runs').document(run_id)
+    return commit_run_finalization(db.transaction(), run_ref, version, manifest)
+
+@firestore.transactional
+def commit_run_finalization(transaction, run_ref, version, manifest=None):
+    """Mark a ready run finalized with its artifact checksums, provided its version still matches"""
+    run_doc = run_ref.get(transaction=transaction)
+    if not run_doc.exists:
+        return False
+    
+    run = run_doc.to_dict()
+    if run.get('status', 'ready') != 'ready' or run.get('version', 0) != version:
+        return False
+    
+    update = {
+        'status': 'finalized',
+        'finalized_at': datetime.now(),
+        'updated_at': datetime.now()
+    }
+    if manifest is not None:
+        update['artifacts'] = artifact_checksums(manifest)
+    transaction.update(run_ref, update)
+    return True
+
+def artifact_checksums(manifest):
+    return {name: entry['sha256'] for name, entry in manifest['files'].items()}
+
+def record_run_artifacts(run_id, manifest):
+    """Keep the checksums of a finalized run's frozen artifacts on the run"""
+    collection('payroll_runs').document(run_id).update({'artifacts': artifact_checksums(manifest)})
+
+def run_concurrently(*calls):
+    """Run independent read callables in parallel and return their results in order"""
+    # The first call runs on the calling thread, so it may itself fan out on READ_POOL;
+    # the rest run on the pool and must not wait on it, or a busy pool could deadlock
+    first, *rest = calls
+    futures = [READ_POOL.submit(bind_entity(call)) for call in rest]
+    return [first()] + [future.result() for future in futures]
+
+def read_line_deductions(line_ref):
+    """Stream one line's ad-hoc deductions"""
+    return [doc.to_dict() for doc in line_ref.collection('deductions').order_by('sort_order').stream()]
+
+def get_deductions_for_line_refs(line_refs):
+    """Stream several lines' ad-hoc deductions in parallel, keyed by line ID"""
+    results = READ_POOL.map(bind_entity(read_line_deductions), line_refs)
+    return {line_ref.id: deductions for line_ref, deductions in zip(line_refs, results)}
+
+def get_lines_with_deductions(run_id, line_ids=None):
+    """Get a run's lines (optionally only some) with their ad-hoc deductions attached"""
+    # Archived snapshots already carry each line's deductions
+    archived = get_run_archive(run_id)
+    if archived is not None:
+        return archived if line_ids is None else archived.subset(line_ids)
+    
+    lines_ref = collection('payroll_runs').document(run_id).collection('lines')
+    if line_ids is None:
+        line_docs = lines_ref.stream()
+    else:
+        line_docs = db.get_all([lines_ref.document(line_id) for line_id in line_ids])
+    
+    lines = PayrollLines.from_documents(line_docs)
+    
+    # Deductions for every line are fetched in parallel rather than one line after another
+    deductions = get_deductions_for_line_refs([lines_ref.document(line['id']) for line in lines])
+    for line in lines:
+        line['adhoc_deductions'] = deductions[line['id']]
+    return lines
+
+def get_payslip_data(run_id, line_id):
+    """Get a run and one of its lines (with deductions) in parallel; returns (run, line)"""
+    run_ref = collection('payroll_runs').document(run_id)
+    line_ref = run_ref.collection('lines').document(line_id)
+    run_archive_ref = archive_ref(run_id)
+    
+    # Run, line and any archive come back from one batched get, alongside the deductions stream
+    deductions, docs = run_concurrently(
+        lambda: read_line_deductions(line_ref),
+        lambda: {doc.reference.path: doc for doc in db.get_all([run_ref, line_ref, run_archive_ref])}
+    )
+    
+    run_doc, line_doc = docs.get(run_ref.path), docs.get(line_ref.path)
+    run = line = None
+    if run_doc and run_doc.exists:
+        run = PayrollRun.from_document(run_doc)
+    
+    archived = read_run_archive(docs.get(run_archive_ref.path))
+    if archived is not None:
+        line = archived.find(line_id)
+    elif line_doc and line_doc.exists:
+        line = PayrollLines.from_documents([line_doc])[0]
+        line['adhoc_deductions'] = deductions
+    return run, line
+
+def fill_missing_tax_numbers(lines):
+    """Fill in tax numbers missing from PCB lines (e.g. made before lines carried them) from the employee records"""
+    missing = [line for line in lines if line.get('pcb_deduction') and not line.get('tax_no') and line.get('employee_ref')]
+    if missing:
+        refs = [collection('employees').document(employee_ref) for employee_ref in {line['employee_ref'] for line in missing}]
+        tax_numbers = {doc.id: doc.to_dict().get('tax_no') for doc in db.get_all(refs) if doc.exists}
+        for line in missing:
+            line['tax_no'] = tax_numbers.get(line['employee_ref'])
+    return lines
+
+def with_employee_tax_numbers(lines):
+    """Stream lines with missing tax numbers filled in, 400 lines per batched employee read"""
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == 400:
+            yield from fill_missing_tax_numbers(batch)
+            batch = []
+    yield from fill_missing_tax_numbers(batch)
+
+def update_lines_email_status(run_id, outcomes):
+    """Record payslip email outcomes, {line_id: (status, error, attempts)}, under one run version per 400 lines"""
+    updates = {}
+    for line_id, (status, error, attempts) in outcomes.items():
+        update = {
+            'email_status': status,
+            'email_error': error,
+            'email_attempts': attempts,
+            'email_updated_at': datetime.now()
+        }
+        if status == 'sent':
+            update['email_sent_at'] = datetime.now()
+        updates[line_id] = update
+    
+    run_ref = collection('payroll_runs').document(run_id)
+    line_ids = list(updates)
+    for start in range(0, len(line_ids), 400):
+        commit_versioned_line_updates(db.transaction(), run_ref, {
+            line_id: updates[line_id] for line_id in line_ids[start:start + 400]
+        })
+
+def mark_lines_email_queued(run_id, line_ids):
+    """Mark lines as queued for email dispatch in batched writes"""
+    run_ref = collection('payroll_runs').document(run_id)
+    for start in range(0, len(line_ids), 400):
+        commit_versioned_line_updates(db.transaction(), run_ref, {
+            line_id: {
+                'email_status': 'queued',
+                'email_error': None,
+                'email_updated_at': datetime.now()
+            }
+            for line_id in line_ids[start:start + 400]
+        })
+
+@firestore.transactional
+def commit_versioned_line_updates(transaction, run_ref, updates):
+    """Apply updates to several lines under one new run version"""
+    run = run_ref.get(transaction=transaction).to_dict()
+    version = run.get('version', 0) + 1
+    for line_id, update in updates.items():
+        transaction.update(run_ref.collection('lines').document(line_id), {**update, 'version': version})
+    transaction.update(run_ref, {'version': version})
+    return version
+
+# === EMPLOYEE PAY HISTORY ===
+
+def encode_history_cursor(month, run_id, line_id):
+    """Opaque pay history cursor for the last line on a page"""
+    return base64.urlsafe_b64encode(json.dumps([month, run_id, line_id]).encode()).decode('ascii')
+
+def decode_history_cursor(cursor):
+    """(month, run_id, line_id) of a pay history cursor"""
+    try:
+        month, run_id, line_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise InvalidHistoryCursor(cursor)
+    if not all(isinstance(part, str) and part and '/' not in part for part in (month, run_id, line_id)):
+        raise InvalidHistoryCursor(cursor)
+    return month, run_id, line_id
+
+def get_employee_pay_history(employee_ref, page_size=12, cursor=None):
+    """Get one page of an employee's payroll lines across runs, newest month first"""
+    # Archived months are older than every live line, so they continue the history once live lines run out
+    if cursor and cursor.startswith('archive:'):
+        offset = cursor.split(':', 1)[1]
+        if not offset.isdigit():
+            raise InvalidHistoryCursor(cursor)
+        return get_archived_pay_history(employee_ref, page_size, int(offset))
+    
+    # Lines of every entity share the collection group, so the query is kept to this entity's
+    query = (
+        db.collection_group('lines')
+        .where('entity', '==', current_entity())
+        .where('employee_ref', '==', employee_ref)
+        .order_by('month', direction='DESCENDING')
+    )
+    
+    # The cursor names the last line on the previous page; it is only resolved inside this
+    # entity's runs and must belong to the same employee
+    if cursor:
+        month, run_id, line_id = decode_history_cursor(cursor)
+        cursor_doc = collection('payroll_runs').document(run_id).collection('lines').document(line_id).get()
+        if not cursor_doc.exists or cursor_doc.get('employee_ref') != employee_ref or cursor_doc.get('month') != month:
+            raise InvalidHistoryCursor(cursor)
+        query = query.start_after(cursor_doc)
+    
+    # Fetch one extra line to know whether another page exists
+    docs = list(query.limit(page_size + 1).stream())
+    
+    lines = []
+    for doc in docs[:page_size]:
+        line = doc.to_dict()
+        line['id'] = doc.id
+        line['payroll_run_id'] = doc.reference.parent.parent.id
+        lines.append(line)
+    
+    if len(docs) > page_size:
+        last = lines[-1]
+        return lines, encode_history_cursor(last['month'], last['payroll_run_id'], last['id'])
+    
+    archived_lines, next_cursor = get_archived_pay_history(employee_ref, page_size - len(lines), 0)
+    return lines + archived_lines, next_cursor
+
+def get_archived_pay_history(employee_ref, page_size, offset):
+    """Get a page of an employee's pay history from archived runs; returns (lines, next_cursor)"""
+    doc = history_archive_ref(employee_ref).get()
+    if not doc.exists:
+        return [], None
+    
+    rows = sorted(doc.to_dict().get('lines', []), key=lambda row: row.get('month') or '', reverse=True)
+    end = offset + page_size
+    return rows[offset:end], f'archive:{end}' if end < len(rows) else None
+
+def backfill_line_months():
+    """Copy each run's month and the entity onto lines created before lines carried them"""
+    entity_id = current_entity()
+    updated = 0
+    batch = db.batch()
+    for run_doc in collection('payroll_runs').stream():
+        month = run_doc.to_dict().get('month')
+        for line_doc in run_doc.reference.collection('lines').stream():
+            line = line_doc.to_dict()
+            if line.get('month') and line.get('entity') == entity_id:
+                continue
+            batch.update(line_doc.reference, {'month': line.get('month') or month, 'entity': entity_id})
+            updated += 1
+            if updated % 400 == 0:
+                batch.commit()
+                batch = db.batch()
+    batch.commit()
+    return updated
+
+# === ARCHIVE ===
+
+def archive_ref(run_id):
+    """Document holding an archived run's packed lines"""
+    return collection('payroll_archives').document(run_id)
+
+def history_archive_ref(employee_ref):
+    """Document holding an employee's pay history rows from archived runs"""
+    return collection('pay_history_archive').document(employee_ref)
+
+def read_run_archive(doc):
+    """Lines of an archive document, or None if the run isn't archived"""
+    if doc is None or not doc.exists:
+        return None
+    
+    archive = doc.to_dict()
+    if hashlib.sha256(archive['snapshot']).hexdigest() != archive['sha256']:
+        raise ValueError(f'Archive for run {doc.id} failed its checksum')
+    return unpack_lines(archive['snapshot'])
+
+def get_run_archive(run_id):
+    """Archived lines of a run, or None if the run is still live"""
+    return read_run_archive(archive_ref(run_id).get())
+
+def get_archivable_payroll_runs(before_month):
+    """IDs of finalized runs for months before the cutoff, oldest first"""
+    docs = collection('payroll_runs').where('status', '==', 'finalized').select(['month']).stream()
+    runs = [(doc.to_dict().get('month') or '', doc.id) for doc in docs]
+    return [run_id for month, run_id in sorted(runs) if month < before_month]
+
+def archive_payroll_run(run_id):
+    """Pack a finalized run's lines and deductions into one snapshot and delete the live documents; returns documents deleted"""
+    run_ref = collection('payroll_runs').document(run_id)
+    run = get_payroll_run(run_id)
+    if run is None or run.get('status') != 'finalized':
+        raise ValueError(f'Run {run_id} is not finalized')
+    
+    # A run archived by an interrupted earlier attempt only needs its leftover documents deleted
+    if not run.get('archived'):
+        lines = get_lines_with_deductions(run_id)
+        snapshot = pack_lines(lines)
+        if len(snapshot) > ARCHIVE_MAX_BYTES:
+            raise ValueError(f'Run {run_id} packs to {len(snapshot)} bytes, over the archive limit')
+        
+        # Pay history rows go first; ArrayUnion makes them safe to write again on a retry
+        batch = db.batch()
+        history_lines = [line for line in lines if line.get('employee_ref')]
+        for count, line in enumerate(history_lines, 1):
+            row = {field: line.get(field) for field in ARCHIVED_HISTORY_FIELDS}
+            row.update({'id': line['id'], 'payroll_run_id': run_id})
+            batch.set(history_archive_ref(line['employee_ref']), {'lines': firestore.ArrayUnion([row])}, merge=True)
+            if count % 400 == 0:
+                batch.commit()
+                batch = db.batch()
+        batch.commit()
+        
+        # The archive and the run's flag are written together, so reads switch over atomically
+        batch = db.batch()
+        batch.set(archive_ref(run_id), {
+            'snapshot': snapshot,
+            'sha256': hashlib.sha256(snapshot).hexdigest(),
+            'line_count': len(lines),
+            'created_at': datetime.now()
+        })
+        batch.update(run_ref, {
+            'archived': True,
+            'archived_at': datetime.now(),
+            'employee_count': len(lines)
+        })
+        batch.commit()
+    
+    return delete_run_lines(run_ref)
+
+def delete_run_lines(run_ref):
+    """Delete a run's line documents and their deductions in batches; returns documents deleted"""
+    line_refs = list(run_ref.collection('lines').list_documents())
+    deduction_refs = READ_POOL.map(lambda line_ref: list(line_ref.collection('deductions').list_documents()), line_refs)
+    
+    deleted = 0
+    batch = db.batch()
+    for line_ref, refs in zip(line_refs, deduction_refs):
+        for ref in refs + [line_ref]:
+            batch.delete(ref)
+            deleted += 1
+            if deleted % 400 == 0:
+                batch.commit()
+                batch = db.batch()
+    batch.commit()
+    return deleted
+
+# === DEDUCTIONS ===
+
+def save_line_deductions(run_id, line_id, adhoc_deductions_data):
+    """Replace a line's ad-hoc deductions and recompute its totals"""
+    run_ref = collection('payroll_runs').document(run_id)
+    line_ref = run_ref.collection('lines').document(line_id)
+    return commit_line_deductions(db.transaction(), run_ref, line_ref, adhoc_deductions_data)
+
+@firestore.transactional
+def commit_line_deductions(transaction, run_ref, line_ref, adhoc_deductions_data):
+    """Write a line's deductions, totals, rollups and new run version in one transaction"""
+    deductions_ref = line_ref.collection('deductions')
+    
+    # Get current run and line data
+    run_doc = run_ref.get(transaction=transaction)
+    line_doc = line_ref.get(transaction=transaction)
+    if not run_doc.exists or not line_doc.exists:
+        return None
+    
+    run = run_doc.to_dict()
+    if run.get('status') == 'finalized':
+        raise PayrollRunLocked(run_ref.id)
+    
+    line_data = line_doc.to_dict()
+    line_data.setdefault('month', run['month'])
+    existing = list(deductions_ref.stream(transaction=transaction))
+    
+    # Edits to a scheduled deduction move its schedule's balance by the difference
+    schedule_deltas = {}
+    for doc in existing:
+        schedule_id = doc.to_dict().get('schedule_id')
+        if schedule_id:
+            schedule_deltas[schedule_id] = schedule_deltas.get(schedule_id, 0) + doc.to_dict().get('amount', 0)
+    for ded in adhoc_deductions_data:
+        if ded.get('schedule_id') and ded['name'] and ded['amount']:
+            schedule_deltas[ded['schedule_id']] = schedule_deltas.get(ded['schedule_id'], 0) - float(ded['amount'])
+    schedule_refs = [collection('deduction_schedules').document(schedule_id) for schedule_id in schedule_deltas]
+    schedules = [doc for doc in transaction.get_all(schedule_refs) if doc.exists] if schedule_refs else []
+    
+    # Delete all existing ad-hoc deductions
+    for doc in existing:
+        transaction.delete(doc.reference)
+    
+    # Add new ad-hoc deductions
+    adhoc_total = 0
+    for idx, ded in enumerate(adhoc_deductions_data):
+        if ded['name'] and ded['amount']:
+            amount = float(ded['amount'])
+            adhoc_total += amount
+            
+            deduction = {
+                'name': ded['name'],
+                'amount': amount,
+                'recurring': bool(ded.get('recurring')),
+                'sort_order': idx,
+                'created_at': datetime.now()
+            }
+            if ded.get('schedule_id'):
+                deduction['schedule_id'] = ded['schedule_id']
+            transaction.set(deductions_ref.document(), deduction)
+    
+    for doc in schedules:
+        balance = doc.to_dict().get('remaining_balance')
+        if balance is not None and schedule_deltas[doc.id]:
+            balance += schedule_deltas[doc.id]
+            transaction.update(doc.reference, {
+                'remaining_balance': balance,
+                'active': balance > 0,
+                'updated_at': datetime.now()
+            })
+    
+    # Calculate totals
+    statutory_total = line_data.get('statutory_deductions_total', 0)
+    total_deductions = statutory_total + adhoc_total
+    salary = line_data.get('salary', 0)
+    net_pay = salary - total_deductions
+    
+    # Every line change bumps the run version so clients can fetch just the delta
+    version = run.get('version', 0) + 1
+    totals = {
+        'adhoc_deductions_total': adhoc_total,
+        'total_deductions': total_deductions,
+        'net_pay': net_pay,
+        'version': version,
+    }
+    
+    # Update the payroll line, run version and rollups in the same commit
+    transaction.update(line_ref, {**totals, 'updated_at': datetime.now()})
+    transaction.update(run_ref, {'version': version})
+    add_ytd_rollup_write(transaction, run_ref.id, {**line_data, **totals}, previous=line_data)
+    add_aggregate_write(transaction, run_ref.id, line_data['month'], [{**line_data, **totals}], previous_lines=[line_data])
+    
+    return totals
+
+# === ATTENDANCE ===
+
+def attendance_ref(month, employee_ref):
+    """Attendance summary document for one employee and month"""
+    return collection('attendance').document(f"{month}_{employee_ref}")
+
+def save_attendance(month, summaries):
+    """Store per-employee attendance summaries for a month, keyed by employee_ref, in batched writes"""
+    items = list(summaries.items())
+    for start in range(0, len(items), 400):
+        batch = db.batch()
+        for employee_ref, summary in items[start:start + 400]:
+            batch.set(attendance_ref(month, employee_ref), {
+                **summary,
+                'employee_ref': employee_ref,
+                'month': month,
+                'imported_at': datetime.now()
+            })
+        batch.commit()
+
+# === DEDUCTION SCHEDULES ===
+
+def get_active_deduction_schedules():
+    """Refs of every active deduction schedule, keyed by employee_ref"""
+    docs = (
+        collection('deduction_schedules')
+        .where('active', '==', True)
+        .select(['employee_ref'])
+        .stream()
+    )
+    scheduled = {}
+    for doc in docs:
+        scheduled.setdefault(doc.to_dict()['employee_ref'], []).append(doc.reference)
+    return scheduled
+
+def get_employee_deduction_schedules(employee_ref):
+    """Get all of an employee's deduction schedules"""
+    docs = collection('deduction_schedules').where('employee_ref', '==', employee_ref).stream()
+    schedules = []
+    for doc in docs:
+        schedule = doc.to_dict()
+        schedule['id'] = doc.id
+        schedules.append(schedule)
+    return sorted(schedules, key=lambda schedule: schedule['start_month'])
+
+def get_deduction_schedule(schedule_id):
+    """Get a single deduction schedule by ID"""
+    doc = collection('deduction_schedules').document(schedule_id).get()
+    if doc.exists:
+        schedule = doc.to_dict()
+        schedule['id'] = doc.id
+        return schedule
+    return None
+
+def create_deduction_schedule(employee_ref, name, amount, start_month, end_month=None, remaining_balance=None):
+    """Add a monthly deduction, e.g. a loan repayment, applied by every run it falls due in"""
+    _, doc_ref = collection('deduction_schedules').add({
+        'employee_ref': employee_ref,
+        'name': name,
+        'amount': amount,
+        'start_month': start_month,
+        'end_month': end_month or None,
+        'remaining_balance': remaining_balance,
+        'applied_months': [],
+        'active': True,
+        'created_at': datetime.now(),
+        'updated_at': datetime.now()
+    })
+    return doc_ref.id
+
+def delete_deduction_schedule(schedule_id):
+    """Delete a deduction schedule; deductions already applied to runs are kept"""
+    collection('deduction_schedules').document(schedule_id).delete()
+
+def schedule_amount_due(schedule, month):
+    """Amount a schedule deducts in a month, capped at its remaining balance"""
+    if not schedule.get('active') or month in schedule.get('applied_months', []):
+        return 0
+    if month < schedule['start_month'] or (schedule.get('end_month') and month > schedule['end_month']):
+        return 0
+    
+    amount = schedule['amount']
+    if schedule.get('remaining_balance') is not None:
+        amount = min(amount, schedule['remaining_balance'])
+    return max(amount, 0)
+
+def apply_deduction_schedules(transaction, schedules, month, employee_refs, deductions):
+    """Add due schedule deductions to a chunk's deductions and record them on the schedules"""
+    for doc in schedules:
+        schedule = doc.to_dict()
+        if schedule['employee_ref'] not in employee_refs:
+            continue
+        amount = schedule_amount_due(schedule, month)
+        if not amount:
+            continue
+        
+        deductions.setdefault(schedule['employee_ref'], []).append({
+            'name': schedule['name'],
+            'amount': amount,
+            'schedule_id': doc.id,
+        })
+        
+        update = {'applied_months': firestore.ArrayUnion([month]), 'updated_at': datetime.now()}
+        if schedule.get('remaining_balance') is not None:
+            update['remaining_balance'] = schedule['remaining_balance'] - amount
+            update['active'] = schedule['remaining_balance'] - amount > 0
+        if schedule.get('end_month') and month >= schedule['end_month']:
+            update['active'] = False
+        transaction.update(doc.reference, update)
+
+# === YEAR-TO-DATE ROLLUPS ===
+
+def ytd_rollup_id(employee_ref, year):
+    """Rollup document ID for one employee and year"""
+    return f"{employee_ref}_{year}"
+
+def add_ytd_rollup_write(batch, run_id, line, previous=None):
+    """Queue an incremental YTD rollup update for a line onto a batch"""
+    year = line['month'][:4]
+    rollup_ref = collection('employee_ytd').document(ytd_rollup_id(line['employee_ref'], year))
+    
+    # Only the change since the previous save is added to the running totals
+    totals = {}
+    for field in YTD_FIELDS:
+        delta = line.get(field, 0) - (previous.get(field, 0) if previous else 0)
+        if delta:
+            totals[field] = firestore.Increment(delta)
+    
+    rollup = {
+        'employee_ref': line['employee_ref'],
+        'year': year,
+        'name': line.get('name'),
+        'employee_id': line.get('employee_id'),
+        'role': line.get('role'),
+        'nationality': line.get('nationality'),
+        'passport': line.get('passport'),
+        'epf_no': line.get('epf_no'),
+        'socso_no': line.get('socso_no'),
+        # Per-run figures, so a payslip can show YTD as at its own month
+        'runs': {run_id: {'month': line['month'], **{field: line.get(field, 0) for field in YTD_FIELDS}}},
+        'updated_at': datetime.now()
+    }
+    # An empty map in a merge write would replace the stored totals, so leave it out
+    if totals:
+        rollup['totals'] = totals
+    batch.set(rollup_ref, rollup, merge=True)
+
+def get_ytd_rollups(year):
+    """Get every employee's YTD rollup for a year"""
+    rollups = []
+    docs = collection('employee_ytd').where('year', '==', str(year)).stream()
+    for doc in docs:
+        rollup = doc.to_dict()
+        rollup['id'] = doc.id
+        rollups.append(rollup)
+    return rollups
+
+def get_ytd_for_lines(lines, month):
+    """Get YTD totals as at `month` for each line, keyed by employee_ref"""
+    year = month[:4]
+    refs = [
+        collection('employee_ytd').document(ytd_rollup_id(line['employee_ref'], year))
+        for line in lines if line.get('employee_ref')
+    ]
+    
+    ytd = {}
+    # One batched read for all rollups
+    for doc in db.get_all(refs):
+        if not doc.exists:
+            continue
+        rollup = doc.to_dict()
+        ytd[rollup['employee_ref']] = ytd_as_at(rollup, month)
+    return ytd
+
+def ytd_as_at(rollup, month):
+    """A rollup's totals over the runs up to and including `month`"""
+    totals = dict.fromkeys(YTD_FIELDS, 0)
+    for run in rollup.get('runs', {}).values():
+        if run.get('month', '') <= month:
+            for field in YTD_FIELDS:
+                totals[field] += run.get(field, 0)
+    return totals
+
+def rebuild_ytd_rollups(year):
+    """Recompute every YTD rollup for a year from the payroll runs"""
+    year = str(year)
+    rollups = {}
+    
+    docs = collection('payroll_runs').where('month', '>=', f"{year}-01").where('month', '<=', f"{year}-12").stream()
+    for run_doc in docs:
+        run = run_doc.to_dict()
+        for line in iter_payroll_lines(run_doc.id):
+            if not line.get('employee_ref'):
+                continue
+            rollup = rollups.setdefault(line['employee_ref'], {
+                'employee_ref': line['employee_ref'],
+                'year': year,
+                'totals': dict.fromkeys(YTD_FIELDS, 0),
+                'runs': {},
+            })
+            for key in ('name', 'employee_id', 'role', 'nationality', 'passport', 'epf_no', 'socso_no'):
+                rollup[key] = line.get(key)
+            for field in YTD_FIELDS:
+                rollup['totals'][field] += line.get(field, 0)
+            rollup['runs'][run_doc.id] = {'month': run['month'], **{field: line.get(field, 0) for field in YTD_FIELDS}}
+    
+    # Overwrite the rollups in batches
+    batch = db.batch()
+    for count, (employee_ref, rollup) in enumerate(rollups.items(), start=1):
+        rollup['updated_at'] = datetime.now()
+        batch.set(collection('employee_ytd').document(ytd_rollup_id(employee_ref, year)), rollup)
+        if count % 400 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    
+    return len(rollups)
+
+# === DASHBOARD AGGREGATES ===
+
+def line_metrics(line):
+    """Dashboard metric values contributed by one line"""
+    return {
+        metric: sum(line.get(field, 0) or 0 for field in fields)
+        for metric, fields in AGGREGATE_METRICS.items()
+    }
+
+def dimension_key(line, dimension):
+    """Map key for a line's value in a dimension"""
+    return (line.get(dimension) or 'Unspecified').strip() or 'Unspecified'
+
+def add_aggregate_write(batch, run_id, month, lines, previous_lines=()):
+    """Queue an incremental update of the run's dashboard aggregate onto a batch"""
+    # Re-saved lines contribute only the change from their previous version
+    added = build_run_aggregate(run_id, month, lines)
+    removed = build_run_aggregate(run_id, month, previous_lines)
+    
+    def deltas(new, old):
+        return {metric: firestore.Increment(new.get(metric, 0) - old.get(metric, 0)) for metric in new}
+    
+    aggregate = {
+        'run_id': run_id,
+        'month': month,
+        'totals': deltas(added['totals'], removed['totals']),
+        'updated_at': datetime.now()
+    }
+    for dimension in AGGREGATE_DIMENSIONS:
+        key = f"by_{dimension}"
+        aggregate[key] = {
+            value: deltas(summary, removed[key].get(value, {}))
+            for value, summary in added[key].items()
+        }
+    
+    batch.set(collection('payroll_aggregates').document(run_id), aggregate, merge=True)
+
+def build_run_aggregate(run_id, month, lines):
+    """Compute a run's dashboard aggregate column by column over its lines"""
+    columns = {metric: [] for metric in AGGREGATE_METRICS}
+    keys = {dimension: [] for dimension in AGGREGATE_DIMENSIONS}
+    
+    # Lay the lines out as columns once
+    for line in lines:
+        for metric, value in line_metrics(line).items():
+            columns[metric].append(value)
+        for dimension in AGGREGATE_DIMENSIONS:
+            keys[dimension].append(dimension_key(line, dimension))
+    
+    def summarize(rows):
+        summary = {metric: math.fsum(columns[metric][row] for row in rows) for metric in AGGREGATE_METRICS}
+        summary['headcount'] = len(rows)
+        return summary
+    
+    aggregate = {
+        'run_id': run_id,
+        'month': month,
+        'totals': summarize(range(len(columns['gross']))),
+        'updated_at': datetime.now()
+    }
+    
+    # Group row numbers per dimension value, then sum each group's columns
+    for dimension, values in keys.items():
+        groups = {}
+        for row, value in enumerate(values):
+            groups.setdefault(value, []).append(row)
+        aggregate[f"by_{dimension}"] = {value: summarize(rows) for value, rows in groups.items()}
+    
+    return aggregate
+
+def rebuild_payroll_aggregates():
+    """Recompute every run's dashboard aggregate from its lines"""
+    count = 0
+    for run_doc in collection('payroll_runs').stream():
+        run = run_doc.to_dict()
+        aggregate = build_run_aggregate(run_doc.id, run['month'], iter_payroll_lines(run_doc.id))
+        collection('payroll_aggregates').document(run_doc.id).set(aggregate)
+        count += 1
+    return count
+
+def get_dashboard_aggregates(months=12):
+    """Get run aggregates summed per month for the most recent months, oldest first"""
+    by_month = {}
+    docs = collection('payroll_aggregates').order_by('month', direction='DESCENDING').stream()
+    for doc in docs:
+        aggregate = doc.to_dict()
+        # Several runs can share a month, so the window counts months rather than documents
+        if aggregate['month'] not in by_month and len(by_month) == months:
+            break
+        merge_aggregate(by_month.setdefault(aggregate['month'], {'month': aggregate['month'], 'run_ids': []}), aggregate)
+        by_month[aggregate['month']]['run_ids'].append(doc.id)
+    return sorted(by_month.values(), key=lambda row: row['month'])
+
+def merge_aggregate(total, aggregate):
+    """Add one run aggregate's totals and dimension breakdowns into a monthly total"""
+    def add(into, summary):
+        for metric, value in summary.items():
+            into[metric] = into.get(metric, 0) + value
+    
+    add(total.setdefault('totals', {}), aggregate.get('totals', {}))
+    for dimension in AGGREGATE_DIMENSIONS:
+        key = f"by_{dimension}"
+        for value, summary in aggregate.get(key, {}).items():
+            add(total.setdefault(key, {}).setdefault(value, {}), summary)
@@ -0,0 +1,140 @@
+from .repository import get_all_employees
+from .entities import current_entity
+import threading
+import time
+
+# How long the cached employee directory is trusted before it is reloaded
+DIRECTORY_TTL_SECONDS = 300
+
+# Exact-match filters available on the directory
+FACET_FIELDS = ['role', 'nationality', 'gender']
+
+def normalize(value):
+    """Lowercase, trimmed form used for every index key"""
+    return ' '.join(str(value or '').lower().split())
+
+def trigrams(text):
+    """Set of 3-character substrings of a normalized string"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class EmployeeIndex:
+    """Trigram and facet index over the employee directory"""
+
+    def __init__(self, employees):
+        self.employees = sorted(employees, key=lambda employee: normalize(employee.get('name')))
+        self.names = []
+        self.prefix_keys = []
+        self.trigrams = {}
+        self.facets = {field: {} for field in FACET_FIELDS}
+
+        for position, employee in enumerate(self.employees):
+            name = normalize(employee.get('name'))
+            employee_id = normalize(employee.get('employee_id'))
+            email = normalize(employee.get('email'))
+            self.names.append(name)
+            self.prefix_keys.append((employee_id, email))
+
+            for gram in trigrams(name) | trigrams(employee_id) | trigrams(email):
+                self.trigrams.setdefault(gram, set()).add(position)
+
+            for field in FACET_FIELDS:
+                value = normalize(employee.get(field))
+                if value:
+                    self.facets[field].setdefault(value, set()).add(position)
+
+    def matches_text(self, position, query):
+        """Name contains the query, or employee ID / email starts with it"""
+        employee_id, email = self.prefix_keys[position]
+        return query in self.names[position] or employee_id.startswith(query) or email.startswith(query)
+
+    def search(self, query='', min_salary=None, max_salary=None, **filters):
+        """Employees matching the text query, facet filters and salary range, by name"""
+        candidates = None
+
+        # Facet filters narrow the candidates first
+        for field in FACET_FIELDS:
+            value = normalize(filters.get(field))
+            if value:
+                matched = self.facets[field].get(value, set())
+                candidates = matched if candidates is None else candidates & matched
+
+        query = normalize(query)
+        if len(query) >= 3:
+            # Every trigram of the query must appear in the employee's keys
+            for gram in trigrams(query):
+                matched = self.trigrams.get(gram, set())
+                candidates = matched if candidates is None else candidates & matched
+                if not candidates:
+                    break
+
+        positions = range(len(self.employees)) if candidates is None else sorted(candidates)
+
+        results = []
+        for position in positions:
+            if query and not self.matches_text(position, query):
+                continue
+            salary = self.employees[position].get('base_salary') or 0
+            if min_salary is not None and salary < min_salary:
+                continue
+            if max_salary is not None and salary > max_salary:
+                continue
+            results.append(self.employees[position])
+        return results
+
+    def facet_values(self, selected=None):
+        """Distinct display values for each facet, with the selected one, for filter dropdowns"""
+        selected = selected or {}
+        values = {field: {} for field in FACET_FIELDS}
+        for employee in self.employees:
+            for field in FACET_FIELDS:
+                value = (employee.get(field) or '').strip()
+                if value:
+                    values[field].setdefault(normalize(value), value)
+        return [
+            {
+                'field': field,
+                'values': sorted(values[field].values()),
+                'selected': values[field].get(normalize(selected.get(field)), ''),
+            }
+            for field in FACET_FIELDS
+        ]
+
+# Each entity's index and the time it was built, keyed by entity ID
+_indexes = {}
+_index_lock = threading.Lock()
+
+def get_employee_index():
+    """Get the current entity's cached employee index, rebuilding it when stale"""
+    entity_id = current_entity()
+    with _index_lock:
+        index, loaded_at = _indexes.get(entity_id, (None, 0))
+        if index is None or time.monotonic() - loaded_at > DIRECTORY_TTL_SECONDS:
+            index = EmployeeIndex(get_all_employees())
+            _indexes[entity_id] = (index, time.monotonic())
+        return index
+
+def invalidate_employee_index():
+    """Drop the current entity's cached index after an employee is created, edited or deleted"""
+    with _index_lock:
+        _indexes.pop(current_entity(), None)
+
+def parse_search_params(params):
+    """Read search and filter values from request GET/POST data"""
+    def amount(key):
+        try:
+            return float(params.get(key)) if params.get(key) else None
+        except ValueError:
+            return None
+
+    return {
+        'query': params.get('q', ''),
+        'role': params.get('role', ''),
+        'nationality': params.get('nationality', ''),
+        'gender': params.get('gender', ''),
+        'min_salary': amount('min_salary'),
+        'max_salary': amount('max_salary'),
+    }
+
+def search_employees(params):
+    """Search the employee directory with request parameters"""
+    return get_employee_index().search(**parse_search_params(params))
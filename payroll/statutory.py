@@ -0,0 +1,201 @@
+import csv
+from io import StringIO
+from django.conf import settings
+
+# Amount fields summed across a run while the files are written
+TOTAL_FIELDS = [
+    'salary',
+    'epf_deduction', 'employer_epf',
+    'socso_deduction', 'employer_socso',
+    'eis_deduction', 'employer_eis',
+    'pcb_deduction',
+]
+
+# SOCSO/EIS text file layout (PERKESO ASSIST upload): (field, width)
+SOCSO_LAYOUT = [
+    ('employer_code', 12),
+    ('id_no', 12),
+    ('name', 150),
+    ('period', 6),
+    ('wages', 14),
+    ('socso_employee', 14),
+    ('socso_employer', 14),
+    ('eis_employee', 14),
+    ('eis_employer', 14),
+]
+
+# PCB CP39 text file layout (LHDN e-PCB upload): (field, width)
+CP39_HEADER_LAYOUT = [
+    ('record_type', 1),
+    ('employer_no', 10),
+    ('year', 4),
+    ('month', 2),
+    ('pcb_total', 10),
+    ('pcb_count', 5),
+    ('cp38_total', 10),
+    ('cp38_count', 5),
+]
+
+CP39_DETAIL_LAYOUT = [
+    ('record_type', 1),
+    ('tax_no', 10),
+    ('name', 60),
+    ('new_ic', 12),
+    ('passport', 12),
+    ('country', 2),
+    ('pcb_amount', 8),
+    ('cp38_amount', 8),
+    ('employee_no', 10),
+]
+
+STATUTORY_FILES = {
+    'epf': 'EPF Borang A',
+    'socso': 'SOCSO/EIS',
+    'cp39': 'PCB CP39',
+}
+
+class StatutoryFileError(ValueError):
+    """Raised when a submission file can't be written correctly from a run's lines"""
+
+    def __init__(self, problems):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+def to_cents(amount):
+    """Convert a ringgit amount to integer cents"""
+    return int(round(float(amount or 0) * 100))
+
+def format_amount(amount):
+    """Format a ringgit amount with 2 decimals"""
+    return f"{float(amount or 0):.2f}"
+
+def fixed_width(record, layout):
+    """Render a record as a fixed-width line (numbers right-aligned, text left-aligned)"""
+    parts = []
+    for field, width in layout:
+        value = record.get(field, '')
+        if isinstance(value, int):
+            # A clipped or signed number would still look valid to the portal, so it is refused
+            if value < 0 or len(str(value)) > width:
+                raise StatutoryFileError([f"{field} {value} does not fit a {width}-digit field"])
+            parts.append(str(value).rjust(width, '0'))
+        else:
+            parts.append(str(value or '').upper().ljust(width)[:width])
+    return ''.join(parts)
+
+def is_local(line):
+    """Malaysians are identified by NRIC, everyone else by passport"""
+    return (line.get('nationality') or '').strip().lower() in ('malaysian', 'malaysia')
+
+def statutory_filename(run, kind):
+    """Download filename for a statutory file"""
+    month = run['month'].replace('-', '_')
+    extension = 'csv' if kind == 'epf' else 'txt'
+    return f"{kind}_{month}.{extension}"
+
+def statutory_zip_files(run, files):
+    """(filename, content) pairs for the zip of every statutory file that could be produced"""
+    zipped = [(statutory_filename(run, kind), files[kind]) for kind in STATUTORY_FILES if files[kind] is not None]
+    problems = [f"{STATUTORY_FILES[kind]}: {problem}" for kind, kind_problems in files['problems'].items() for problem in kind_problems]
+    if problems:
+        zipped.append((f"problems_{run['month'].replace('-', '_')}.txt", '\r\n'.join(problems).encode('utf-8')))
+    return zipped
+
+def generate_statutory_files(run, lines):
+    """Build EPF, SOCSO/EIS and CP39 files in a single pass; a file that can't be written correctly is None, with reasons under 'problems'"""
+    year, month = (run['month'].split('-') + [''])[:2]
+    period = f"{month}{year}"
+
+    epf_buffer = StringIO()
+    epf_writer = csv.writer(epf_buffer)
+    epf_writer.writerow(['Member No', 'IC/Passport No', 'Name', 'Wages', 'Employer Share', 'Employee Share'])
+
+    socso_rows = []
+    cp39_rows = []
+    problems = {kind: [] for kind in STATUTORY_FILES}
+
+    # Shared aggregation across all three files
+    totals = dict.fromkeys(TOTAL_FIELDS, 0)
+    pcb_count = 0
+
+    for line in lines:
+        for field in TOTAL_FIELDS:
+            totals[field] += float(line.get(field) or 0)
+
+        id_no = line.get('passport') or ''
+        local = is_local(line)
+        name = line.get('name') or line.get('id')
+
+        # EPF Borang A
+        if line.get('epf_no') or line.get('epf_deduction') or line.get('employer_epf'):
+            epf_writer.writerow([
+                line.get('epf_no') or '',
+                id_no,
+                line.get('name') or '',
+                format_amount(line.get('salary')),
+                format_amount(line.get('employer_epf')),
+                format_amount(line.get('epf_deduction')),
+            ])
+
+        # SOCSO / EIS
+        if line.get('socso_no') or line.get('socso_deduction') or line.get('eis_deduction'):
+            try:
+                socso_rows.append(fixed_width({
+                    'employer_code': settings.EMPLOYER_SOCSO_NO,
+                    'id_no': line.get('socso_no') or id_no,
+                    'name': line.get('name'),
+                    'period': period,
+                    'wages': to_cents(line.get('salary')),
+                    'socso_employee': to_cents(line.get('socso_deduction')),
+                    'socso_employer': to_cents(line.get('employer_socso')),
+                    'eis_employee': to_cents(line.get('eis_deduction')),
+                    'eis_employer': to_cents(line.get('employer_eis')),
+                }, SOCSO_LAYOUT))
+            except StatutoryFileError as e:
+                problems['socso'].append(f"{name}: {e}")
+
+        # PCB CP39; LHDN rejects a detail record with a blank tax number
+        if line.get('pcb_deduction'):
+            pcb_count += 1
+            if not line.get('tax_no'):
+                problems['cp39'].append(f"{name}: no income tax number")
+                continue
+            try:
+                cp39_rows.append(fixed_width({
+                    'record_type': 'D',
+                    'tax_no': line.get('tax_no'),
+                    'name': line.get('name'),
+                    'new_ic': id_no if local else '',
+                    'passport': '' if local else id_no,
+                    'country': 'MY' if local else '',
+                    'pcb_amount': to_cents(line.get('pcb_deduction')),
+                    'cp38_amount': 0,
+                    'employee_no': line.get('employee_id'),
+                }, CP39_DETAIL_LAYOUT))
+            except StatutoryFileError as e:
+                problems['cp39'].append(f"{name}: {e}")
+
+    cp39 = None
+    if not problems['cp39']:
+        try:
+            cp39_header = fixed_width({
+                'record_type': 'H',
+                'employer_no': settings.EMPLOYER_TAX_NO,
+                'year': int(year or 0),
+                'month': int(month or 0),
+                'pcb_total': to_cents(totals['pcb_deduction']),
+                'pcb_count': pcb_count,
+                'cp38_total': 0,
+                'cp38_count': 0,
+            }, CP39_HEADER_LAYOUT)
+            cp39 = '\r\n'.join([cp39_header] + cp39_rows).encode('ascii', 'replace')
+        except StatutoryFileError as e:
+            problems['cp39'].append(f"Header: {e}")
+
+    return {
+        'epf': epf_buffer.getvalue().encode('utf-8'),
+        'socso': None if problems['socso'] else '\r\n'.join(socso_rows).encode('ascii', 'replace'),
+        'cp39': cp39,
+        'totals': totals,
+        'problems': {kind: kind_problems for kind, kind_problems in problems.items() if kind_problems},
+    }
@@ -1,3 +1,613 @@
-from django.test import TestCase
+import csv
+import uuid
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.transforms import Increment
+from . import repository
+from .earnings import PunchFileError, aggregate_punches, read_punches
+from .records import PayrollLines, pack_lines, unpack_lines
+from .statutory import (
+    fixed_width, generate_statutory_files, statutory_zip_files, StatutoryFileError,
+    CP39_DETAIL_LAYOUT, CP39_HEADER_LAYOUT, SOCSO_LAYOUT,
+)
 
-# Create your tests here.
+def make_line(**fields):
+    line = {
+        'id': 'emp1',
+        'name': 'Aisyah Rahman',
+        'nationality': 'Malaysian',
+        'passport': '900101145678',
+        'employee_id': 'EMP001',
+        'epf_no': 'EPF123456',
+        'socso_no': 'SOCSO123456',
+        'tax_no': 'SG10234560',
+        'salary': 5500.00,
+        'epf_deduction': 605.00,
+        'employer_epf': 715.00,
+        'socso_deduction': 24.50,
+        'employer_socso': 86.05,
+        'eis_deduction': 8.25,
+        'employer_eis': 8.25,
+        'pcb_deduction': 150.00,
+    }
+    line.update(fields)
+    return line
+
+class FixedWidthTests(SimpleTestCase):
+    LAYOUT = [('code', 4), ('name', 6), ('amount', 5)]
+
+    def test_pads_text_right_and_numbers_left_with_zeros(self):
+        self.assertEqual(fixed_width({'code': 'ab', 'name': 'Lee', 'amount': 42}, self.LAYOUT), 'AB  LEE   00042')
+
+    def test_truncates_text_wider_than_its_field(self):
+        row = fixed_width({'code': 'ABCDEFG', 'name': 'Muhammad Hafiz', 'amount': 12345}, self.LAYOUT)
+        self.assertEqual(row, 'ABCDMUHAMM12345')
+
+    def test_refuses_numbers_wider_than_their_field(self):
+        with self.assertRaises(StatutoryFileError):
+            fixed_width({'amount': 123456}, self.LAYOUT)
+
+    def test_refuses_negative_numbers(self):
+        with self.assertRaises(StatutoryFileError):
+            fixed_width({'amount': -1234}, self.LAYOUT)
+
+    def test_missing_values_are_blank(self):
+        self.assertEqual(fixed_width({'amount': 0}, self.LAYOUT), ' ' * 10 + '00000')
+
+@override_settings(EMPLOYER_TAX_NO='E123456789', EMPLOYER_SOCSO_NO='A1234567890B')
+class StatutoryFilesTests(SimpleTestCase):
+    RUN = {'id': 'run1', 'month': '2024-03'}
+
+    def test_epf_csv_rows_and_run_totals(self):
+        lines = [make_line(), make_line(id='emp2', name='Tan Wei', salary=7200.10, epf_deduction=792.01, employer_epf=936.01)]
+        files = generate_statutory_files(self.RUN, lines)
+
+        rows = list(csv.reader(StringIO(files['epf'].decode('utf-8'))))
+        self.assertEqual(rows[0], ['Member No', 'IC/Passport No', 'Name', 'Wages', 'Employer Share', 'Employee Share'])
+        self.assertEqual(rows[2], ['EPF123456', '900101145678', 'Tan Wei', '7200.10', '936.01', '792.01'])
+        self.assertAlmostEqual(files['totals']['salary'], 12700.10)
+        self.assertAlmostEqual(files['totals']['epf_deduction'], 1397.01)
+        self.assertAlmostEqual(files['totals']['pcb_deduction'], 300.00)
+
+    def test_fixed_width_records_have_the_layout_width(self):
+        files = generate_statutory_files(self.RUN, [make_line(name='N' * 200)])
+
+        socso_row = files['socso'].decode('ascii')
+        self.assertEqual(len(socso_row), sum(width for _, width in SOCSO_LAYOUT))
+        header, detail = files['cp39'].decode('ascii').split('\r\n')
+        self.assertEqual(len(header), sum(width for _, width in CP39_HEADER_LAYOUT))
+        self.assertEqual(len(detail), sum(width for _, width in CP39_DETAIL_LAYOUT))
+
+    def test_cp39_header_totals_and_detail_tax_number(self):
+        lines = [make_line(), make_line(id='emp2', tax_no='SG10789010', pcb_deduction=210.55), make_line(id='emp3', pcb_deduction=0)]
+        header, *details = generate_statutory_files(self.RUN, lines)['cp39'].decode('ascii').split('\r\n')
+
+        self.assertEqual(header, 'HE123456789202403000003605500002000000000000000')
+        self.assertEqual(len(details), 2)
+        self.assertEqual(details[1][1:11], 'SG10789010')
+        self.assertEqual(details[1][-26:-10], '0002105500000000')
+
+    def test_pcb_line_without_tax_number_only_withholds_cp39(self):
+        lines = [make_line(), make_line(id='emp2', name='Tan Wei', tax_no='')]
+        files = generate_statutory_files(self.RUN, lines)
+
+        self.assertIsNone(files['cp39'])
+        self.assertEqual(files['problems'], {'cp39': ['Tan Wei: no income tax number']})
+        self.assertEqual(len(files['epf'].decode('utf-8').splitlines()), 3)
+        self.assertEqual(len(files['socso'].decode('ascii').split('\r\n')), 2)
+
+        zipped = dict(statutory_zip_files(self.RUN, files))
+        self.assertEqual(sorted(zipped), ['epf_2024_03.csv', 'problems_2024_03.txt', 'socso_2024_03.txt'])
+        self.assertEqual(zipped['problems_2024_03.txt'], b'PCB CP39: Tan Wei: no income tax number')
+
+    def test_overflowing_amount_withholds_only_its_file(self):
+        files = generate_statutory_files(self.RUN, [make_line(pcb_deduction=1_000_000)])
+
+        self.assertIsNone(files['cp39'])
+        self.assertIn('pcb_amount', files['problems']['cp39'][0])
+        self.assertIsNotNone(files['socso'])
+
+    def test_lines_without_pcb_need_no_tax_number(self):
+        files = generate_statutory_files(self.RUN, [make_line(tax_no=None, pcb_deduction=0)])
+        self.assertEqual(files['problems'], {})
+        self.assertIsNotNone(files['cp39'])
+
+class FakeDocument:
+    """Stands in for a Firestore document snapshot"""
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+def line_documents(count):
+    created = datetime(2024, 3, 28, 9, 30)
+    return [
+        FakeDocument(f'emp{row}', {
+            'payroll_run_id': 'run1', 'month': '2024-03', 'employee_ref': f'emp{row}',
+            'name': f'Employee {row}', 'role': 'Engineer', 'nationality': 'Malaysian',
+            'salary': 5000 + row * 0.1, 'statutory_deductions_total': 637.75,
+            'adhoc_deductions_total': 12.5 if row % 2 else 0,
+            'total_deductions': 637.75 + (12.5 if row % 2 else 0),
+            'net_pay': 5000 + row * 0.1 - 637.75 - (12.5 if row % 2 else 0),
+            'earnings': [{'label': 'Basic Salary', 'amount': 5000 + row * 0.1}],
+            'adhoc_deductions': [{'name': 'Advance', 'amount': 12.5}] if row % 2 else [],
+            'version': row, 'created_at': created, 'updated_at': created,
+            'bank_account': f'1234{row}',
+        })
+        for row in range(count)
+    ] + [FakeDocument('deleted', None)]
+
+class PackedLinesTests(SimpleTestCase):
+    def test_round_trip_keeps_every_field_and_timestamp(self):
+        lines = PayrollLines.from_documents(line_documents(25))
+        restored = unpack_lines(pack_lines(lines))
+
+        self.assertEqual(len(restored), 25)
+        self.assertEqual([line.to_dict() for line in restored], [line.to_dict() for line in lines])
+        self.assertIsInstance(restored[3]['created_at'], datetime)
+        self.assertEqual(restored[3]['bank_account'], '12343')
+
+    def test_totals_survive_packing(self):
+        lines = PayrollLines.from_documents(line_documents(25))
+        restored = unpack_lines(pack_lines(lines))
+
+        self.assertAlmostEqual(lines.total('salary'), 125030.0)
+        self.assertAlmostEqual(lines.total('adhoc_deductions_total'), 150.0)
+        self.assertEqual(restored.totals(), lines.totals())
+
+    def test_subset_and_find(self):
+        lines = unpack_lines(pack_lines(PayrollLines.from_documents(line_documents(5))))
+
+        subset = lines.subset(['emp1', 'emp4', 'missing'])
+        self.assertEqual([line.id for line in subset], ['emp1', 'emp4'])
+        self.assertEqual(subset.total('salary'), lines.find('emp1')['salary'] + lines.find('emp4')['salary'])
+        self.assertIsNone(lines.find('missing'))
+
+    def test_snapshot_from_before_a_field_existed_reads_it_as_empty(self):
+        snapshot = PayrollLines.from_documents(line_documents(2)).to_snapshot()
+        del snapshot['numeric']['allowance']
+        del snapshot['text']['tax_no']
+        lines = PayrollLines.from_snapshot(snapshot)
+
+        self.assertEqual(lines[1]['allowance'], 0)
+        self.assertIsNone(lines[1].get('tax_no'))
+
+def merge_fields(current, data):
+    """Apply a merge write the way Firestore does: nested maps merge, increments add up"""
+    for field, value in data.items():
+        if isinstance(value, Increment):
+            current[field] = current.get(field, 0) + value.value
+        elif isinstance(value, dict) and value:
+            existing = current.get(field)
+            current[field] = merge_fields(existing if isinstance(existing, dict) else {}, value)
+        else:
+            current[field] = value
+    return current
+
+class MemoryDocumentRef:
+    """Just enough of a Firestore document reference, kept in a dict"""
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name):
+        return MemoryCollection(self.store, f'{self.path}/{name}')
+
+    def get(self, transaction=None):
+        data = self.store.get(self.path)
+        snapshot = FakeDocument(self.id, data)
+        snapshot.reference = self
+        return snapshot
+
+    def create(self, data):
+        if self.path in self.store:
+            raise AlreadyExists(self.path)
+        self.store[self.path] = dict(data)
+
+    def set(self, data, merge=False):
+        self.store[self.path] = merge_fields(self.store.get(self.path, {}), data) if merge else dict(data)
+
+    def update(self, data):
+        merge_fields(self.store[self.path], data)
+
+class MemoryCollection:
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+
+    def document(self, doc_id=None):
+        return MemoryDocumentRef(self.store, f'{self.path}/{doc_id or uuid.uuid4().hex}')
+
+    def stream(self):
+        prefix = self.path + '/'
+        return [
+            MemoryDocumentRef(self.store, path).get() for path in sorted(self.store)
+            if path.startswith(prefix) and '/' not in path[len(prefix):]
+        ]
+
+class MemoryTransaction:
+    """Applies writes straight away; tests run one worker at a time"""
+
+    def set(self, ref, data, merge=False):
+        ref.set(data, merge=merge)
+
+    def update(self, ref, data):
+        ref.update(data)
+
+    def get_all(self, refs):
+        return [ref.get() for ref in refs]
+
+class MemoryClient:
+    def __init__(self):
+        self.store = {}
+
+    def collection(self, name):
+        return MemoryCollection(self.store, name)
+
+    def batch(self):
+        return MemoryBatch()
+
+    def transaction(self):
+        return MemoryTransaction()
+
+class MemoryBatch(MemoryTransaction):
+    def commit(self):
+        pass
+
+def snapshot_lines(run_id, month, employee_ids):
+    return [
+        {'employee_ref': emp_id, 'month': month, 'name': emp_id, 'salary': 3000.0, 'statutory_deductions_total': 400.0,
+         'adhoc_deductions_total': 0, 'total_deductions': 400.0, 'net_pay': 2600.0}
+        for emp_id in employee_ids
+    ]
+
+class RunChunkResumeTests(SimpleTestCase):
+    EMPLOYEES = [f'emp{number}' for number in range(7)]
+
+    def setUp(self):
+        self.client = MemoryClient()
+        patches = [
+            mock.patch.object(repository, 'db', self.client),
+            mock.patch.object(repository, 'RUN_CHUNK_SIZE', 2),
+            mock.patch.object(repository, 'get_active_deduction_schedules', return_value={}),
+            # The transactional wrapper needs a real client; the function underneath is what's tested
+            mock.patch.object(repository, 'commit_run_chunk', repository.commit_run_chunk.to_wrap),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_doc(self, run_id):
+        return self.client.store[f'payroll_runs/{run_id}']
+
+    def line_ids(self, run_id):
+        prefix = f'payroll_runs/{run_id}/lines/'
+        return sorted(path[len(prefix):] for path in self.client.store if path.startswith(prefix))
+
+    def start(self):
+        return repository.create_payroll_run('2024-03', '2024-03-31', self.EMPLOYEES, idempotency_key='run-2024-03')
+
+    def test_chunk_membership_is_kept_off_the_run_document(self):
+        with mock.patch.object(repository, 'build_employee_lines', side_effect=snapshot_lines):
+            self.assertEqual(self.start(), ('run-2024-03', True))
+
+        run = self.run_doc('run-2024-03')
+        self.assertNotIn('employee_ids', run)
+        self.assertEqual(run['chunks_total'], 4)
+        self.assertEqual(self.client.store['payroll_runs/run-2024-03/chunks/00003'], {'employee_ids': ['emp6']})
+
+    def test_resume_after_a_crash_writes_each_line_once(self):
+        calls = {'count': 0}
+
+        def crash_on_third_chunk(run_id, month, employee_ids):
+            calls['count'] += 1
+            if calls['count'] == 3:
+                raise RuntimeError('worker killed')
+            return snapshot_lines(run_id, month, employee_ids)
+
+        with mock.patch.object(repository, 'build_employee_lines', side_effect=crash_on_third_chunk):
+            with self.assertRaises(RuntimeError):
+                self.start()
+            run = self.run_doc('run-2024-03')
+            self.assertEqual((run['status'], run['chunks_done'], run['employee_count']), ('building', 2, 4))
+
+            # A retried submit leaves a recently active run to its worker
+            self.assertEqual(self.start(), ('run-2024-03', False))
+            self.assertEqual(calls['count'], 3)
+
+            self.assertTrue(repository.build_payroll_run('run-2024-03'))
+            # Running the resume again after it finished changes nothing
+            self.assertTrue(repository.build_payroll_run('run-2024-03'))
+
+        run = self.run_doc('run-2024-03')
+        self.assertEqual((run['status'], run['chunks_done'], run['employee_count']), ('ready', 4, 7))
+        self.assertEqual(run['version'], 4)
+        self.assertEqual(self.line_ids('run-2024-03'), self.EMPLOYEES)
+        self.assertEqual(calls['count'], 5)
+
+    def test_retried_submit_resumes_a_run_whose_worker_died(self):
+        with mock.patch.object(repository, 'build_employee_lines', side_effect=[snapshot_lines('run-2024-03', '2024-03', ['emp0', 'emp1']), RuntimeError]):
+            with self.assertRaises(RuntimeError):
+                self.start()
+        self.run_doc('run-2024-03')['updated_at'] = datetime.now() - timedelta(seconds=repository.RUN_HEARTBEAT_SECONDS + 1)
+
+        with mock.patch.object(repository, 'build_employee_lines', side_effect=snapshot_lines):
+            self.assertEqual(self.start(), ('run-2024-03', True))
+        self.assertEqual(self.run_doc('run-2024-03')['employee_count'], 7)
+        self.assertEqual(self.line_ids('run-2024-03'), self.EMPLOYEES)
+
+    def test_chunk_committed_by_another_worker_is_skipped(self):
+        with mock.patch.object(repository, 'build_employee_lines', side_effect=snapshot_lines):
+            self.start()
+        run_ref = self.client.collection('payroll_runs').document('run-2024-03')
+        before = dict(self.run_doc('run-2024-03'))
+
+        lines = snapshot_lines('run-2024-03', '2024-03', ['emp0', 'emp1'])
+        self.assertFalse(repository.commit_run_chunk(MemoryTransaction(), run_ref, 0, lines))
+        self.assertEqual(self.run_doc('run-2024-03'), before)
+
+class YtdRollupTests(SimpleTestCase):
+    def setUp(self):
+        self.client = MemoryClient()
+        patch = mock.patch.object(repository, 'db', self.client)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def rollup(self):
+        return self.client.store[f"employee_ytd/{repository.ytd_rollup_id('emp0', '2024')}"]
+
+    def test_saving_an_unchanged_line_keeps_totals(self):
+        line = snapshot_lines('run-2024-03', '2024-03', ['emp0'])[0]
+        repository.add_ytd_rollup_write(MemoryBatch(), 'run-2024-03', line)
+        repository.add_ytd_rollup_write(MemoryBatch(), 'run-2024-03', line, previous=dict(line))
+
+        self.assertEqual(self.rollup()['totals']['salary'], 3000.0)
+        self.assertEqual(self.rollup()['totals']['net_pay'], 2600.0)
+
+    def test_edited_line_adds_only_the_change(self):
+        line = snapshot_lines('run-2024-03', '2024-03', ['emp0'])[0]
+        repository.add_ytd_rollup_write(MemoryBatch(), 'run-2024-03', line)
+        repository.add_ytd_rollup_write(MemoryBatch(), 'run-2024-03', {**line, 'salary': 3200.0}, previous=line)
+
+        self.assertEqual(self.rollup()['totals']['salary'], 3200.0)
+        self.assertEqual(self.rollup()['totals']['net_pay'], 2600.0)
+        self.assertEqual(self.rollup()['runs']['run-2024-03']['salary'], 3200.0)
+
+class DashboardAggregateTests(SimpleTestCase):
+    def aggregates(self, runs, months):
+        docs = [
+            FakeDocument(run_id, {
+                'month': month, 'totals': {'headcount': headcount, 'gross': gross},
+                'by_role': {'Engineer': {'headcount': headcount, 'gross': gross}},
+                'by_nationality': {},
+            })
+            for run_id, month, headcount, gross in sorted(runs, key=lambda run: run[1], reverse=True)
+        ]
+        query = mock.Mock()
+        query.order_by.return_value.stream.return_value = iter(docs)
+        with mock.patch.object(repository, 'collection', return_value=query):
+            return repository.get_dashboard_aggregates(months)
+
+    def test_runs_in_the_same_month_are_summed_into_one_row(self):
+        aggregates = self.aggregates([
+            ('run-a', '2024-03', 2, 6000.0),
+            ('run-b', '2024-03', 1, 2500.0),
+            ('run-c', '2024-02', 3, 9000.0),
+        ], months=2)
+
+        self.assertEqual([row['month'] for row in aggregates], ['2024-02', '2024-03'])
+        self.assertEqual(aggregates[1]['totals'], {'headcount': 3, 'gross': 8500.0})
+        self.assertEqual(aggregates[1]['by_role']['Engineer'], {'headcount': 3, 'gross': 8500.0})
+        self.assertEqual(sorted(aggregates[1]['run_ids']), ['run-a', 'run-b'])
+
+    def test_window_counts_months_not_runs(self):
+        aggregates = self.aggregates([
+            ('run-a', '2024-03', 2, 6000.0),
+            ('run-b', '2024-03', 1, 2500.0),
+            ('run-c', '2024-02', 3, 9000.0),
+            ('run-d', '2024-01', 3, 9000.0),
+        ], months=2)
+
+        self.assertEqual([row['month'] for row in aggregates], ['2024-02', '2024-03'])
+
+class ResumePayrollRunsTests(SimpleTestCase):
+    def test_runs_with_a_fresh_heartbeat_are_left_alone(self):
+        from .management.commands import resume_payroll_runs
+        runs = {
+            'run-live': {'status': 'building', 'updated_at': datetime.now()},
+            'run-stalled': {'status': 'building', 'updated_at': datetime.now() - timedelta(hours=1)},
+        }
+        with mock.patch.object(resume_payroll_runs, 'get_entities', return_value={'default': {}}), \
+                mock.patch.object(resume_payroll_runs, 'get_unfinished_payroll_runs', return_value=runs), \
+                mock.patch.object(resume_payroll_runs, 'build_payroll_run') as build:
+            resume_payroll_runs.Command(stdout=StringIO()).handle()
+
+        build.assert_called_once_with('run-stalled')
+
+class DeductionScheduleViewTests(SimpleTestCase):
+    def setUp(self):
+        from . import views
+        self.views = views
+        patches = [
+            mock.patch.object(views, 'get_employee_deduction_schedules', return_value=[]),
+            mock.patch('payroll.repository.get_employee', return_value={'id': 'emp1', 'name': 'Aina'}),
+            mock.patch('payroll.entities.get_entities', return_value={}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def request(self, method, path, data=None):
+        request = getattr(RequestFactory(), method)(path, data or {})
+        request.user = mock.Mock(is_authenticated=True)
+        return request
+
+    def test_invalid_amount_is_a_form_error(self):
+        with mock.patch.object(self.views, 'create_deduction_schedule') as create:
+            response = self.views.employee_schedules(
+                self.request('post', '/employees/emp1/schedules/', {'name': 'Car loan', 'amount': 'abc', 'start_month': '2024-03'}),
+                'emp1'
+            )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertContains(response, 'Monthly amount must be a number', status_code=400)
+        create.assert_not_called()
+
+    def test_valid_schedule_is_created(self):
+        with mock.patch.object(self.views, 'create_deduction_schedule') as create:
+            response = self.views.employee_schedules(
+                self.request('post', '/employees/emp1/schedules/', {'name': 'Car loan', 'amount': '250', 'start_month': '2024-03'}),
+                'emp1'
+            )
+
+        self.assertEqual(response.status_code, 302)
+        create.assert_called_once_with('emp1', 'Car loan', 250.0, '2024-03', end_month=None, remaining_balance=None)
+
+    def test_another_employees_schedule_is_not_deleted(self):
+        with mock.patch.object(self.views, 'get_deduction_schedule', return_value={'id': 'sched1', 'employee_ref': 'emp2'}), \
+                mock.patch.object(self.views, 'delete_deduction_schedule') as delete:
+            response = self.views.employee_schedule_delete(self.request('post', '/'), 'emp1', 'sched1')
+
+        self.assertEqual(response.status_code, 404)
+        delete.assert_not_called()
+
+class FinalizePayrollTests(SimpleTestCase):
+    def setUp(self):
+        from . import views
+        self.views = views
+        self.run = {'id': 'run1', 'month': '2024-03', 'status': 'ready', 'version': 3}
+        self.manifest = {'files': {'combined.pdf': {'sha256': 'abc'}}}
+        patches = [
+            mock.patch.object(views, 'run_concurrently', side_effect=lambda *calls: [[], self.run]),
+            mock.patch.object(views, 'attach_ytd'),
+            mock.patch.object(views, 'fill_missing_tax_numbers'),
+            mock.patch.object(views, 'validate_run_totals', return_value=[]),
+            mock.patch.object(views, 'discard_run_artifacts'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def finalize(self):
+        request = RequestFactory().post('/payroll/run1/finalize/')
+        request.user = mock.Mock(is_authenticated=True)
+        return self.views.finalize_payroll(request, 'run1')
+
+    def test_failed_render_leaves_the_run_unlocked(self):
+        with mock.patch.object(self.views, 'render_run_artifacts', side_effect=OSError('disk full')), \
+                mock.patch.object(self.views, 'finalize_payroll_run') as lock:
+            with self.assertRaises(OSError):
+                self.finalize()
+
+        lock.assert_not_called()
+
+    def test_checksums_are_committed_with_the_lock(self):
+        with mock.patch.object(self.views, 'render_run_artifacts', return_value=('/tmp/scratch', self.manifest)), \
+                mock.patch.object(self.views, 'finalize_payroll_run', return_value=True) as lock, \
+                mock.patch.object(self.views, 'publish_run_artifacts') as publish:
+            response = self.finalize()
+
+        self.assertEqual(response.status_code, 200)
+        lock.assert_called_once_with('run1', 3, self.manifest)
+        publish.assert_called_once_with(self.run, '/tmp/scratch', self.manifest)
+
+    def test_changed_run_discards_the_rendered_files(self):
+        with mock.patch.object(self.views, 'render_run_artifacts', return_value=('/tmp/scratch', self.manifest)), \
+                mock.patch.object(self.views, 'finalize_payroll_run', return_value=False), \
+                mock.patch.object(self.views, 'publish_run_artifacts') as publish:
+            response = self.finalize()
+
+        self.assertEqual(response.status_code, 409)
+        publish.assert_not_called()
+        self.views.discard_run_artifacts.assert_called_once_with('/tmp/scratch')
+
+    def test_finalized_run_without_frozen_files_is_frozen_again(self):
+        self.run['status'] = 'finalized'
+        with mock.patch.object(self.views, 'get_frozen_manifest', return_value=None), \
+                mock.patch.object(self.views, 'freeze_run_artifacts', return_value=self.manifest) as freeze, \
+                mock.patch.object(self.views, 'record_run_artifacts') as record:
+            response = self.finalize()
+
+        self.assertEqual(response.status_code, 200)
+        freeze.assert_called_once_with(self.run, [])
+        record.assert_called_once_with('run1', self.manifest)
+
+class ReadPunchesTests(SimpleTestCase):
+    def read(self, content, month='2024-03'):
+        return read_punches(BytesIO(content), month)
+
+    def test_offsets_are_dropped_so_mixed_timestamps_pair_up(self):
+        punches, skipped = self.read(
+            b"employee_id,timestamp\n"
+            b"E1,2024-03-04T09:00:00+08:00\n"
+            b"E1,2024-03-04T18:30:00\n"
+        )
+        summaries, unmatched = aggregate_punches(punches, '2024-03')
+
+        self.assertEqual(skipped, 0)
+        self.assertEqual(summaries['E1']['hours'], 9.5)
+        self.assertEqual(unmatched, {})
+
+    def test_file_that_is_not_utf8_is_refused(self):
+        with self.assertRaises(PunchFileError):
+            self.read("employee_id,timestamp\nE1,2024-03-04T09:00:00\nJosé,2024-03-04T18:00:00\n".encode('latin-1'))
+
+class LineWithDeductionsTests(SimpleTestCase):
+    async def test_archived_run_is_read_once_for_line_and_deductions(self):
+        from . import async_repository
+        archive = PayrollLines.from_documents(line_documents(2))
+        with mock.patch.object(async_repository, 'get_run_archive', mock.AsyncMock(return_value=archive)) as get_archive, \
+                mock.patch.object(async_repository, 'collection') as live_collection:
+            line, deductions = await async_repository.get_line_with_deductions('run1', 'emp1')
+
+        get_archive.assert_awaited_once_with('run1')
+        live_collection.assert_not_called()
+        self.assertEqual(line['id'], 'emp1')
+        self.assertEqual(deductions, [{'name': 'Advance', 'amount': 12.5}])
+
+    async def test_missing_line_in_an_archive(self):
+        from . import async_repository
+        archive = PayrollLines.from_documents(line_documents(2))
+        with mock.patch.object(async_repository, 'get_run_archive', mock.AsyncMock(return_value=archive)):
+            self.assertEqual(await async_repository.get_line_with_deductions('run1', 'nobody'), (None, []))
+
+class EntityMiddlewareTests(SimpleTestCase):
+    def setUp(self):
+        from . import entities
+        self.entities = entities
+        entities.invalidate_entities()
+        self.addCleanup(entities.invalidate_entities)
+
+    async def test_cold_cache_is_loaded_off_the_event_loop_once_per_request(self):
+        import asyncio
+        loaded_on_loop = []
+
+        def load():
+            try:
+                asyncio.get_running_loop()
+                loaded_on_loop.append(True)
+            except RuntimeError:
+                loaded_on_loop.append(False)
+            return {'default': {'id': 'default'}, 'acme': {'id': 'acme'}}
+
+        async def view(request):
+            # Lookups later in the request reuse the list, even if the cache is dropped meanwhile
+            self.entities.invalidate_entities()
+            return self.entities.current_entity(), self.entities.get_entities()
+
+        request = RequestFactory().get('/', HTTP_COOKIE=f'{self.entities.ENTITY_COOKIE}=acme')
+        with mock.patch.object(self.entities, 'load_entities', side_effect=load):
+            entity_id, entities = await self.entities.entity_middleware(view)(request)
+
+        self.assertEqual(entity_id, 'acme')
+        self.assertIn('acme', entities)
+        self.assertEqual(loaded_on_loop, [False])
@@ -5,18 +5,39 @@ urlpatterns = [
     path('', views.payroll_list, name='payroll_list'),
     path('create/', views.payroll_create, name='payroll_create'),
     path('logout/', views.logout_view, name='logout'),
+    path('entity/', views.select_entity, name='select_entity'),
+    path('dashboard/', views.dashboard, name='dashboard'),
+    path('attendance/', views.attendance_import, name='attendance_import'),
     
     # Employee management
     path('employees/', views.employee_list, name='employee_list'),
     path('employees/create/', views.employee_create, name='employee_create'),
     path('employees/<str:employee_id>/edit/', views.employee_edit, name='employee_edit'),
     path('employees/<str:employee_id>/delete/', views.employee_delete, name='employee_delete'),
+    path('employees/<str:employee_id>/history/', views.employee_history, name='employee_history'),
+    path('employees/<str:employee_id>/schedules/', views.employee_schedules, name='employee_schedules'),
+    path('employees/<str:employee_id>/schedules/<str:schedule_id>/delete/', views.employee_schedule_delete, name='employee_schedule_delete'),
+    path('api/employees/search/', views.employee_search_api, name='employee_search_api'),
+    path('api/employees/<str:employee_id>/history/', views.employee_history_api, name='employee_history_api'),
+    
+    # Annual reporting
+    path('ea-forms/<int:year>/', views.download_ea_forms, name='download_ea_forms'),
+    
+    # JSON API
+    path('api/runs/<str:run_id>/lines/', views.payroll_lines_api, name='payroll_lines_api'),
     
     # Payroll detail and downloads
     path('<str:run_id>/', views.payroll_detail, name='payroll_detail'),
+    path('<str:run_id>/clone/', views.payroll_clone, name='payroll_clone'),
+    path('<str:run_id>/finalize/', views.finalize_payroll, name='finalize_payroll'),
     path('<str:run_id>/lines/<str:line_id>/deductions/', views.get_deductions, name='get_deductions'),
     path('<str:run_id>/lines/<str:line_id>/deductions/save/', views.save_deductions, name='save_deductions'),
     path('<str:run_id>/download/', views.download_payroll_pdf, name='download_payroll_pdf'),
     path('<str:run_id>/download-zip/', views.download_all_payslips_zip, name='download_all_payslips_zip'),
     path('<str:run_id>/lines/<str:line_id>/download/', views.download_single_payslip, name='download_single_payslip'),
+    path('<str:run_id>/lines/<str:line_id>/preview/', views.payslip_preview, name='payslip_preview'),
+    path('<str:run_id>/statutory/<str:kind>/', views.download_statutory_file, name='download_statutory_file'),
+    path('<str:run_id>/register/', views.download_register, name='download_register'),
+    path('<str:run_id>/email/', views.email_payslips, name='email_payslips'),
+    path('<str:run_id>/events/', views.payroll_events, name='payroll_events'),
 ]
\ No newline at end of file
@@ -1,12 +1,40 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse, HttpResponse
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.http import JsonResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse, FileResponse
 from django.views.decorators.http import require_http_methods
+from asgiref.sync import sync_to_async
+import asyncio
+import base64
 import json
-import zipfile
+import math
+import uuid
 from datetime import datetime
-from io import BytesIO
-from .repository import get_all_employees, create_payroll_run, get_payroll_run, get_payroll_lines
-from .pdf_generator import generate_payroll_pdf
+from .repository import (
+    create_payroll_run, clone_payroll_run, get_payroll_run, iter_payroll_lines,
+    save_line_deductions, get_ytd_for_lines, get_ytd_rollups, get_employee_pay_history,
+    get_lines_with_deductions, get_payslip_data, run_concurrently,
+    get_dashboard_aggregates, AGGREGATE_DIMENSIONS,
+    get_employee_deduction_schedules, get_deduction_schedule, create_deduction_schedule, delete_deduction_schedule,
+    validate_run_totals, finalize_payroll_run, record_run_artifacts, PayrollRunLocked, PayrollRunArchived,
+    InvalidHistoryCursor, fill_missing_tax_numbers, with_employee_tax_numbers,
+    save_attendance, collection,
+)
+from .pdf_generator import generate_payroll_pdf, build_payslip_layout, get_payslip_header
+from .statutory import generate_statutory_files, statutory_filename, statutory_zip_files, STATUTORY_FILES
+from .ea_form import generate_ea_forms_pdf
+from .artifacts import (
+    freeze_run_artifacts, render_run_artifacts, publish_run_artifacts, discard_run_artifacts,
+    get_frozen_artifact, get_frozen_manifest, generate_payroll_register, build_zip,
+    payslip_filename, combined_filename, payslips_zip_filename, statutory_zip_filename, register_filename,
+)
+from .mailer import dispatch_payslips_in_background
+from .decorators import async_login_required
+from . import async_repository
+from .realtime import line_change_events
+from .search import search_employees, parse_search_params, get_employee_index, invalidate_employee_index
+from .earnings import read_punches, aggregate_punches, month_bounds, PunchFileError
+from .entities import current_entity, get_entities, ENTITY_COOKIE
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import logout
 
@@ -22,241 +50,410 @@ def payroll_create(request):
         month = request.POST.get('month')
         issued_date = request.POST.get('issued_date')
         selected_employees = request.POST.getlist('employees')
+        if request.POST.get('select_matching'):
+            # "Select all matching" re-runs the picker's search on the server
+            selected_employees = [employee['id'] for employee in search_employees(request.POST)]
+        idempotency_key = request.POST.get('idempotency_key')
         
-        # Create the payroll run
-        run_id = create_payroll_run(month, issued_date, selected_employees)
+        # Create the payroll run (a retried submit resumes the same run)
+        run_id, _ = create_payroll_run(month, issued_date, selected_employees, idempotency_key)
         
         # Redirect to the detail page
         return redirect('payroll_detail', run_id=run_id)
     
-    # GET request - show the form
-    employees = get_all_employees()
+    # GET request - show the form, narrowed by any picker filters
+    index = get_employee_index()
+    search = parse_search_params(request.GET)
+    employees = index.search(**search)
     return render(request, 'payroll/payroll_create.html', {
-        'employees': employees
+        'employees': employees,
+        'search': search,
+        'facets': index.facet_values(search),
+        'idempotency_key': uuid.uuid4().hex
     })
 
 @login_required
-def payroll_detail(request, run_id):
-    """Payroll detail page - the 'payrolling screen'"""
+def payroll_clone(request, run_id):
+    """Create a new month's run from an existing run"""
+    if request.method == 'POST':
+        try:
+            result = clone_payroll_run(
+                run_id,
+                request.POST.get('month'),
+                request.POST.get('issued_date'),
+                include_deductions=bool(request.POST.get('include_deductions')),
+                idempotency_key=request.POST.get('idempotency_key')
+            )
+        except PayrollRunArchived:
+            return HttpResponse('Archived payroll runs cannot be cloned', status=409)
+        if result is None:
+            return HttpResponse('Payroll run not found', status=404)
+        
+        new_run_id, _ = result
+        return redirect('payroll_detail', run_id=new_run_id)
+    
     run = get_payroll_run(run_id)
-    lines = get_payroll_lines(run_id)
+    if not run:
+        return HttpResponse('Payroll run not found', status=404)
+    
+    return render(request, 'payroll/payroll_clone.html', {
+        'run': run,
+        'idempotency_key': uuid.uuid4().hex
+    })
+
+@async_login_required
+async def payroll_detail(request, run_id):
+    """Payroll detail page - the 'payrolling screen'"""
+    # Run header and lines are independent, so fetch them together
+    run, lines = await asyncio.gather(
+        async_repository.get_payroll_run(run_id),
+        async_repository.get_payroll_lines(run_id)
+    )
+    
+    # Finalized runs with no frozen downloads here can have them frozen again
+    unfrozen = False
+    if run and run.get('status') == 'finalized':
+        unfrozen = await sync_to_async(get_frozen_manifest)(run_id) is None
     
     return render(request, 'payroll/payroll_detail.html', {
         'run': run,
-        'lines': lines
+        'lines': lines,
+        'totals': lines.totals(),
+        'unfrozen': unfrozen
     })
 
-@login_required
+@async_login_required
 @require_http_methods(["GET"])
-def get_deductions(request, run_id, line_id):
+async def get_deductions(request, run_id, line_id):
     """Get payroll line with statutory and ad-hoc deductions"""
-    from payroll_mvp.firebase import db
-    
-    # Get the payroll line
-    line_ref = db.collection('payroll_runs').document(run_id).collection('lines').document(line_id)
-    line_doc = line_ref.get()
+    line_data, adhoc_deductions = await async_repository.get_line_with_deductions(run_id, line_id)
     
-    if not line_doc.exists:
+    if line_data is None:
         return JsonResponse({'error': 'Line not found'}, status=404)
     
-    line_data = line_doc.to_dict()
-    line_data['id'] = line_doc.id
-    
-    # Get ad-hoc deductions
-    adhoc_deductions = []
-    docs = line_ref.collection('deductions').stream()
-    
-    for doc in docs:
-        deduction = doc.to_dict()
-        deduction['id'] = doc.id
-        adhoc_deductions.append(deduction)
-    
     return JsonResponse({
         'line': line_data,
         'adhoc_deductions': adhoc_deductions
     })
 
+# Rendered previews are keyed by line version; YTD totals from other runs' edits show once this expires
+PREVIEW_CACHE_SECONDS = 60 * 60
+
+def preview_cache_key(run_id, line_id, version):
+    return f"payslip-preview:{current_entity()}:{run_id}:{line_id}:{version}"
+
+@async_login_required
+@require_http_methods(["GET"])
+async def payslip_preview(request, run_id, line_id):
+    """HTML preview of a payslip, built from the same layout as the PDF"""
+    # A caller that knows the line's version can be answered without any Firestore reads
+    version = request.GET.get('version')
+    if version:
+        html = await cache.aget(preview_cache_key(run_id, line_id, version))
+        if html is not None:
+            return HttpResponse(html)
+    
+    run, (line_data, adhoc_deductions) = await asyncio.gather(
+        async_repository.get_payroll_run(run_id),
+        async_repository.get_line_with_deductions(run_id, line_id)
+    )
+    if run is None or line_data is None:
+        return HttpResponse('Payroll line not found', status=404)
+    
+    line_data['adhoc_deductions'] = adhoc_deductions
+    # The PDF shows YTD totals, so the preview must too
+    line_data['ytd'] = await async_repository.get_line_ytd(line_data, run['month'])
+    logo_data = get_payslip_header('compact')['logo_data']
+    html = render_to_string('payroll/payslip_preview.html', {
+        'layout': build_payslip_layout(run, line_data),
+        'logo_uri': f"data:image/png;base64,{base64.b64encode(logo_data).decode('ascii')}" if logo_data else None
+    })
+    await cache.aset(preview_cache_key(run_id, line_id, line_data.get('version') or 0), html, PREVIEW_CACHE_SECONDS)
+    
+    return HttpResponse(html)
+
+# Line fields the detail table needs when refreshing rows
+LINE_SUMMARY_FIELDS = [
+    'id', 'name', 'employee_id', 'role', 'salary', 'total_deductions', 'net_pay',
+    'email_status', 'email_error', 'version',
+]
+
+@async_login_required
+@require_http_methods(["GET"])
+async def payroll_lines_api(request, run_id):
+    """JSON lines for a run, with ETag and 'changed since version' support"""
+    run = await async_repository.get_payroll_run(run_id)
+    if not run:
+        return JsonResponse({'error': 'Payroll run not found'}, status=404)
+    
+    # The run version changes whenever any of its lines is written
+    version = run.get('version', 0)
+    etag = f'"{run_id}-{version}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        return JsonResponse({'error': 'Invalid since'}, status=400)
+    
+    # Only lines written after the client's version, unless it needs everything
+    full = not 0 < since <= version
+    if full:
+        lines = await async_repository.get_payroll_lines(run_id)
+    else:
+        lines = await async_repository.get_changed_payroll_lines(run_id, since)
+    
+    response = JsonResponse({
+        'run_id': run_id,
+        'version': version,
+        'full': full,
+        'lines': [{field: line.get(field) for field in LINE_SUMMARY_FIELDS} for line in lines]
+    })
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@async_login_required
+@require_http_methods(["GET"])
+async def payroll_events(request, run_id):
+    """Push channel (Server-Sent Events) of line changes for the detail screen"""
+    try:
+        since = int(request.GET.get('since', 0))
+    except ValueError:
+        since = 0
+    
+    response = StreamingHttpResponse(line_change_events(current_entity(), run_id, since), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @login_required
 @require_http_methods(["POST"])
 def save_deductions(request, run_id, line_id):
     """Save ad-hoc deductions for a payroll line"""
-    from payroll_mvp.firebase import db
-    from datetime import datetime
-    
     data = json.loads(request.body)
     adhoc_deductions_data = data.get('adhoc_deductions', [])
     
-    # Reference to the line and its deductions subcollection
-    line_ref = db.collection('payroll_runs').document(run_id).collection('lines').document(line_id)
-    deductions_ref = line_ref.collection('deductions')
-    
-    # Get current line data
-    line_doc = line_ref.get()
-    if not line_doc.exists:
+    try:
+        totals = save_line_deductions(run_id, line_id, adhoc_deductions_data)
+    except PayrollRunLocked:
+        return JsonResponse({'error': 'Payroll run is finalized'}, status=409)
+    if totals is None:
         return JsonResponse({'error': 'Line not found'}, status=404)
     
-    line_data = line_doc.to_dict()
-    
-    # Delete all existing ad-hoc deductions
-    existing = deductions_ref.stream()
-    for doc in existing:
-        doc.reference.delete()
-    
-    # Add new ad-hoc deductions
-    adhoc_total = 0
-    for idx, ded in enumerate(adhoc_deductions_data):
-        if ded['name'] and ded['amount']:
-            amount = float(ded['amount'])
-            adhoc_total += amount
-            
-            deductions_ref.add({
-                'name': ded['name'],
-                'amount': amount,
-                'sort_order': idx,
-                'created_at': datetime.now()
-            })
-    
-    # Calculate totals
-    statutory_total = line_data.get('statutory_deductions_total', 0)
-    total_deductions = statutory_total + adhoc_total
-    salary = line_data.get('salary', 0)
-    net_pay = salary - total_deductions
-    
-    # Update the payroll line
-    line_ref.update({
-        'adhoc_deductions_total': adhoc_total,
-        'total_deductions': total_deductions,
-        'net_pay': net_pay,
-        'updated_at': datetime.now()
-    })
-    
     return JsonResponse({
         'success': True,
-        'adhoc_deductions_total': adhoc_total,
-        'total_deductions': total_deductions,
-        'net_pay': net_pay
+        **totals
     })
 
 @login_required
-def download_payroll_pdf(request, run_id):
-    """Download combined PDF for entire payroll run"""
-    from payroll_mvp.firebase import db
+@require_http_methods(["POST"])
+def email_payslips(request, run_id):
+    """Queue payslip emails (all lines, or the given ones) for sending"""
+    data = json.loads(request.body or '{}')
+    line_ids = data.get('line_ids') or None
     
-    # Get payroll run
     run = get_payroll_run(run_id)
+    if not run:
+        return JsonResponse({'error': 'Payroll run not found'}, status=404)
+    if run.get('archived'):
+        return JsonResponse({'error': 'Payroll run is archived'}, status=409)
+    
+    dispatch_payslips_in_background(
+        run_id,
+        line_ids=line_ids,
+        password_protected=bool(data.get('password_protected')),
+        resend=bool(data.get('resend'))
+    )
+    
+    return JsonResponse({'success': True})
+
+def attach_ytd(lines, month):
+    """Attach year-to-date totals to each line for the payslip"""
+    ytd = get_ytd_for_lines(lines, month)
+    for line in lines:
+        line['ytd'] = ytd.get(line.get('employee_ref'))
+
+def frozen_download(run_id, name):
+    """Serve a finalized run's frozen artifact straight from disk, or None if there isn't one"""
+    artifact = get_frozen_artifact(run_id, name)
+    if artifact is None:
+        return None
+    
+    path, entry = artifact
+    response = FileResponse(open(path, 'rb'), as_attachment=True, filename=entry['filename'], content_type=entry['content_type'])
+    response['ETag'] = f'"{entry["sha256"]}"'
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+def attachment(content, content_type, filename):
+    response = HttpResponse(content, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@login_required
+@require_http_methods(["POST"])
+def finalize_payroll(request, run_id):
+    """Validate and lock a run, then render its downloads once"""
+    lines, run = run_concurrently(
+        lambda: get_lines_with_deductions(run_id),
+        lambda: get_payroll_run(run_id)
+    )
+    if not run:
+        return JsonResponse({'error': 'Payroll run not found'}, status=404)
+    
+    attach_ytd(lines, run['month'])
+    fill_missing_tax_numbers(lines)
+    
+    # A finalized run whose downloads never got frozen here is frozen again rather than refused
+    if run.get('status') == 'finalized':
+        if get_frozen_manifest(run_id) is not None:
+            return JsonResponse({'error': 'Payroll run is already finalized'}, status=409)
+        manifest = freeze_run_artifacts(run, lines)
+        record_run_artifacts(run_id, manifest)
+        return JsonResponse({'success': True, 'files': len(manifest['files'])})
+    
+    errors = validate_run_totals(run, lines)
+    if errors:
+        return JsonResponse({'error': 'Payroll run failed validation', 'errors': errors}, status=400)
+    
+    # Rendered before locking, so a failed render leaves the run editable; the
+    # checksums are written by the same transaction that locks the run
+    scratch, manifest = render_run_artifacts(run, lines)
+    try:
+        # Locking only succeeds if nothing changed since the lines above were read
+        if not finalize_payroll_run(run_id, run.get('version', 0), manifest):
+            return JsonResponse({'error': 'Payroll run changed while finalizing, please retry'}, status=409)
+        publish_run_artifacts(run, scratch, manifest)
+    finally:
+        discard_run_artifacts(scratch)
+    
+    return JsonResponse({'success': True, 'files': len(manifest['files'])})
+
+@login_required
+def download_payroll_pdf(request, run_id):
+    """Download combined PDF for entire payroll run"""
+    # Finalized runs are served from their frozen copy without touching Firestore
+    frozen = frozen_download(run_id, 'combined.pdf')
+    if frozen:
+        return frozen
+    
+    # Run header and lines (with deductions) are read in parallel
+    lines, run = run_concurrently(
+        lambda: get_lines_with_deductions(run_id),
+        lambda: get_payroll_run(run_id)
+    )
     if not run:
         return HttpResponse('Payroll run not found', status=404)
     
-    # Get all lines with their ad-hoc deductions
-    lines = []
-    line_docs = db.collection('payroll_runs').document(run_id).collection('lines').stream()
-    
-    for line_doc in line_docs:
-        line_data = line_doc.to_dict()
-        line_data['id'] = line_doc.id
-        
-        # Get ad-hoc deductions for this line
-        adhoc_deductions = []
-        ded_docs = line_doc.reference.collection('deductions').stream()
-        for ded_doc in ded_docs:
-            ded = ded_doc.to_dict()
-            adhoc_deductions.append(ded)
-        
-        line_data['adhoc_deductions'] = adhoc_deductions
-        lines.append(line_data)
+    attach_ytd(lines, run['month'])
     
     # Generate combined PDF
     pdf_buffer = generate_payroll_pdf(run, lines)
     
     # Return as downloadable file
-    response = HttpResponse(pdf_buffer, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="payroll_{run["month"]}_combined.pdf"'
-    
-    return response
+    return attachment(pdf_buffer, 'application/pdf', combined_filename(run))
 
 @login_required
 def download_single_payslip(request, run_id, line_id):
     """Download PDF for a single employee payslip"""
-    from payroll_mvp.firebase import db
+    frozen = frozen_download(run_id, f'payslips/{line_id}.pdf')
+    if frozen:
+        return frozen
     
-    # Get payroll run
-    run = get_payroll_run(run_id)
+    run, line_data = get_payslip_data(run_id, line_id)
     if not run:
         return HttpResponse('Payroll run not found', status=404)
-    
-    # Get the specific payroll line
-    line_ref = db.collection('payroll_runs').document(run_id).collection('lines').document(line_id)
-    line_doc = line_ref.get()
-    
-    if not line_doc.exists:
+    if not line_data:
         return HttpResponse('Payroll line not found', status=404)
     
-    line_data = line_doc.to_dict()
-    line_data['id'] = line_doc.id
-    
-    # Get ad-hoc deductions
-    adhoc_deductions = []
-    ded_docs = line_ref.collection('deductions').stream()
-    for ded_doc in ded_docs:
-        ded = ded_doc.to_dict()
-        adhoc_deductions.append(ded)
-    
-    line_data['adhoc_deductions'] = adhoc_deductions
+    attach_ytd([line_data], run['month'])
     
     # Generate PDF for single employee
     pdf_buffer = generate_payroll_pdf(run, [line_data])
     
     # Return as downloadable file
-    employee_name = line_data.get('name', 'employee').replace(' ', '_')
-    response = HttpResponse(pdf_buffer, content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="{employee_name}_payslip_{run["month"]}.pdf"'
-    
-    return response
+    return attachment(pdf_buffer, 'application/pdf', payslip_filename(run, line_data))
 
 @login_required
 def download_all_payslips_zip(request, run_id):
     """Download all payslips as individual PDFs in a ZIP file"""
-    from payroll_mvp.firebase import db
+    frozen = frozen_download(run_id, 'payslips.zip')
+    if frozen:
+        return frozen
+    
+    lines, run = run_concurrently(
+        lambda: get_lines_with_deductions(run_id),
+        lambda: get_payroll_run(run_id)
+    )
+    if not run:
+        return HttpResponse('Payroll run not found', status=404)
+    
+    attach_ytd(lines, run['month'])
+    
+    # One PDF per employee, zipped in memory
+    payslips = [
+        (payslip_filename(run, line_data), generate_payroll_pdf(run, [line_data]).getvalue())
+        for line_data in lines
+    ]
+    
+    return attachment(build_zip(payslips), 'application/zip', payslips_zip_filename(run))
+
+@login_required
+def download_statutory_file(request, run_id, kind):
+    """Download EPF / SOCSO-EIS / CP39 submission files for a payroll run"""
+    if kind != 'all' and kind not in STATUTORY_FILES:
+        return HttpResponse('Unknown statutory file', status=404)
+    
+    frozen = frozen_download(run_id, f'statutory/{kind}')
+    if frozen:
+        return frozen
+    
+    run = get_payroll_run(run_id)
+    if not run:
+        return HttpResponse('Payroll run not found', status=404)
+    
+    # All three files come out of one pass over the lines
+    files = generate_statutory_files(run, with_employee_tax_numbers(iter_payroll_lines(run_id)))
+    
+    if kind != 'all':
+        if files[kind] is None:
+            problems = '; '.join(files['problems'][kind])
+            return HttpResponse(f'{STATUTORY_FILES[kind]} file could not be generated: {problems}', status=400)
+        content_type = 'text/csv' if kind == 'epf' else 'text/plain'
+        return attachment(files[kind], content_type, statutory_filename(run, kind))
+    
+    # Files that can't be produced are left out of the zip, with the reasons alongside
+    return attachment(build_zip(statutory_zip_files(run, files)), 'application/zip', statutory_zip_filename(run))
+
+@login_required
+def download_register(request, run_id):
+    """Download the payroll register (one row per employee) as CSV"""
+    frozen = frozen_download(run_id, 'register.csv')
+    if frozen:
+        return frozen
     
-    # Get payroll run
     run = get_payroll_run(run_id)
     if not run:
         return HttpResponse('Payroll run not found', status=404)
     
-    # Get all lines
-    line_docs = db.collection('payroll_runs').document(run_id).collection('lines').stream()
-    
-    # Create in-memory ZIP file
-    zip_buffer = BytesIO()
-    
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for line_doc in line_docs:
-            line_data = line_doc.to_dict()
-            line_data['id'] = line_doc.id
-            
-            # Get ad-hoc deductions
-            adhoc_deductions = []
-            ded_docs = line_doc.reference.collection('deductions').stream()
-            for ded_doc in ded_docs:
-                ded = ded_doc.to_dict()
-                adhoc_deductions.append(ded)
-            
-            line_data['adhoc_deductions'] = adhoc_deductions
-            
-            # Generate individual PDF
-            pdf_buffer = generate_payroll_pdf(run, [line_data])
-            
-            # Add to ZIP
-            employee_name = line_data.get('name', 'employee').replace(' ', '_')
-            filename = f"{employee_name}_payslip_{run['month']}.pdf"
-            zip_file.writestr(filename, pdf_buffer.getvalue())
-    
-    zip_buffer.seek(0)
-    
-    # Return ZIP file
-    month_year = run['month'].replace('-', '_')
-    response = HttpResponse(zip_buffer, content_type='application/zip')
-    response['Content-Disposition'] = f'attachment; filename="leogics_payslips_{month_year}.zip"'
+    return attachment(generate_payroll_register(run, iter_payroll_lines(run_id)), 'text/csv', register_filename(run))
+
+@login_required
+def download_ea_forms(request, year):
+    """Download EA forms for every employee paid in a year"""
+    rollups = get_ytd_rollups(year)
+    if not rollups:
+        return HttpResponse(f'No payroll data for {year}', status=404)
+    
+    rollups.sort(key=lambda rollup: rollup.get('name') or '')
+    pdf_buffer = generate_ea_forms_pdf(year, rollups)
+    
+    response = HttpResponse(pdf_buffer, content_type='application/pdf')
+    response['Content-Disposition'] = f'attachment; filename="ea_forms_{year}.pdf"'
     
     return response
 
@@ -271,6 +468,54 @@ def payroll_list(request):
         'runs': runs
     }) 
 
+@login_required
+def dashboard(request):
+    """Monthly payroll trends from the precomputed run aggregates"""
+    aggregates = get_dashboard_aggregates()
+    
+    trend = [
+        {'month': aggregate['month'], 'headcount': 0, 'gross': 0, 'statutory': 0, 'employer': 0, 'net': 0, **aggregate['totals']}
+        for aggregate in aggregates
+    ]
+    peak_gross = max((row['gross'] for row in trend), default=0) or 1
+    for row in trend:
+        row['bar_width'] = round(row['gross'] / peak_gross * 100)
+    
+    # Each dimension value's figures month by month across the window
+    months = [aggregate['month'] for aggregate in aggregates]
+    breakdowns = []
+    for dimension in AGGREGATE_DIMENSIONS:
+        labels = {}
+        for aggregate in aggregates:
+            for label, values in aggregate.get(f"by_{dimension}", {}).items():
+                if values.get('headcount'):
+                    labels.setdefault(label, {})[aggregate['month']] = values
+        rows = []
+        for label, by_month in labels.items():
+            rows.append({
+                'label': label,
+                'months': [by_month.get(month) for month in months],
+                'gross': sum(values.get('gross', 0) for values in by_month.values())
+            })
+        rows.sort(key=lambda row: row['gross'], reverse=True)
+        breakdowns.append({'dimension': dimension.title(), 'rows': rows})
+    
+    return render(request, 'payroll/dashboard.html', {
+        'trend': trend,
+        'months': months,
+        'breakdowns': breakdowns
+    })
+
+@login_required
+@require_http_methods(["POST"])
+def select_entity(request):
+    """Switch the legal entity every page and download is scoped to"""
+    response = redirect('payroll_list')
+    entity_id = request.POST.get('entity')
+    if entity_id in get_entities():
+        response.set_cookie(ENTITY_COOKIE, entity_id, max_age=365 * 24 * 60 * 60, samesite='Lax')
+    return response
+
 def logout_view(request):
     """Handle logout"""
     logout(request)
@@ -278,19 +523,194 @@ def logout_view(request):
 
 @login_required
 def employee_list(request):
-    """List all employees"""
-    employees = get_all_employees()
+    """List employees, filtered by the search form"""
+    index = get_employee_index()
+    search = parse_search_params(request.GET)
+    employees = index.search(**search)
     
     return render(request, 'payroll/employee_list.html', {
-        'employees': employees
+        'employees': employees,
+        'search': search,
+        'facets': index.facet_values(search)
+    })
+
+@login_required
+@require_http_methods(["GET"])
+def employee_search_api(request):
+    """JSON employee search for pickers"""
+    employees = search_employees(request.GET)
+    
+    return JsonResponse({
+        'count': len(employees),
+        'employees': [
+            {field: employee.get(field) for field in ['id', 'name', 'employee_id', 'email', 'role', 'nationality', 'gender', 'base_salary']}
+            for employee in employees
+        ]
+    })
+
+@login_required
+def employee_history(request, employee_id):
+    """Pay history for one employee across payroll runs"""
+    from .repository import get_employee
+    
+    employee = get_employee(employee_id)
+    if not employee:
+        return HttpResponse('Employee not found', status=404)
+    
+    try:
+        lines, next_cursor = get_employee_pay_history(employee_id, cursor=request.GET.get('cursor'))
+    except InvalidHistoryCursor:
+        return HttpResponse('Invalid cursor', status=400)
+    
+    return render(request, 'payroll/employee_history.html', {
+        'employee': employee,
+        'lines': lines,
+        'next_cursor': next_cursor
+    })
+
+@login_required
+@require_http_methods(["GET"])
+def employee_history_api(request, employee_id):
+    """Paginated JSON pay history for one employee"""
+    try:
+        page_size = min(max(int(request.GET.get('page_size', 12)), 1), 100)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid page_size'}, status=400)
+    
+    try:
+        lines, next_cursor = get_employee_pay_history(
+            employee_id, page_size=page_size, cursor=request.GET.get('cursor')
+        )
+    except InvalidHistoryCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    return JsonResponse({
+        'lines': lines,
+        'next_cursor': next_cursor
     })
 
+@login_required
+def employee_schedules(request, employee_id):
+    """List and add an employee's recurring deduction schedules"""
+    from .repository import get_employee
+    
+    employee = get_employee(employee_id)
+    if not employee:
+        return HttpResponse('Employee not found', status=404)
+    
+    context = {'employee': employee}
+    if request.method == 'POST':
+        form = request.POST
+        errors = []
+        
+        def read_amount(field, label, required=False):
+            value = form.get(field, '').strip()
+            if not value:
+                if required:
+                    errors.append(f"{label} is required")
+                return None
+            try:
+                amount = float(value)
+            except ValueError:
+                errors.append(f"{label} must be a number")
+                return None
+            if not math.isfinite(amount) or amount < 0:
+                errors.append(f"{label} must be zero or more")
+                return None
+            return amount
+        
+        def read_month(field, label, required=False):
+            value = form.get(field, '').strip()
+            if not value:
+                if required:
+                    errors.append(f"{label} is required")
+                return None
+            try:
+                datetime.strptime(value, '%Y-%m')
+            except ValueError:
+                errors.append(f"{label} must be a month like 2024-03")
+                return None
+            return value
+        
+        name = form.get('name', '').strip()
+        if not name:
+            errors.append("Name is required")
+        amount = read_amount('amount', 'Monthly amount', required=True)
+        if amount == 0:
+            errors.append("Monthly amount must be more than zero")
+        start_month = read_month('start_month', 'Start month', required=True)
+        end_month = read_month('end_month', 'End month')
+        if start_month and end_month and end_month < start_month:
+            errors.append("End month cannot be before the start month")
+        remaining_balance = read_amount('remaining_balance', 'Remaining balance')
+        
+        if not errors:
+            create_deduction_schedule(
+                employee_id, name, amount, start_month,
+                end_month=end_month,
+                remaining_balance=remaining_balance
+            )
+            return redirect('employee_schedules', employee_id=employee_id)
+        context.update({'errors': errors, 'form': form})
+    
+    context['schedules'] = get_employee_deduction_schedules(employee_id)
+    return render(request, 'payroll/employee_schedules.html', context, status=400 if context.get('errors') else 200)
+
+@login_required
+@require_http_methods(["POST"])
+def employee_schedule_delete(request, employee_id, schedule_id):
+    """Delete a deduction schedule"""
+    schedule = get_deduction_schedule(schedule_id)
+    if not schedule or schedule.get('employee_ref') != employee_id:
+        return HttpResponse('Schedule not found', status=404)
+    delete_deduction_schedule(schedule_id)
+    return redirect('employee_schedules', employee_id=employee_id)
+
+@login_required
+def attendance_import(request):
+    """Import a month's clock punches and store per-employee attendance summaries"""
+    context = {'month': request.POST.get('month') or datetime.now().strftime('%Y-%m')}
+    
+    if request.method == 'POST' and request.FILES.get('punches'):
+        try:
+            month_bounds(context['month'])
+        except ValueError:
+            context['error'] = f"Invalid month '{context['month']}', expected YYYY-MM"
+            return render(request, 'payroll/attendance_import.html', context, status=400)
+        
+        try:
+            punches, skipped = read_punches(request.FILES['punches'].file, context['month'])
+        except PunchFileError as error:
+            context['error'] = str(error)
+            return render(request, 'payroll/attendance_import.html', context, status=400)
+        summaries, unmatched_punches = aggregate_punches(punches, context['month'])
+        
+        # Punch files carry the staff number; attendance is stored against the employee document
+        employee_refs = {
+            employee.get('employee_id'): employee['id']
+            for employee in get_employee_index().employees if employee.get('employee_id')
+        }
+        matched = {employee_refs[code]: summary for code, summary in summaries.items() if code in employee_refs}
+        save_attendance(context['month'], matched)
+        
+        context.update({
+            'imported': True,
+            'punch_count': len(punches),
+            'skipped': skipped,
+            'matched_count': len(matched),
+            'unmatched': sorted(code for code in summaries if code not in employee_refs),
+            'unmatched_punches': [
+                (code, [punched_at.strftime('%Y-%m-%d %H:%M') for punched_at in times])
+                for code, times in sorted(unmatched_punches.items())
+            ],
+        })
+    
+    return render(request, 'payroll/attendance_import.html', context)
+
 @login_required
 def employee_create(request):
     """Create a new employee"""
     if request.method == 'POST':
-        from payroll_mvp.firebase import db
-        
         employee_data = {
             'name': request.POST.get('name'),
             'role': request.POST.get('role'),
@@ -300,8 +720,12 @@ def employee_create(request):
             'passport': request.POST.get('passport'),
             'epf_no': request.POST.get('epf_no'),
             'socso_no': request.POST.get('socso_no'),
+            'tax_no': request.POST.get('tax_no'),
             'gender': request.POST.get('gender'),
+            'join_date': request.POST.get('join_date') or None,
+            'leave_date': request.POST.get('leave_date') or None,
             'base_salary': float(request.POST.get('base_salary', 0)),
+            'allowance': float(request.POST.get('allowance') or 0),
             # Employee deductions
             'epf_deduction': float(request.POST.get('epf_deduction', 0)),
             'socso_deduction': float(request.POST.get('socso_deduction', 0)),
@@ -318,7 +742,8 @@ def employee_create(request):
             'employer_hrdf': float(request.POST.get('employer_hrdf', 0)),
         }
         
-        db.collection('employees').add(employee_data)
+        collection('employees').add(employee_data)
+        invalidate_employee_index()
         
         return redirect('employee_list')
     
@@ -327,7 +752,6 @@ def employee_create(request):
 @login_required
 def employee_edit(request, employee_id):
     """Edit an employee"""
-    from payroll_mvp.firebase import db
     from .repository import get_employee
     
     if request.method == 'POST':
@@ -340,8 +764,12 @@ def employee_edit(request, employee_id):
             'passport': request.POST.get('passport'),
             'epf_no': request.POST.get('epf_no'),
             'socso_no': request.POST.get('socso_no'),
+            'tax_no': request.POST.get('tax_no'),
             'gender': request.POST.get('gender'),
+            'join_date': request.POST.get('join_date') or None,
+            'leave_date': request.POST.get('leave_date') or None,
             'base_salary': float(request.POST.get('base_salary', 0)),
+            'allowance': float(request.POST.get('allowance') or 0),
             # Employee deductions
             'epf_deduction': float(request.POST.get('epf_deduction', 0)),
             'socso_deduction': float(request.POST.get('socso_deduction', 0)),
@@ -358,7 +786,8 @@ def employee_edit(request, employee_id):
             'employer_hrdf': float(request.POST.get('employer_hrdf', 0)),
         }
         
-        db.collection('employees').document(employee_id).update(employee_data)
+        collection('employees').document(employee_id).update(employee_data)
+        invalidate_employee_index()
         
         return redirect('employee_list')
     
@@ -371,10 +800,9 @@ def employee_edit(request, employee_id):
 @login_required
 def employee_delete(request, employee_id):
     """Delete an employee"""
-    from payroll_mvp.firebase import db
-    
     if request.method == 'POST':
-        db.collection('employees').document(employee_id).delete()
+        collection('employees').document(employee_id).delete()
+        invalidate_employee_index()
         return redirect('employee_list')
     
     from .repository import get_employee
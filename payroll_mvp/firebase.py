@@ -1,7 +1,10 @@
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.cloud.firestore import AsyncClient
+import asyncio
 import os
 import json
+import weakref
 
 # Check if credentials are in environment variable (production)
 firebase_creds = os.environ.get('FIREBASE_CREDENTIALS')
@@ -15,4 +18,16 @@ else:
     cred = credentials.Certificate('firebase-credentials.json')
 
 firebase_admin.initialize_app(cred)
-db = firestore.client()
\ No newline at end of file
+db = firestore.client()
+
+# Async clients are tied to the event loop that created them
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_db():
+    """Get a Firestore AsyncClient for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncClient(project=cred.project_id, credentials=cred.get_credential())
+        _async_clients[loop] = client
+    return client
@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'payroll.entities.entity_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -65,6 +66,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'payroll.entities.entity_context',
             ],
         },
     },
@@ -130,4 +132,42 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # For Render
-CSRF_TRUSTED_ORIGINS = ['https://*.onrender.com']
\ No newline at end of file
+CSRF_TRUSTED_ORIGINS = ['https://*.onrender.com']
+
+# Employer identifiers used in statutory submission files
+EMPLOYER_SOCSO_NO = os.environ.get('EMPLOYER_SOCSO_NO', '')
+EMPLOYER_TAX_NO = os.environ.get('EMPLOYER_TAX_NO', '')
+
+# Outgoing email (console backend unless SMTP is configured)
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
+EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
+EMAIL_TIMEOUT = 30
+DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'payroll@leogics.com')
+
+# Payslip email dispatch
+PAYSLIP_EMAIL_CONNECTIONS = int(os.environ.get('PAYSLIP_EMAIL_CONNECTIONS', 4))  # pooled SMTP connections
+PAYSLIP_EMAIL_RATE = float(os.environ.get('PAYSLIP_EMAIL_RATE', 5))  # messages per second, 0 = unlimited
+PAYSLIP_EMAIL_RETRIES = int(os.environ.get('PAYSLIP_EMAIL_RETRIES', 3))
+PAYSLIP_EMAIL_STATUS_CHUNK = int(os.environ.get('PAYSLIP_EMAIL_STATUS_CHUNK', 50))  # outcomes written per run version
+PAYSLIP_PASSWORD_FIELD = os.environ.get('PAYSLIP_PASSWORD_FIELD', 'passport')  # line field used as PDF password
+
+# Frozen PDFs and exports of finalized runs; point at a persistent disk in production
+PAYROLL_ARTIFACTS_DIR = os.environ.get('PAYROLL_ARTIFACTS_DIR', os.path.join(BASE_DIR, 'artifacts'))
+
+# Payslip PDF output profile: 'print' (original logo), 'standard' or 'compact'
+PAYSLIP_PDF_PROFILE = os.environ.get('PAYSLIP_PDF_PROFILE', 'standard')
+PAYSLIP_EMAIL_PDF_PROFILE = os.environ.get('PAYSLIP_EMAIL_PDF_PROFILE', 'compact')  # emailed attachments
+
+# Legal entities: the default entity uses the top-level collections and the branding below;
+# other entities live under entities/<id>/ with branding on their entity document
+PAYROLL_DEFAULT_ENTITY = os.environ.get('PAYROLL_DEFAULT_ENTITY', 'default')
+COMPANY_NAME = "Leogics Solutions (M) Sdn. Bhd."
+COMPANY_ADDRESS_LINES = [
+    "06-01 & 06M-01, Level 6 & 6M, Menara EcoWorld, Bukit Bintang City Centre, 2, Jln Hang Tuah, Pudu",
+    "55100, Wilayah Persekutuan Kuala Lumpur",
+]
+COMPANY_REGISTRATION = "Business registration number: 202501000353 (1601768-D)"